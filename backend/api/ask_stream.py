@@ -0,0 +1,187 @@
+import asyncio
+import time
+from typing import Any, Callable, Awaitable
+
+from fastapi.encoders import jsonable_encoder
+
+from api.conf import Config
+from api.schemas import AskResponse, AskResponseType
+
+config = Config()
+
+# 只在部分类型的帧中出现的字段，为空时不发送
+_OPTIONAL_RESPONSE_FIELDS = ("message_delta", "seq", "queue_position", "queue_estimated_wait")
+
+
+def encode_ask_response(response: AskResponse) -> dict:
+    """
+    将 AskResponse 转为 json，省略为空的 _OPTIONAL_RESPONSE_FIELDS；其它字段（包括消息中的字段）为空时仍保留
+    """
+    exclude = {field for field in _OPTIONAL_RESPONSE_FIELDS if getattr(response, field, None) is None}
+    return jsonable_encoder(response, exclude=exclude)
+
+
+def diff_json(old: Any, new: Any, path: list[str | int] = None, ops: list[dict] = None) -> list[dict]:
+    """
+    计算两个 json 对象的差异，结果为 AskResponseMessageDeltaOperation 格式的操作列表
+    字符串只在末尾增长时、列表只增加元素时使用 append，其余情况使用 set / remove
+    """
+    path = path or []
+    ops = [] if ops is None else ops
+    if old == new:
+        return ops
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "set", "path": path + [key], "value": value})
+            else:
+                diff_json(old[key], value, path + [key], ops)
+        for key in old.keys() - new.keys():
+            ops.append({"op": "remove", "path": path + [key]})
+    elif isinstance(old, str) and isinstance(new, str) and new.startswith(old):
+        ops.append({"op": "append", "path": path, "value": new[len(old):]})
+    elif isinstance(old, list) and isinstance(new, list) and len(new) >= len(old):
+        for index in range(len(old)):
+            diff_json(old[index], new[index], path + [index], ops)
+        for value in new[len(old):]:
+            ops.append({"op": "append", "path": path, "value": value})
+    else:
+        ops.append({"op": "set", "path": path, "value": new})
+    return ops
+
+
+class TextChunkBuffer:
+    """
+    累积流式回复的文本：append 为 O(1)，getvalue 时才拼接上次之后新增的部分
+    避免每收到一块就复制一次完整文本（O(n²)）
+    """
+
+    def __init__(self):
+        self._value = ""
+        self._chunks: list[str] = []
+
+    def append(self, chunk: str):
+        if chunk:
+            self._chunks.append(chunk)
+
+    def set(self, text: str):
+        self._value = text
+        self._chunks = []
+
+    def has_pending(self) -> bool:
+        return bool(self._chunks)
+
+    def getvalue(self) -> str:
+        if self._chunks:
+            self._value += "".join(self._chunks)
+            self._chunks = []
+        return self._value
+
+
+class AskResponseDeltaEncoder:
+    """
+    增量模式下，将 message 类型的 AskResponse 编码为 message_delta 帧：
+    - 每一帧都带有递增的 seq，message_delta 帧应用于 seq - 1 帧得到的消息
+    - 消息 id 变化时（例如 code interpreter 的多条消息）或每隔 delta_snapshot_interval 帧发送一次完整消息，
+      客户端收到完整消息后即可重新同步
+    """
+
+    def __init__(self, snapshot_interval: int = None):
+        self.snapshot_interval = snapshot_interval or config.ask_stream.delta_snapshot_interval
+        self.seq = 0
+        self._last_message: dict | None = None
+        self._frames_since_snapshot = 0
+
+    def encode(self, response: AskResponse) -> dict:
+        data = encode_ask_response(response)
+        if response.type != AskResponseType.message or data.get("message") is None:
+            return data
+
+        self.seq += 1
+        message = data["message"]
+        last_message = self._last_message
+        self._last_message = message
+
+        if last_message is None or last_message["id"] != message["id"] or \
+                self._frames_since_snapshot >= self.snapshot_interval:
+            self._frames_since_snapshot = 0
+            data["seq"] = self.seq
+            return data
+
+        self._frames_since_snapshot += 1
+        return {
+            "type": AskResponseType.message_delta,
+            "conversation_id": data["conversation_id"],
+            "seq": self.seq,
+            "message_delta": {
+                "message_id": message["id"],
+                "ops": diff_json(last_message, message),
+            },
+        }
+
+
+class AskResponseCoalescer:
+    """
+    合并短时间内的 message 帧后再发送：
+    - message 帧都包含完整消息（增量模式下在发送时才计算差异），因此窗口内只需发送最后一帧
+    - 距上次发送 message 帧已超过一个窗口时立即发送（例如第一帧），不增加首字延迟；之后到达的帧才会被合并
+    - 其它类型的帧会先发送积压的 message 帧，然后立即发送，保证顺序
+    - 客户端较慢时，窗口内的帧会被合并；积累 coalesce_max_chunks 帧后，put 会等待发送完成，从而向上游施加背压
+    后台发送出错时（例如连接已关闭），异常会在下一次 put / flush 时抛出
+    """
+
+    def __init__(self, send: Callable[[AskResponse], Awaitable[None]], flush_interval_ms: int = None,
+                 max_chunks: int = None):
+        self._send = send
+        self.flush_interval = (config.ask_stream.coalesce_interval_ms if flush_interval_ms is None
+                               else flush_interval_ms) / 1000
+        self.max_chunks = max_chunks or config.ask_stream.coalesce_max_chunks
+        self._pending: AskResponse | None = None
+        self._pending_count = 0
+        self._lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self._error: Exception | None = None
+        self._last_sent_time: float | None = None  # 上次发送 message 帧的时间
+
+    async def put(self, response: AskResponse):
+        self._raise_if_failed()
+        if response.type != AskResponseType.message or self.flush_interval == 0:
+            await self.flush()
+            async with self._lock:
+                await self._send(response)
+            return
+        self._pending = response
+        self._pending_count += 1
+        elapsed = None if self._last_sent_time is None else time.monotonic() - self._last_sent_time
+        if self._pending_count >= self.max_chunks or \
+                (self._pending_count == 1 and (elapsed is None or elapsed >= self.flush_interval)):
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            delay = self.flush_interval if elapsed is None else max(0.0, self.flush_interval - elapsed)
+            self._flush_task = asyncio.create_task(self._delayed_flush(delay))
+
+    async def flush(self):
+        self._raise_if_failed()
+        async with self._lock:
+            if self._pending is None:
+                return
+            response, self._pending = self._pending, None
+            self._pending_count = 0
+            self._last_sent_time = time.monotonic()
+            await self._send(response)
+
+    def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._pending = None
+
+    async def _delayed_flush(self, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            self._error = e
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
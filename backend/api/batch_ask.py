@@ -0,0 +1,213 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+from api import conversation_history
+from api.conf import Config
+from api.database.sqlalchemy import get_async_session_context
+from api.enums import ChatSourceTypes, BatchAskJobStatus, BatchAskItemStatus
+from api.models.db import BaseConversation
+from api.models.doc import BatchAskJobDocument, BatchAskJobItem, OpenaiApiChatMessage, \
+    OpenaiApiChatMessageTextContent, OpenaiApiConversationHistoryDocument
+from api.schemas import BaseConversationSchema
+from api.sources import OpenaiApiChatManager
+from api.tokenizer import count_message_tokens
+from api.user_limits import UserLimitsCache
+from utils.common import singleton_with_lock
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+UNFINISHED_ITEM_STATUSES = (BatchAskItemStatus.pending, BatchAskItemStatus.running)
+
+
+def _now() -> datetime:
+    return datetime.now().astimezone(tz=timezone.utc)
+
+
+async def _update_job(job_id: uuid.UUID, update: dict):
+    # 只更新指定的字段，多个条目并发写回时互不覆盖
+    await BatchAskJobDocument.find_one(BatchAskJobDocument.id == job_id).update(update)
+
+
+@singleton_with_lock
+class BatchAskJobRunner:
+    """
+    在后台执行批量提问任务，每个任务内最多同时进行 concurrency 个提问
+    - 每个条目完成后立即写回 MongoDB，重启后由 resume_unfinished_jobs 继续执行未完成的条目
+    - 不经过 chat 中的排队和用户提问次数限制，仅供管理员使用
+    """
+
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def is_running(self, job_id: uuid.UUID | str) -> bool:
+        return str(job_id) in self._tasks
+
+    def start(self, job_id: uuid.UUID):
+        key = str(job_id)
+        if key in self._tasks:
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _task: self._tasks.pop(key, None))
+
+    async def cancel(self, job_id: uuid.UUID):
+        """
+        取消任务；正在进行的提问会被中断，其条目恢复为 pending，之后可以继续执行
+        """
+        await _update_job(job_id, {"$set": {"status": BatchAskJobStatus.cancelled, "update_time": _now()}})
+        task = self._tasks.get(str(job_id))
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def resume(self, job_id: uuid.UUID, retry_failed: bool = False):
+        """
+        继续执行任务；retry_failed 为 True 时同时重试失败的条目
+        """
+        if self.is_running(job_id):
+            return
+        job = await BatchAskJobDocument.get(job_id)
+        update = {"status": BatchAskJobStatus.pending, "finish_time": None, "update_time": _now()}
+        if retry_failed:
+            for item in job.items:
+                if item.status == BatchAskItemStatus.failed:
+                    update[f"items.{item.index}.status"] = BatchAskItemStatus.pending
+                    update[f"items.{item.index}.error"] = None
+            update["failed_count"] = 0
+        await _update_job(job.id, {"$set": update})
+        self.start(job_id)
+
+    async def resume_unfinished_jobs(self):
+        """
+        启动时调用：继续执行上次未完成（pending 或 running）的任务
+        """
+        jobs = await BatchAskJobDocument.find(
+            {"status": {"$in": [BatchAskJobStatus.pending, BatchAskJobStatus.running]}}).to_list()
+        for job in jobs:
+            logger.info(f"Resume batch ask job {job.id}: {job.succeeded_count + job.failed_count}/{job.total_count}")
+            self.start(job.id)
+
+    async def _run(self, job_id: uuid.UUID):
+        job = await BatchAskJobDocument.get(job_id)
+        if job is None or job.status in (BatchAskJobStatus.completed, BatchAskJobStatus.cancelled):
+            return
+        await _update_job(job.id, {"$set": {"status": BatchAskJobStatus.running, "update_time": _now()}})
+
+        # 上次中断时处于 running 的条目没有写回结果，重新执行
+        items = [item for item in job.items if item.status in UNFINISHED_ITEM_STATUSES]
+        semaphore = asyncio.Semaphore(job.concurrency)
+
+        async def run_item(item: BatchAskJobItem):
+            async with semaphore:
+                await self._run_item(job, item)
+
+        try:
+            await asyncio.gather(*(run_item(item) for item in items))
+        except asyncio.CancelledError:
+            # 被中断的条目恢复为 pending
+            interrupted = {f"items.{item.index}.status": BatchAskItemStatus.pending
+                           for item in items if item.status == BatchAskItemStatus.running}
+            if interrupted:
+                await _update_job(job.id, {"$set": interrupted})
+            raise
+
+        await _update_job(job.id, {"$set": {"status": BatchAskJobStatus.completed, "update_time": _now(),
+                                            "finish_time": _now()}})
+        logger.info(f"Batch ask job {job.id} completed")
+
+    async def _run_item(self, job: BatchAskJobDocument, item: BatchAskJobItem):
+        item.status = BatchAskItemStatus.running
+        await _update_job(job.id, {"$set": {f"items.{item.index}.status": BatchAskItemStatus.running}})
+
+        manager = OpenaiApiChatManager()
+        request_start_time = _now()
+        message = None
+        try:
+            async for message in manager.ask(item.prompt, model=job.model, extra_args=job.extra_args):
+                pass
+            if message is None:
+                raise ValueError("no reply")
+            conversation_id = None
+            if job.save_conversations:
+                conversation_id = await self._save_conversation(job, item, message, request_start_time)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"batch ask job {job.id} item {item.index} failed: {e.__class__.__name__} {str(e)}")
+            item.status = BatchAskItemStatus.failed
+            await _update_job(job.id, {
+                "$set": {f"items.{item.index}.status": BatchAskItemStatus.failed,
+                         f"items.{item.index}.error": str(e) or e.__class__.__name__,
+                         f"items.{item.index}.finish_time": _now(),
+                         "update_time": _now()},
+                "$inc": {"failed_count": 1},
+            })
+            return
+
+        item.status = BatchAskItemStatus.succeeded
+        await _update_job(job.id, {
+            "$set": {f"items.{item.index}.status": BatchAskItemStatus.succeeded,
+                     f"items.{item.index}.reply": message.content.text,
+                     f"items.{item.index}.finish_reason": message.metadata.finish_reason,
+                     f"items.{item.index}.usage": message.metadata.usage,
+                     f"items.{item.index}.conversation_id": conversation_id,
+                     f"items.{item.index}.finish_time": _now(),
+                     "update_time": _now()},
+            "$inc": {"succeeded_count": 1},
+        })
+
+    @staticmethod
+    async def _save_conversation(job: BatchAskJobDocument, item: BatchAskJobItem, message: OpenaiApiChatMessage,
+                                 request_start_time: datetime) -> uuid.UUID:
+        """
+        与 chat 中新建 API 对话的写入方式相同：MongoDB 中的历史记录和数据库中的对话
+        """
+        conversation_id = uuid.uuid4()
+        title = f"{job.title or 'Batch'} #{item.index + 1}"
+        ask_message = OpenaiApiChatMessage(
+            source="openai_api",
+            id=message.parent,
+            role="user",
+            create_time=request_start_time,
+            parent=None,
+            children=[message.id],
+            content=OpenaiApiChatMessageTextContent(content_type="text", text=item.prompt)
+        )
+        count_message_tokens(ask_message, job.model)
+        count_message_tokens(message, job.model)
+
+        current_time = _now()
+        await conversation_history.create_conversation_history(OpenaiApiConversationHistoryDocument(
+            source="openai_api",
+            id=conversation_id,
+            title=title,
+            create_time=request_start_time,
+            update_time=current_time,
+            mapping={
+                str(ask_message.id): ask_message,
+                str(message.id): message
+            },
+            current_node=str(message.id),
+            current_model=message.model
+        ))
+        async with get_async_session_context() as session:
+            new_conv = BaseConversationSchema(
+                source=ChatSourceTypes.openai_api,
+                is_valid=True,
+                conversation_id=conversation_id,
+                title=title,
+                user_id=job.user_id,
+                current_model=job.model,
+                create_time=current_time,
+                update_time=current_time
+            )
+            session.add(BaseConversation(**new_conv.dict(exclude_unset=True)))
+            await session.commit()
+        UserLimitsCache().on_conversation_created(job.user_id, ChatSourceTypes.openai_api)
+        return conversation_id
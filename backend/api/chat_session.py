@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+from sqlalchemy import update
+
+from api.conf import Config
+from api.database.sqlalchemy import get_async_session_context
+from api.enums import OpenaiWebChatStatus
+from api.models.db import UserSetting
+from utils.common import singleton_with_lock
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+
+@singleton_with_lock
+class ChatSessionRegistry:
+    """
+    记录各用户当前的 openai_web 提问状态（排队中 / 提问中），只保存在内存中，重启后所有用户均为 idling
+    - 提问过程中不再读写数据库，避免 SQLite 写锁影响其它请求
+    - openai_web.chat_status_snapshot_interval > 0 时，定期将状态批量写入 user_setting.openai_web_chat_status，供管理员查看
+    """
+
+    def __init__(self):
+        self._sessions: dict[int, tuple[OpenaiWebChatStatus, float]] = {}  # user_id -> (状态, 开始时间)
+        self._dirty = False
+        self._snapshot_task: asyncio.Task | None = None
+
+    def get_status(self, user_id: int) -> OpenaiWebChatStatus:
+        session = self._sessions.get(user_id)
+        return session[0] if session is not None else OpenaiWebChatStatus.idling
+
+    def set_status(self, user_id: int, status: OpenaiWebChatStatus):
+        if status == OpenaiWebChatStatus.idling:
+            if self._sessions.pop(user_id, None) is None:
+                return
+        else:
+            self._sessions[user_id] = (status, time.time())
+        self._dirty = True
+
+    def count(self, status: OpenaiWebChatStatus) -> int:
+        return sum(1 for session_status, _ in self._sessions.values() if session_status == status)
+
+    def get_sessions(self) -> dict[int, tuple[OpenaiWebChatStatus, float]]:
+        return dict(self._sessions)
+
+    async def reset_snapshot(self):
+        """
+        启动时将数据库中的状态全部重置为 idling（只需要一条 UPDATE）
+        """
+        async with get_async_session_context() as session:
+            await session.execute(
+                update(UserSetting)
+                .where(UserSetting.openai_web_chat_status != OpenaiWebChatStatus.idling)
+                .values(openai_web_chat_status=OpenaiWebChatStatus.idling)
+            )
+            await session.commit()
+
+    async def snapshot(self):
+        """
+        将当前状态写入数据库；状态没有变化时跳过
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        sessions = self.get_sessions()
+        async with get_async_session_context() as session:
+            await session.execute(
+                update(UserSetting)
+                .where(UserSetting.openai_web_chat_status != OpenaiWebChatStatus.idling,
+                       UserSetting.user_id.not_in(list(sessions.keys())))
+                .values(openai_web_chat_status=OpenaiWebChatStatus.idling)
+            )
+            for status in (OpenaiWebChatStatus.queueing, OpenaiWebChatStatus.asking):
+                user_ids = [user_id for user_id, (session_status, _) in sessions.items() if session_status == status]
+                if user_ids:
+                    await session.execute(
+                        update(UserSetting)
+                        .where(UserSetting.user_id.in_(user_ids))
+                        .values(openai_web_chat_status=status)
+                    )
+            await session.commit()
+
+    def start_snapshot(self):
+        interval = config.openai_web.chat_status_snapshot_interval
+        if interval <= 0 or self._snapshot_task is not None:
+            return
+
+        async def snapshot_regularly():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.snapshot()
+                except Exception as e:
+                    self._dirty = True
+                    logger.warning(f"Failed to snapshot chat status: {e}")
+
+        self._snapshot_task = asyncio.create_task(snapshot_regularly())
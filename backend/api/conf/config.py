@@ -26,6 +26,12 @@ class CommonSetting(BaseModel):
     create_initial_admin_user: bool = True
     initial_admin_user_username: str = 'admin'
     initial_admin_user_password: str = 'password'
+    # 记录与上游之间的请求和回复（已去除密钥），或者回放记录而不请求上游；用于可重复的性能测试，见 api/upstream_record.py
+    upstream_record_dir: Optional[str] = None
+    upstream_replay_dir: Optional[str] = None
+    upstream_replay_speed: float = Field(1.0, ge=0)  # 回放倍速，0 表示不等待
+    # 扣除的提问次数先记录在内存中，每隔这么多秒批量写入数据库；0 表示每次提问后立即写入
+    ask_count_flush_interval: int = Field(5, ge=0)
 
     @validator("initial_admin_user_password")
     def validate_password(cls, v):
@@ -48,6 +54,8 @@ class DataSetting(BaseModel):
     mongodb_db_name: str = 'cws'
     run_migration: bool = False
     max_file_upload_size: int = Field(100 * 1024 * 1024, ge=0)
+    # 新对话历史的存储方式；split 为每条消息一个文档，适合很长的对话。已有对话需用 manage.py migrate_history_layout 迁移
+    history_storage_layout: Literal['embedded', 'split'] = 'embedded'
 
     @validator("database_url")
     def validate_database_url(cls, v):
@@ -70,9 +78,28 @@ class OpenaiWebChatGPTSetting(BaseModel):
     proxy: Optional[str] = None
     common_timeout: int = Field(20, ge=1)  # connect, read, write
     ask_timeout: int = Field(600, ge=1)
+    http2: bool = True  # 需要安装 h2
+    max_connections: int = Field(50, ge=1)  # 每个账号 session 的连接数上限
+    max_keepalive_connections: int = Field(10, ge=0)
+    keepalive_expiry: float = Field(60, ge=0)  # 空闲连接保留的时间（秒）
+    warm_up_on_startup: bool = True  # 启动时预先建立到 chatgpt_base_url 的连接
+    account_max_concurrency: int = Field(1, ge=1)  # 每个账号同时进行的提问数
+    account_unhealthy_cooldown_seconds: int = Field(300, ge=0)  # 账号出错（401/403/429）后暂停分配的时间
+    ask_queue_policy: Literal['fifo', 'weighted'] = 'fifo'  # weighted: 按用户设置的 queue_weight 加权公平排队
+    ask_queue_update_interval: float = Field(1, gt=0)  # 向排队中的用户推送排队位置的间隔（秒）
+    # 用户排队 / 提问状态只保存在内存中；大于 0 时每隔这么多秒批量写入数据库一次（user_setting.openai_web_chat_status）
+    chat_status_snapshot_interval: int = Field(0, ge=0)
+    # 优先级 = 用户 ask_priority + 管理员加成 + 模型优先级 + 排队时间 / ask_queue_aging_seconds，优先级高的先分配
+    ask_queue_superuser_priority: int = 0
+    ask_queue_model_priorities: dict[OpenaiWebChatModels, int] = {}  # 例如 gpt_3_5: 2, gpt_4_code_interpreter: -2
+    ask_queue_aging_seconds: int = Field(60, ge=1)  # 每排队这么久优先级 +1，避免低优先级提问饿死
     sync_conversations_on_startup: bool = True
     sync_conversations_schedule: bool = False
     sync_conversations_schedule_interval_hours: int = Field(12, ge=1)
+    sync_conversations_incremental: bool = True  # 只同步上次同步后更新过的对话；全量同步才能发现已删除的对话
+    sync_conversations_concurrency: int = Field(4, ge=1)  # 同步时并发获取的页数
+    history_cache: bool = True  # 优先从 mongodb 返回对话历史，对话在本地更新后才重新从 ChatGPT 获取
+    history_cache_revalidate_seconds: int = Field(300, ge=0)  # 缓存超过该时间后，返回缓存的同时在后台重新获取
     enabled_models: list[OpenaiWebChatModels] = ["gpt_3_5", "gpt_4", "gpt_4_code_interpreter", "gpt_4_plugins",
                                                  "gpt_4_browsing"]
     model_code_mapping: dict[OpenaiWebChatModels, str] = default_openai_web_model_code_mapping
@@ -108,6 +135,31 @@ class OpenaiApiSetting(BaseModel):
         "gpt_3_5": "gpt-3.5-turbo",
         "gpt_4": "gpt-4",
     }
+    context_cache_size: int = Field(1000, ge=0)  # 在内存中缓存最近提问的对话分支，用于组装上下文，0 表示不缓存
+    tokenizer: str = 'auto'  # auto: 安装了 tiktoken 时使用 tiktoken，否则使用 estimate 估算
+    model_context_length: dict[OpenaiApiChatModels, int] = {  # 按 token 截断上下文；未设置的模型不截断
+        "gpt_3_5": 4096,
+        "gpt_4": 8192,
+    }
+    reserved_completion_tokens: int = Field(1024, ge=0)  # 为回复预留的 token 数
+    max_connections: int = Field(100, ge=1)
+    key_max_concurrency: int = Field(10, ge=1)  # 每个 key 同时进行的提问数
+    key_rpm_limit: Optional[int] = Field(None, ge=1)  # 每个 key 每分钟的请求数上限，为空表示不限制
+    key_tpm_limit: Optional[int] = Field(None, ge=1)  # 每个 key 每分钟的 token 数上限，为空表示不限制
+    key_cooldown_seconds: int = Field(60, ge=0)  # key 被限流（429）且没有 Retry-After 时暂停使用的时间
+    key_acquire_timeout: int = Field(30, ge=0)  # 等待可用 key 的最长时间
+    response_cache: bool = False  # 完全相同的请求（模型、消息、extra_args）直接使用缓存的回复
+    response_cache_ttl: int = Field(24 * 60 * 60, ge=1)  # 缓存的回复的有效时间（秒）
+    response_cache_size: int = Field(10000, ge=0)  # 最多缓存的回复数
+    batch_ask_max_concurrency: int = Field(4, ge=1)  # 每个批量提问任务同时进行的提问数上限
+    batch_ask_max_prompts: int = Field(1000, ge=1)  # 每个批量提问任务的 prompt 数上限
+
+
+class AskStreamSetting(BaseModel):
+    delta_snapshot_interval: int = Field(50, ge=1)  # 增量模式下，每隔多少帧发送一次完整消息
+    coalesce_interval_ms: int = Field(50, ge=0)  # 合并该时间窗口内的消息帧，0 表示不合并
+    coalesce_max_chunks: int = Field(20, ge=1)  # 窗口内积累这么多帧时立即发送
+    raw_relay: bool = False  # 开启后流式转发时只提取必要字段，不逐帧构造和校验 pydantic 模型
 
 
 class LogSetting(BaseModel):
@@ -129,6 +181,7 @@ class ConfigModel(BaseModel):
     auth: AuthSetting = AuthSetting()
     stats: StatsSetting = StatsSetting()
     log: LogSetting = LogSetting()
+    ask_stream: AskStreamSetting = AskStreamSetting()
 
     class Config:
         underscore_attrs_are_private = True
@@ -145,6 +198,7 @@ class Config(BaseConfig[ConfigModel]):
         stats: StatsSetting = StatsSetting()
         data: DataSetting = DataSetting()
         auth: AuthSetting = AuthSetting()
+        ask_stream: AskStreamSetting = AskStreamSetting()
 
     def __init__(self, load_config: bool = True):
         super().__init__(ConfigModel, "config.yaml", load_config=load_config)
@@ -1,6 +1,6 @@
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from api.conf.base_config import BaseConfig
 from utils.common import singleton_with_lock
@@ -8,11 +8,31 @@ from utils.common import singleton_with_lock
 _TYPE_CHECKING = False
 
 
+class OpenaiWebAccountCredentials(BaseModel):
+    name: str
+    access_token: str
+    max_concurrency: Optional[int] = Field(None, ge=1)  # 为空时使用 openai_web.account_max_concurrency
+    enabled: bool = True
+
+
+class OpenaiApiKeyCredentials(BaseModel):
+    name: str
+    api_key: str
+    max_concurrency: Optional[int] = Field(None, ge=1)  # 为空时使用 openai_api.key_max_concurrency
+    rpm_limit: Optional[int] = Field(None, ge=1)  # 每分钟请求数上限，为空时使用 openai_api.key_rpm_limit
+    tpm_limit: Optional[int] = Field(None, ge=1)  # 每分钟 token 数上限，为空时使用 openai_api.key_tpm_limit
+    enabled: bool = True
+
+
 class CredentialsModel(BaseModel):
     openai_web_access_token: Optional[str] = None
     # chatgpt_account_username: Optional[str] = None
     # chatgpt_account_password: Optional[str] = None
+    # 额外的 ChatGPT 账号，与 openai_web_access_token（即 default 账号）一起组成账号池
+    openai_web_extra_accounts: list[OpenaiWebAccountCredentials] = []
     openai_api_key: Optional[str] = None
+    # 额外的 API key，与 openai_api_key（即 default key）一起组成 key 池
+    openai_api_extra_keys: list[OpenaiApiKeyCredentials] = []
 
 
 @singleton_with_lock
@@ -21,7 +41,9 @@ class Credentials(BaseConfig[CredentialsModel]):
         openai_web_access_token: Optional[str]
         # chatgpt_account_username: Optional[str]
         # chatgpt_account_password: Optional[str]
+        openai_web_extra_accounts: list[OpenaiWebAccountCredentials]
         openai_api_key: Optional[str]
+        openai_api_extra_keys: list[OpenaiApiKeyCredentials]
 
     def __init__(self, load_config: bool = True):
         super().__init__(CredentialsModel, "credentials.yaml", load_config=load_config)
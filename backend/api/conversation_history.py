@@ -0,0 +1,399 @@
+"""
+对话历史的读写：兼容两种存储方式
+- embedded: 所有消息保存在对话历史文档的 mapping 中
+- split: 对话历史文档只保存元数据，每条消息单独保存为 *ChatMessageDocument
+读取单个分支或部分消息时，split 方式只需读取用到的消息
+"""
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from bson import Binary
+
+from api.conf import Config
+from api.enums import ChatSourceTypes
+from api.models.doc import BaseChatMessage, BaseConversationHistory, OpenaiWebConversationHistoryDocument, \
+    OpenaiApiConversationHistoryDocument, OpenaiWebChatMessageDocument, OpenaiApiChatMessageDocument
+from utils.common import singleton_with_lock
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+_HISTORY_DOCUMENTS = {
+    ChatSourceTypes.openai_web: OpenaiWebConversationHistoryDocument,
+    ChatSourceTypes.openai_api: OpenaiApiConversationHistoryDocument,
+}
+
+_MESSAGE_DOCUMENTS = {
+    ChatSourceTypes.openai_web: OpenaiWebChatMessageDocument,
+    ChatSourceTypes.openai_api: OpenaiApiChatMessageDocument,
+}
+
+
+def _is_split(doc: BaseConversationHistory) -> bool:
+    return doc.storage_layout == "split"
+
+
+def _to_message_document(source: ChatSourceTypes, conversation_id: uuid.UUID, message: BaseChatMessage):
+    return _MESSAGE_DOCUMENTS[source](id=message.id, conversation_id=conversation_id, parent=message.parent,
+                                      message=message)
+
+
+def _diff_mapping(old: dict[str, BaseChatMessage], new: dict[str, BaseChatMessage]) -> tuple[dict, set]:
+    """
+    返回新增或变化的消息，以及已删除的消息 id
+    消息的 create_time 不会变化，且从 mongodb 读出后精度和时区都不同，因此比较时忽略
+    """
+    changed = {}
+    for message_id, message in new.items():
+        old_message = old.get(message_id)
+        if old_message is None or old_message.dict(exclude={"create_time"}) != message.dict(exclude={"create_time"}):
+            changed[message_id] = message
+    return changed, old.keys() - new.keys()
+
+
+def get_branch_from_mapping(mapping: dict[str, BaseChatMessage], node_id: uuid.UUID | str,
+                            limit: int = None) -> list[BaseChatMessage]:
+    """
+    从已加载的 mapping 中取出根节点到 node_id 的消息，按从旧到新排列；limit 不为空时只取最后 limit 条
+    """
+    messages = []
+    message = mapping.get(str(node_id))
+    # len(mapping) 防止 parent 成环
+    while message is not None and len(messages) <= len(mapping) and (limit is None or len(messages) < limit):
+        messages.append(message)
+        message = mapping.get(str(message.parent)) if message.parent else None
+    messages.reverse()
+    return messages
+
+
+async def get_conversation_history(source: ChatSourceTypes, conversation_id: uuid.UUID | str,
+                                   with_mapping: bool = True) -> BaseConversationHistory | None:
+    """
+    with_mapping 为 False 时，split 方式的对话不加载消息（mapping 为空）
+    """
+    doc = await _HISTORY_DOCUMENTS[source].get(uuid.UUID(str(conversation_id)))
+    if doc is not None and _is_split(doc) and with_mapping:
+        message_docs = await _MESSAGE_DOCUMENTS[source].find(
+            _MESSAGE_DOCUMENTS[source].conversation_id == doc.id).to_list()
+        doc.mapping = {str(message_doc.id): message_doc.message for message_doc in message_docs}
+    return doc
+
+
+async def load_branch(source: ChatSourceTypes, conversation_id: uuid.UUID | str, node_id: uuid.UUID | str = None,
+                      limit: int = None) -> tuple[BaseConversationHistory | None, list[BaseChatMessage]]:
+    """
+    返回对话历史文档，以及从根节点到 node_id（默认为 current_node）的消息，按从旧到新排列
+    limit 不为空时只返回最后 limit 条消息；返回的文档不一定包含完整的 mapping
+    """
+    doc = await get_conversation_history(source, conversation_id, with_mapping=False)
+    if doc is None:
+        return None, []
+    node_id = node_id or doc.current_node
+    if node_id is None or limit == 0:
+        return doc, []
+
+    if not _is_split(doc):
+        return doc, get_branch_from_mapping(doc.mapping, node_id, limit)
+
+    # 使用 $graphLookup 沿 parent 一次查出所有祖先
+    message_document = _MESSAGE_DOCUMENTS[source]
+    conversation_id = Binary.from_uuid(doc.id)
+    graph_lookup = {
+        "from": message_document.get_collection_name(),
+        "startWith": "$parent",
+        "connectFromField": "parent",
+        "connectToField": "_id",
+        "as": "ancestors",
+        "depthField": "depth",
+        "restrictSearchWithMatch": {"conversation_id": conversation_id},
+    }
+    if limit is not None:
+        graph_lookup["maxDepth"] = max(limit - 2, 0)
+    pipeline = [{"$match": {"_id": Binary.from_uuid(uuid.UUID(str(node_id))), "conversation_id": conversation_id}}]
+    if limit != 1:
+        pipeline.append({"$graphLookup": graph_lookup})
+    results = await message_document.get_motor_collection().aggregate(pipeline).to_list(length=None)
+    if not results:
+        return doc, []
+    messages = []
+    ancestors = sorted(results[0].get("ancestors", []), key=lambda item: item["depth"], reverse=True)
+    for item in ancestors + [results[0]]:
+        messages.append(message_document.parse_obj(item).message)
+    if limit is not None:
+        messages = messages[-limit:]
+    return doc, messages
+
+
+async def load_children(source: ChatSourceTypes, conversation_id: uuid.UUID | str,
+                        parent_id: uuid.UUID | str, doc: BaseConversationHistory = None) -> list[BaseChatMessage]:
+    """
+    返回 parent_id 的所有子消息；doc 为已读取的对话历史文档，可避免重复读取
+    """
+    doc = doc or await get_conversation_history(source, conversation_id, with_mapping=False)
+    if doc is None:
+        return []
+    if not _is_split(doc):
+        parent = doc.mapping.get(str(parent_id))
+        if parent is None:
+            return []
+        return [doc.mapping[str(child)] for child in parent.children if str(child) in doc.mapping]
+    message_document = _MESSAGE_DOCUMENTS[source]
+    message_docs = await message_document.find(
+        message_document.conversation_id == doc.id, message_document.parent == uuid.UUID(str(parent_id))).to_list()
+    return [message_doc.message for message_doc in message_docs]
+
+
+async def load_descendants(source: ChatSourceTypes, conversation_id: uuid.UUID | str, node_id: uuid.UUID | str,
+                           limit: int, doc: BaseConversationHistory = None) -> list[BaseChatMessage]:
+    """
+    返回从 node_id 开始，每次沿最新的子消息（children 的最后一个）向下直到叶子节点的消息，最多 limit 条
+    用于切换分支：客户端已有 node_id 之前的消息，只需加载切换后的部分
+    """
+    doc = doc or await get_conversation_history(source, conversation_id, with_mapping=False)
+    if doc is None:
+        return []
+    messages = []
+    if not _is_split(doc):
+        message = doc.mapping.get(str(node_id))
+        while message is not None and len(messages) < limit:
+            messages.append(message)
+            message = doc.mapping.get(str(message.children[-1])) if message.children else None
+        return messages
+    if limit <= 0:
+        return messages
+
+    # 使用 $graphLookup 沿 parent 反向一次查出 limit 层以内的所有后代，再沿最新的子消息取出一条分支
+    message_document = _MESSAGE_DOCUMENTS[source]
+    conversation_id = Binary.from_uuid(doc.id)
+    pipeline = [{"$match": {"_id": Binary.from_uuid(uuid.UUID(str(node_id))), "conversation_id": conversation_id}}]
+    if limit > 1:
+        pipeline.append({"$graphLookup": {
+            "from": message_document.get_collection_name(),
+            "startWith": "$_id",
+            "connectFromField": "_id",
+            "connectToField": "parent",
+            "as": "descendants",
+            "maxDepth": limit - 2,
+            "restrictSearchWithMatch": {"conversation_id": conversation_id},
+        }})
+    results = await message_document.get_motor_collection().aggregate(pipeline).to_list(length=None)
+    if not results:
+        return messages
+    descendants = {}
+    for item in results[0].get("descendants", []):
+        message = message_document.parse_obj(item).message
+        descendants[str(message.id)] = message
+    message = message_document.parse_obj(results[0]).message
+    while message is not None and len(messages) < limit:
+        messages.append(message)
+        message = descendants.get(str(message.children[-1])) if message.children else None
+    return messages
+
+
+@singleton_with_lock
+class ConversationThreadCache:
+    """
+    按对话缓存最近一次提问所在的分支（从旧到新的消息列表），提问时若 parent 为缓存分支的末尾，则无需读取数据库
+    - 只缓存用于组装上下文的消息，其中消息的 children 可能不是最新的
+    - 经本站追加消息后用 append 增量更新；对话被删除时需要 invalidate
+    - LRU，最多缓存 openai_api.context_cache_size 个对话；每个分支最多缓存 put 时指定的 capacity 条消息
+    """
+
+    def __init__(self):
+        # conversation_id -> (messages, 是否包含根节点, capacity)
+        self._threads: OrderedDict[str, tuple[list[BaseChatMessage], bool, int]] = OrderedDict()
+
+    def get(self, conversation_id: uuid.UUID | str, node_id: uuid.UUID | str,
+            count: int) -> list[BaseChatMessage] | None:
+        """
+        返回分支末尾为 node_id 时的最后 count 条消息；缓存不存在或消息不足时返回 None
+        """
+        key = str(conversation_id)
+        if key not in self._threads:
+            return None
+        messages, is_complete, _capacity = self._threads[key]
+        if not messages or str(messages[-1].id) != str(node_id) or (len(messages) < count and not is_complete):
+            return None
+        self._threads.move_to_end(key)
+        return messages[-count:]
+
+    def put(self, conversation_id: uuid.UUID | str, messages: list[BaseChatMessage], capacity: int):
+        """
+        messages 为分支末尾的若干条消息；第一条消息没有 parent 时即为完整的分支
+        """
+        if config.openai_api.context_cache_size == 0 or not messages:
+            return
+        key = str(conversation_id)
+        messages = messages[-capacity:]
+        self._threads[key] = (messages, messages[0].parent is None, capacity)
+        self._threads.move_to_end(key)
+        while len(self._threads) > config.openai_api.context_cache_size:
+            self._threads.popitem(last=False)
+
+    def append(self, conversation_id: uuid.UUID | str, messages: list[BaseChatMessage]):
+        """
+        追加新消息；新消息不是接在缓存分支的末尾时（例如从中间分叉），缓存新消息所在的分支
+        """
+        key = str(conversation_id)
+        if key not in self._threads or not messages:
+            return
+        cached_messages, is_complete, capacity = self._threads[key]
+        parent = messages[0].parent
+        for index in range(len(cached_messages) - 1, -1, -1):
+            if cached_messages[index].id == parent:
+                cached_messages = cached_messages[:index + 1] + list(messages)
+                if len(cached_messages) > capacity:
+                    cached_messages = cached_messages[-capacity:]
+                    is_complete = False
+                self._threads[key] = (cached_messages, is_complete, capacity)
+                self._threads.move_to_end(key)
+                return
+        self.invalidate(conversation_id)
+
+    def invalidate(self, conversation_id: uuid.UUID | str):
+        self._threads.pop(str(conversation_id), None)
+
+
+async def create_conversation_history(doc: BaseConversationHistory):
+    """
+    保存新对话的历史，使用 data.history_storage_layout 设置的存储方式
+    """
+    if config.data.history_storage_layout == "split":
+        mapping = doc.mapping
+        doc.mapping = {}
+        doc.storage_layout = "split"
+        await _MESSAGE_DOCUMENTS[doc.source].find(_MESSAGE_DOCUMENTS[doc.source].conversation_id == doc.id).delete()
+        if mapping:
+            await _MESSAGE_DOCUMENTS[doc.source].insert_many(
+                [_to_message_document(doc.source, doc.id, message) for message in mapping.values()])
+        await doc.save()
+        doc.mapping = mapping
+    else:
+        doc.storage_layout = "embedded"
+        await doc.save()
+
+
+async def add_messages(source: ChatSourceTypes, conversation_id: uuid.UUID, messages: list[BaseChatMessage],
+                       current_model: str | None, update_time: datetime) -> bool:
+    """
+    向已有对话追加消息，最后一条消息作为 current_node；新消息的 parent 会追加到对应消息的 children 中
+    只写入新增的内容，不重写整个文档。返回 False 表示对话或父消息不存在
+    """
+    history_document = _HISTORY_DOCUMENTS[source]
+    message_ids = {message.id for message in messages}
+    new_children: dict[uuid.UUID, list[uuid.UUID]] = {}
+    for message in messages:
+        if message.parent is not None and message.parent not in message_ids:
+            new_children.setdefault(message.parent, []).append(message.id)
+    header_fields = {
+        "current_node": messages[-1].id,
+        "current_model": current_model,
+        "update_time": update_time,
+    }
+
+    # embedded: 一次更新完成；父消息不存在时不匹配
+    history_update = {"$set": {**header_fields, **{f"mapping.{message.id}": message for message in messages}}}
+    if new_children:
+        history_update["$push"] = {f"mapping.{parent}.children": {"$each": children}
+                                   for parent, children in new_children.items()}
+    history_filters = [history_document.id == conversation_id, {"storage_layout": {"$ne": "split"}}]
+    history_filters += [{f"mapping.{parent}": {"$exists": True}} for parent in new_children]
+    result = await history_document.find_one(*history_filters).update(history_update)
+    if result.matched_count == 1:
+        return True
+
+    # split
+    message_document = _MESSAGE_DOCUMENTS[source]
+    for parent, children in new_children.items():
+        result = await message_document.find_one(
+            message_document.id == parent, message_document.conversation_id == conversation_id
+        ).update({"$push": {"message.children": {"$each": children}}})
+        if result.matched_count == 0:
+            return False
+    result = await history_document.find_one(
+        history_document.id == conversation_id, {"storage_layout": "split"}
+    ).update({"$set": header_fields})
+    if result.matched_count == 0:
+        return False
+    await message_document.insert_many([_to_message_document(source, conversation_id, message)
+                                        for message in messages])
+    return True
+
+
+async def save_conversation_history(doc: BaseConversationHistory, cached_doc: BaseConversationHistory = None):
+    """
+    用完整的 doc 覆盖已有的对话历史；传入完整加载的 cached_doc 时只写入变化的消息
+    """
+    if cached_doc is None:
+        existing = await _HISTORY_DOCUMENTS[doc.source].get(doc.id)
+        if existing is not None and _is_split(existing):
+            await _MESSAGE_DOCUMENTS[doc.source].find(
+                _MESSAGE_DOCUMENTS[doc.source].conversation_id == doc.id).delete()
+        await create_conversation_history(doc)
+        return
+
+    if _is_split(cached_doc) and not cached_doc.mapping:  # 只读取了对话历史文档
+        cached_doc = await get_conversation_history(doc.source, doc.id)
+    history_document = _HISTORY_DOCUMENTS[doc.source]
+    changed, removed = _diff_mapping(cached_doc.mapping, doc.mapping)
+    header_fields = {key: getattr(doc, key) for key in doc.__fields__ if key not in (
+        "id", "revision_id", "mapping", "create_time", "storage_layout")}
+    if not _is_split(cached_doc):
+        update = {"$set": {**header_fields, **{f"mapping.{message_id}": message
+                                               for message_id, message in changed.items()}}}
+        if removed:
+            update["$unset"] = {f"mapping.{message_id}": "" for message_id in removed}
+        await history_document.find_one(history_document.id == doc.id).update(update)
+    else:
+        message_document = _MESSAGE_DOCUMENTS[doc.source]
+        replaced_ids = [uuid.UUID(message_id) for message_id in list(changed.keys()) + list(removed)]
+        if replaced_ids:
+            await message_document.find(message_document.conversation_id == doc.id,
+                                        {"_id": {"$in": replaced_ids}}).delete()
+        if changed:
+            await message_document.insert_many(
+                [_to_message_document(doc.source, doc.id, message) for message in changed.values()])
+        await history_document.find_one(history_document.id == doc.id).update({"$set": header_fields})
+    doc.storage_layout = cached_doc.storage_layout
+
+
+async def delete_conversation_history(source: ChatSourceTypes, conversation_id: uuid.UUID):
+    ConversationThreadCache().invalidate(conversation_id)
+    await _MESSAGE_DOCUMENTS[source].find(_MESSAGE_DOCUMENTS[source].conversation_id == conversation_id).delete()
+    await _HISTORY_DOCUMENTS[source].find_one(_HISTORY_DOCUMENTS[source].id == conversation_id).delete()
+
+
+async def migrate_conversation_history(layout: str) -> int:
+    """
+    将所有对话历史迁移为 layout 存储方式，返回迁移的对话数；可重复执行，中断后重新执行即可
+    """
+    count = 0
+    for source, history_document in _HISTORY_DOCUMENTS.items():
+        message_document = _MESSAGE_DOCUMENTS[source]
+        if layout == "split":
+            query = {"storage_layout": {"$ne": "split"}}
+        else:
+            query = {"storage_layout": "split"}
+        async for doc in history_document.find(query):
+            try:
+                if layout == "split":
+                    # 先写入消息再修改对话历史文档，中断时文档仍为 embedded
+                    await message_document.find(message_document.conversation_id == doc.id).delete()
+                    if doc.mapping:
+                        await message_document.insert_many(
+                            [_to_message_document(source, doc.id, message) for message in doc.mapping.values()])
+                    await history_document.find_one(history_document.id == doc.id).update(
+                        {"$set": {"mapping": {}, "storage_layout": "split"}})
+                else:
+                    message_docs = await message_document.find(message_document.conversation_id == doc.id).to_list()
+                    mapping = {str(message_doc.id): message_doc.message for message_doc in message_docs}
+                    await history_document.find_one(history_document.id == doc.id).update(
+                        {"$set": {"mapping": mapping, "storage_layout": "embedded"}})
+                    await message_document.find(message_document.conversation_id == doc.id).delete()
+                count += 1
+            except Exception as e:
+                logger.warning(f"Failed to migrate conversation history {doc.id} to {layout}: "
+                               f"{e.__class__.__name__} {e}")
+    return count
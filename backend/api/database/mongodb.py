@@ -3,7 +3,7 @@ from motor.motor_asyncio import AsyncIOMotorClient
 
 from api.conf import Config
 from api.models.doc import OpenaiApiConversationHistoryDocument, OpenaiWebConversationHistoryDocument, AskLogDocument, \
-    RequestLogDocument
+    RequestLogDocument, OpenaiWebChatMessageDocument, OpenaiApiChatMessageDocument, BatchAskJobDocument
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -18,7 +18,8 @@ async def init_mongodb():
     client = AsyncIOMotorClient(config.data.mongodb_url)
     await init_beanie(database=client[config.data.mongodb_db_name],
                       document_models=[OpenaiApiConversationHistoryDocument, OpenaiWebConversationHistoryDocument, AskLogDocument,
-                                       RequestLogDocument])
+                                       RequestLogDocument, OpenaiWebChatMessageDocument, OpenaiApiChatMessageDocument,
+                                       BatchAskJobDocument])
     # 展示当前mongodb数据库用量
     db = client[config.data.mongodb_db_name]
     stats = await db.command({"dbStats": 1})
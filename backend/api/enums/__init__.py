@@ -1,2 +1,2 @@
 from .models import ChatSourceTypes, OpenaiWebChatModels, OpenaiApiChatModels
-from .status import OpenaiWebChatStatus
+from .status import OpenaiWebChatStatus, BatchAskJobStatus, BatchAskItemStatus
@@ -6,3 +6,17 @@ class OpenaiWebChatStatus(StrEnum):
     asking = auto()
     queueing = auto()
     idling = auto()
+
+
+class BatchAskJobStatus(StrEnum):
+    pending = auto()
+    running = auto()
+    completed = auto()
+    cancelled = auto()
+
+
+class BatchAskItemStatus(StrEnum):
+    pending = auto()
+    running = auto()
+    succeeded = auto()
+    failed = auto()
@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import List, Optional
 
 from fastapi_users_db_sqlalchemy import Integer
-from sqlalchemy import String, Enum, Boolean, ForeignKey, func, Float
+from sqlalchemy import String, Enum, Boolean, ForeignKey, func, Float, Index
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
 
 from api.database.custom_types import Pydantic, UTCDateTime, GUID
@@ -68,6 +68,10 @@ class BaseConversation(Base):
         "polymorphic_on": "source",
         "polymorphic_identity": "base",
     }
+    __table_args__ = (
+        # 提问前统计用户有效对话数量
+        Index("ix_conversation_user_id_source_is_valid", "user_id", "source", "is_valid"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     source: Mapped[ChatSourceTypes] = mapped_column(Enum(ChatSourceTypes), comment="对话类型")
@@ -79,6 +83,8 @@ class BaseConversation(Base):
     is_valid: Mapped[bool] = mapped_column(Boolean, comment="是否有效")
     create_time: Mapped[Optional[datetime]] = mapped_column(UTCDateTime(timezone=True), comment="创建时间")
     update_time: Mapped[Optional[datetime]] = mapped_column(UTCDateTime(timezone=True), comment="最后更新时间")
+    openai_web_account: Mapped[Optional[str]] = mapped_column(String(64), default=None,
+                                                              comment="对话所属的 ChatGPT 账号，为空表示 default 账号")
 
 
 class OpenaiWebConversation(BaseConversation):
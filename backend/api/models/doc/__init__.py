@@ -4,8 +4,9 @@ from typing import Optional, Any, Literal, Union, Annotated, Dict
 
 from beanie import Document, TimeSeriesConfig, Granularity
 from pydantic import BaseModel, Field
+from pymongo import IndexModel, ASCENDING
 
-from api.enums import OpenaiWebChatModels, OpenaiApiChatModels
+from api.enums import OpenaiWebChatModels, OpenaiApiChatModels, BatchAskJobStatus, BatchAskItemStatus
 from api.models.doc.openai_web_code_interpreter import OpenaiWebChatMessageMetadataAggregateResult, \
     OpenaiWebChatMessageMetadataAttachment
 from api.models.types import SourceTypeLiteral
@@ -75,6 +76,10 @@ class OpenaiApiChatMessageMetadata(BaseModel):
     source: Literal['openai_api']
     usage: Optional[OpenaiChatResponseUsage]
     finish_reason: Optional[str]
+    # 内容的 token 数缓存，tokenizer 为计算时使用的分词器
+    token_count: Optional[int]
+    tokenizer: Optional[str]
+    cached: Optional[bool]  # 回复来自 openai_api.response_cache，没有请求 OpenAI
 
 
 # content 相关
@@ -212,6 +217,8 @@ class BaseConversationHistory(BaseModel):
     current_model: Optional[str]
     metadata: Optional[Annotated[
         Union[OpenaiWebConversationHistoryMeta, OpenaiApiConversationHistoryMeta], Field(discriminator='source')]]
+    # split: 消息单独存储在 *ChatMessageDocument 中，mongodb 中的 mapping 为空；为空时等同于 embedded
+    storage_layout: Optional[Literal['embedded', 'split']]
 
 
 class OpenaiWebConversationHistoryDocument(Document, BaseConversationHistory):
@@ -219,6 +226,7 @@ class OpenaiWebConversationHistoryDocument(Document, BaseConversationHistory):
     source: Literal["openai_web"]
     mapping: dict[str, OpenaiWebChatMessage]
     metadata: Optional[OpenaiWebConversationHistoryMeta]
+    fetch_time: Optional[datetime.datetime]  # 从 ChatGPT 获取的时间，用于判断缓存是否过期
 
     class Settings:
         name = "openai_web_conversation_history"
@@ -235,6 +243,76 @@ class OpenaiApiConversationHistoryDocument(Document, BaseConversationHistory):
         validate_on_save = True
 
 
+# 按消息存储（storage_layout 为 split）时，每条消息一个文档
+
+
+class OpenaiWebChatMessageDocument(Document):
+    id: uuid.UUID = Field(alias="_id")  # 即消息 id
+    conversation_id: uuid.UUID
+    parent: Optional[uuid.UUID]
+    message: OpenaiWebChatMessage
+
+    class Settings:
+        name = "openai_web_chat_message"
+        indexes = [
+            IndexModel([("conversation_id", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("conversation_id", ASCENDING), ("parent", ASCENDING)]),
+        ]
+
+
+class OpenaiApiChatMessageDocument(Document):
+    id: uuid.UUID = Field(alias="_id")
+    conversation_id: uuid.UUID
+    parent: Optional[uuid.UUID]
+    message: OpenaiApiChatMessage
+
+    class Settings:
+        name = "openai_api_chat_message"
+        indexes = [
+            IndexModel([("conversation_id", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("conversation_id", ASCENDING), ("parent", ASCENDING)]),
+        ]
+
+
+class BatchAskJobItem(BaseModel):
+    index: int
+    prompt: str
+    status: BatchAskItemStatus = BatchAskItemStatus.pending
+    reply: Optional[str]
+    finish_reason: Optional[str]
+    usage: Optional[OpenaiChatResponseUsage]
+    error: Optional[str]
+    conversation_id: Optional[uuid.UUID]  # save_conversations 为 True 时保存的对话
+    finish_time: Optional[datetime.datetime]
+
+
+class BatchAskJobDocument(Document):
+    """
+    批量提问任务：每个 prompt 作为一次独立的新对话提问，结果逐条写回 items
+    """
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, alias="_id")
+    user_id: int
+    title: Optional[str]
+    model: OpenaiApiChatModels
+    extra_args: Optional[dict[str, Any]]
+    concurrency: int
+    save_conversations: bool = False
+    status: BatchAskJobStatus = BatchAskJobStatus.pending
+    items: list[BatchAskJobItem]
+    total_count: int
+    succeeded_count: int = 0
+    failed_count: int = 0
+    create_time: datetime.datetime
+    update_time: datetime.datetime
+    finish_time: Optional[datetime.datetime]
+
+    class Settings:
+        name = "batch_ask_jobs"
+        indexes = [
+            IndexModel([("status", ASCENDING)]),
+        ]
+
+
 class RequestLogMeta(BaseModel):
     route_path: str
     method: Literal['GET', 'POST', 'PUT', 'DELETE', 'PATCH'] | str
@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+
+from sqlalchemy import select
+
+from api.conf import Config
+from api.database.sqlalchemy import get_async_session_context
+from api.enums import ChatSourceTypes
+from api.models.db import UserSetting
+from api.schemas import UserReadAdmin, UserSettingSchema
+from utils.common import singleton_with_lock
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+UNLIMITED = -1
+
+
+class AskCounts:
+    """
+    某用户某一对话类型的提问次数；作为余额时 -1 表示不限，作为扣除量时表示扣除的次数
+    """
+
+    def __init__(self, total: int = 0, models: dict[str, int] | None = None):
+        self.total = total
+        self.models = models if models is not None else {}
+
+    def add(self, other: "AskCounts", sign: int = 1):
+        # 结果不小于 0，以免变成 -1（不限）
+        if self.total != UNLIMITED:
+            self.total = max(0, self.total + sign * other.total)
+        for model, count in other.models.items():
+            if self.models.get(model, 0) != UNLIMITED:
+                self.models[model] = max(0, self.models.get(model, 0) + sign * count)
+
+    def is_empty(self) -> bool:
+        return self.total == 0 and not any(self.models.values())
+
+
+class AskCountReservation:
+    def __init__(self, user_id: int, source: ChatSourceTypes, deduction: AskCounts):
+        self.user_id = user_id
+        self.source = source
+        self.deduction = deduction
+        self.is_settled = False
+
+
+@singleton_with_lock
+class QuotaLedger:
+    """
+    用户剩余提问次数（total_ask_count / per_model_ask_count）的内存账本：
+    - 检查和预扣在同一次同步调用中完成，不会被并发的提问穿插；提问失败时退还，得到回复后确认扣除
+    - 确认的扣除量每隔 common.ask_count_flush_interval 秒批量写入数据库，写入时基于数据库中的当前值扣除，不覆盖其它修改
+    - 写入后用数据库中的值校正内存中的余额；管理员修改用户设置前先写入该用户未写入的扣除量，修改后丢弃该用户的余额
+    """
+
+    def __init__(self):
+        self._balances: dict[tuple[int, ChatSourceTypes], AskCounts] = {}
+        self._pending: dict[tuple[int, ChatSourceTypes], AskCounts] = {}  # 已确认、未写入数据库的扣除量
+        self._in_flight: dict[tuple[int, ChatSourceTypes], AskCounts] = {}  # 已预扣、未确认的扣除量
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+
+    def _get_balance(self, user: UserReadAdmin, source: ChatSourceTypes) -> AskCounts:
+        key = (user.id, source)
+        balance = self._balances.get(key)
+        if balance is None:
+            source_setting = getattr(user.setting, source)
+            balance = AskCounts(source_setting.total_ask_count, dict(source_setting.per_model_ask_count.__root__))
+            # 用户信息可能读取于上次写入之前
+            for deduction in (self._pending.get(key), self._in_flight.get(key)):
+                if deduction is not None:
+                    balance.add(deduction, -1)
+            self._balances[key] = balance
+        return balance
+
+    def get_balance(self, user: UserReadAdmin, source: ChatSourceTypes) -> AskCounts:
+        return self._get_balance(user, source)
+
+    def reserve(self, user: UserReadAdmin, source: ChatSourceTypes, model: str) -> AskCountReservation | None:
+        """
+        预扣一次提问；调用前需用 get_balance 检查余额（两者之间不能有 await）。不限次数时返回 None
+        """
+        balance = self._get_balance(user, source)
+        deduction = AskCounts()
+        if balance.total != UNLIMITED:
+            deduction.total = 1
+        if balance.models.get(model, UNLIMITED) != UNLIMITED:
+            deduction.models[model] = 1
+        if deduction.is_empty():
+            return None
+        balance.add(deduction, -1)
+        self._in_flight.setdefault((user.id, source), AskCounts()).add(deduction)
+        return AskCountReservation(user.id, source, deduction)
+
+    def _settle(self, reservation: AskCountReservation):
+        key = (reservation.user_id, reservation.source)
+        reservation.is_settled = True
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            in_flight.add(reservation.deduction, -1)
+            if in_flight.is_empty():
+                del self._in_flight[key]
+
+    def release(self, reservation: AskCountReservation | None):
+        """
+        提问失败，退还预扣的次数
+        """
+        if reservation is None or reservation.is_settled:
+            return
+        self._settle(reservation)
+        balance = self._balances.get((reservation.user_id, reservation.source))
+        if balance is not None:
+            balance.add(reservation.deduction)
+
+    def commit(self, reservation: AskCountReservation | None):
+        """
+        已得到回复，确认扣除；之后写入数据库
+        """
+        if reservation is None or reservation.is_settled:
+            return
+        self._settle(reservation)
+        self._pending.setdefault((reservation.user_id, reservation.source), AskCounts()).add(reservation.deduction)
+
+    @contextlib.asynccontextmanager
+    async def resetting_user(self, user_id: int):
+        """
+        包裹管理员对用户设置的修改：修改前写入该用户未写入的扣除量，修改期间不会有其它写入，修改后以设置中的次数为准
+        """
+        async with self._flush_lock:
+            pending = {}
+            for source in ChatSourceTypes:
+                deduction = self._pending.pop((user_id, source), None)
+                if deduction is not None:
+                    pending[(user_id, source)] = deduction
+            if pending:
+                try:
+                    await self._write(pending)
+                except Exception:
+                    for key, deduction in pending.items():
+                        self._pending.setdefault(key, AskCounts()).add(deduction)
+                    raise
+            yield
+            for source in ChatSourceTypes:
+                self._balances.pop((user_id, source), None)
+
+    def apply_to(self, user_id: int, setting: UserSettingSchema):
+        """
+        用内存中的余额覆盖 setting 中的次数（数据库中的值可能还没有写入）
+        """
+        for source in ChatSourceTypes:
+            balance = self._balances.get((user_id, source))
+            if balance is not None:
+                source_setting = getattr(setting, source)
+                source_setting.total_ask_count = balance.total
+                source_setting.per_model_ask_count.__root__.update(balance.models)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            try:
+                flushed = await self._write(pending)
+            except Exception:
+                # 写入失败，合并回去等待下次写入
+                for key, deduction in pending.items():
+                    self._pending.setdefault(key, AskCounts()).add(deduction)
+                raise
+            # 用写入后的数据库值校正余额，扣除写入期间新增的扣除量
+            for key, counts in flushed.items():
+                if key not in self._balances:
+                    continue
+                for deduction in (self._pending.get(key), self._in_flight.get(key)):
+                    if deduction is not None:
+                        counts.add(deduction, -1)
+                self._balances[key] = counts
+
+    @staticmethod
+    async def _write(pending: dict[tuple[int, ChatSourceTypes], AskCounts]) -> dict[tuple[int, ChatSourceTypes], AskCounts]:
+        flushed = {}
+        async with get_async_session_context() as session:
+            r = await session.execute(
+                select(UserSetting).where(UserSetting.user_id.in_({user_id for user_id, _ in pending})))
+            settings = {setting.user_id: setting for setting in r.scalars().all()}
+            for (user_id, source), deduction in pending.items():
+                setting = settings.get(user_id)
+                if setting is None:  # 用户已删除
+                    continue
+                source_setting = getattr(setting, source).copy(deep=True)
+                if source_setting.total_ask_count != UNLIMITED:
+                    source_setting.total_ask_count = max(0, source_setting.total_ask_count - deduction.total)
+                per_model_ask_count = source_setting.per_model_ask_count.__root__
+                for model, count in deduction.models.items():
+                    if per_model_ask_count.get(model, UNLIMITED) != UNLIMITED:
+                        per_model_ask_count[model] = max(0, per_model_ask_count[model] - count)
+                setattr(setting, source, source_setting)
+                flushed[(user_id, source)] = AskCounts(source_setting.total_ask_count, dict(per_model_ask_count))
+            await session.commit()
+        return flushed
+
+    def start_flush(self):
+        interval = config.common.ask_count_flush_interval
+        if interval <= 0 or self._flush_task is not None:
+            return
+
+        async def flush_regularly():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.warning(f"Failed to flush ask counts: {e}")
+
+        self._flush_task = asyncio.create_task(flush_regularly())
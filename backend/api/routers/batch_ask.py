@@ -0,0 +1,145 @@
+import csv
+import io
+import json
+import uuid
+from datetime import datetime, timezone
+from typing import Literal
+
+from fastapi import APIRouter, Depends
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+from api.batch_ask import BatchAskJobRunner
+from api.conf import Config
+from api.enums import BatchAskJobStatus
+from api.exceptions import InvalidParamsException, ResourceNotFoundException, InvalidRequestException
+from api.models.db import User
+from api.models.doc import BatchAskJobDocument, BatchAskJobItem
+from api.schemas import BatchAskJobCreate, BatchAskJobSchema
+from api.users import current_super_user
+
+router = APIRouter()
+config = Config()
+
+EXPORT_FIELDS = ["index", "status", "prompt", "reply", "finish_reason", "prompt_tokens", "completion_tokens",
+                 "error", "conversation_id"]
+
+
+async def _get_job(job_id: uuid.UUID) -> BatchAskJobDocument:
+    job = await BatchAskJobDocument.get(job_id)
+    if job is None:
+        raise ResourceNotFoundException(f"No such batch ask job: {job_id}")
+    return job
+
+
+@router.post("/batch-ask", tags=["batch-ask"], response_model=BatchAskJobSchema)
+async def create_batch_ask_job(job_create: BatchAskJobCreate, user: User = Depends(current_super_user)):
+    """
+    创建并立即开始执行批量提问任务，每个 prompt 使用 OpenAI API 作为新对话单独提问
+    """
+    if not config.openai_api.enabled:
+        raise InvalidRequestException("openai_api is not enabled")
+    if job_create.model not in config.openai_api.enabled_models:
+        raise InvalidParamsException("errors.modelNotEnabled")
+    if len(job_create.prompts) > config.openai_api.batch_ask_max_prompts:
+        raise InvalidParamsException(f"Too many prompts, max: {config.openai_api.batch_ask_max_prompts}")
+    current_time = datetime.now().astimezone(tz=timezone.utc)
+    job = BatchAskJobDocument(
+        user_id=user.id,
+        title=job_create.title,
+        model=job_create.model,
+        extra_args=job_create.extra_args,
+        concurrency=min(job_create.concurrency or config.openai_api.batch_ask_max_concurrency,
+                        config.openai_api.batch_ask_max_concurrency),
+        save_conversations=job_create.save_conversations,
+        items=[BatchAskJobItem(index=index, prompt=prompt) for index, prompt in enumerate(job_create.prompts)],
+        total_count=len(job_create.prompts),
+        create_time=current_time,
+        update_time=current_time,
+    )
+    await job.insert()
+    BatchAskJobRunner().start(job.id)
+    return BatchAskJobSchema(**job.dict())
+
+
+@router.get("/batch-ask", tags=["batch-ask"], response_model=list[BatchAskJobSchema])
+async def get_batch_ask_jobs(_user: User = Depends(current_super_user)):
+    jobs = await BatchAskJobDocument.find_all(projection_model=BatchAskJobSchema).sort(
+        -BatchAskJobDocument.create_time).to_list()
+    return jobs
+
+
+@router.get("/batch-ask/{job_id}", tags=["batch-ask"], response_model=BatchAskJobDocument)
+async def get_batch_ask_job(job_id: uuid.UUID, _user: User = Depends(current_super_user)):
+    """
+    返回任务及每个条目的结果
+    """
+    return await _get_job(job_id)
+
+
+@router.post("/batch-ask/{job_id}/cancel", tags=["batch-ask"], response_model=BatchAskJobSchema)
+async def cancel_batch_ask_job(job_id: uuid.UUID, _user: User = Depends(current_super_user)):
+    job = await _get_job(job_id)
+    if job.status == BatchAskJobStatus.completed:
+        raise InvalidRequestException("Batch ask job is already completed")
+    await BatchAskJobRunner().cancel(job_id)
+    return BatchAskJobSchema(**(await _get_job(job_id)).dict())
+
+
+@router.post("/batch-ask/{job_id}/resume", tags=["batch-ask"], response_model=BatchAskJobSchema)
+async def resume_batch_ask_job(job_id: uuid.UUID, retry_failed: bool = False,
+                               _user: User = Depends(current_super_user)):
+    """
+    继续执行被取消的任务；retry_failed 为 True 时重新执行失败的条目（已完成的任务也可以）
+    """
+    job = await _get_job(job_id)
+    if job.status == BatchAskJobStatus.completed and not (retry_failed and job.failed_count > 0):
+        raise InvalidRequestException("Batch ask job is already completed")
+    await BatchAskJobRunner().resume(job_id, retry_failed=retry_failed)
+    return BatchAskJobSchema(**(await _get_job(job_id)).dict())
+
+
+@router.delete("/batch-ask/{job_id}", tags=["batch-ask"])
+async def delete_batch_ask_job(job_id: uuid.UUID, _user: User = Depends(current_super_user)):
+    """
+    删除任务记录；已保存的对话不会被删除
+    """
+    job = await _get_job(job_id)
+    await BatchAskJobRunner().cancel(job_id)
+    await job.delete()
+    return None
+
+
+def _export_row(item: BatchAskJobItem) -> dict:
+    return {
+        "index": item.index,
+        "status": item.status,
+        "prompt": item.prompt,
+        "reply": item.reply,
+        "finish_reason": item.finish_reason,
+        "prompt_tokens": item.usage.prompt_tokens if item.usage else None,
+        "completion_tokens": item.usage.completion_tokens if item.usage else None,
+        "error": item.error,
+        "conversation_id": item.conversation_id,
+    }
+
+
+@router.get("/batch-ask/{job_id}/export", tags=["batch-ask"])
+async def export_batch_ask_job(job_id: uuid.UUID, format: Literal["jsonl", "csv"] = "jsonl",
+                               _user: User = Depends(current_super_user)):
+    """
+    按 prompt 顺序导出结果，每个条目一行
+    """
+    job = await _get_job(job_id)
+    rows = [_export_row(item) for item in job.items]
+    if format == "csv":
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+        content, media_type = output.getvalue(), "text/csv"
+    else:
+        content = "".join(json.dumps(jsonable_encoder(row), ensure_ascii=False) + "\n" for row in rows)
+        media_type = "application/x-ndjson"
+    return Response(content=content, media_type=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="batch-ask-{job_id}.{format}"'})
@@ -10,10 +10,12 @@ from fastapi import APIRouter, Depends
 from fastapi.encoders import jsonable_encoder
 from httpx import HTTPError
 from pydantic import ValidationError
-from sqlalchemy import select, func, and_
 from starlette.websockets import WebSocket, WebSocketState
 from websockets.exceptions import ConnectionClosed
 
+from api import conversation_history
+from api.ask_stream import AskResponseDeltaEncoder, AskResponseCoalescer, encode_ask_response
+from api.chat_session import ChatSessionRegistry
 from api.conf import Config
 from api.database.sqlalchemy import get_async_session_context
 from api.enums import OpenaiWebChatStatus, ChatSourceTypes, OpenaiWebChatModels, OpenaiApiChatModels
@@ -25,15 +27,22 @@ from api.models.doc import OpenaiWebChatMessage, OpenaiApiChatMessage, OpenaiWeb
     OpenaiApiAskLogMeta
 from api.routers.conv import _get_conversation_by_id
 from api.schemas import OpenaiWebConversationSchema, AskRequest, AskResponse, AskResponseType, UserReadAdmin, \
-    BaseConversationSchema
+    BaseConversationSchema, AskStreamMode
 from api.schemas.openai_schemas import OpenaiChatPlugin, OpenaiChatPluginUserSettings
-from api.sources import OpenaiWebChatManager, convert_revchatgpt_message, OpenaiApiChatManager, OpenaiApiException
+from api.sources import OpenaiWebChatManager, convert_revchatgpt_message, OpenaiApiChatManager, OpenaiApiException, \
+    DEFAULT_ACCOUNT_NAME, convert_revchatgpt_message_to_json, MAX_CONTEXT_MESSAGE_COUNT
+from api.tokenizer import count_message_tokens
+from api.quota_ledger import QuotaLedger, AskCountReservation
+from api.user_limits import UserLimitsCache
 from api.users import websocket_auth, current_active_user, current_super_user
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 router = APIRouter()
 openai_web_manager = OpenaiWebChatManager()
+chat_session_registry = ChatSessionRegistry()
+user_limits_cache = UserLimitsCache()
+quota_ledger = QuotaLedger()
 openai_api_manager = OpenaiApiChatManager()
 config = Config()
 
@@ -136,21 +145,11 @@ class WebsocketInvalidAskException(WebsocketException):
         super().__init__(1008, tip, error_detail)
 
 
-async def change_user_chat_status(user_id: int, status: OpenaiWebChatStatus):
-    async with get_async_session_context() as session:
-        user = await session.get(User, user_id)
-        user.setting.openai_web_chat_status = status
-        session.add(user.setting)
-        await session.commit()
-        await session.refresh(user)
-    return user
-
-
-async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
-    source_setting = user.setting.openai_web if ask_request.source == ChatSourceTypes.openai_web else user.setting.openai_api
+async def check_limits(user: UserReadAdmin, ask_request: AskRequest) -> AskCountReservation | None:
+    source_limits = user_limits_cache.get_source_limits(user, ask_request.source)
 
     # 是否允许使用当前提问类型
-    if not source_setting.allow_to_use:
+    if not source_limits.allow_to_use:
         raise WebsocketInvalidAskException(tip="errors.userNotAllowToUseChatType")
 
     # 当前对话类型是否全局启用
@@ -160,22 +159,18 @@ async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
 
     # 是否到期
     current_datetime = datetime.now().astimezone(tz=timezone.utc)
-    if source_setting.valid_until is not None and current_datetime > source_setting.valid_until:
+    if source_limits.valid_until is not None and current_datetime > source_limits.valid_until:
         raise WebsocketInvalidAskException(tip="errors.userChatTypeExpired",
-                                           error_detail=f"valid until: {source_setting.valid_until}")
+                                           error_detail=f"valid until: {source_limits.valid_until}")
 
     # 当前时间是否允许请求
-    time_slots = source_setting.daily_available_time_slots  # list of {start_time, end_time} datetime.time
-    if time_slots is not None and len(time_slots) > 0:
-        now_time = datetime.now().time()  # TODO: 时区处理
-        if not any(time_slot.start_time <= now_time <= time_slot.end_time for time_slot in time_slots):
-            raise WebsocketInvalidAskException("errors.userNotAllowToAskAtThisTime")
+    if not source_limits.is_available_at(datetime.now().time()):  # TODO: 时区处理
+        raise WebsocketInvalidAskException("errors.userNotAllowToAskAtThisTime")
 
     # TODO: 时间窗口频率限制
 
     # 判断是否能使用该模型
-    if ask_request.source == ChatSourceTypes.openai_web and ask_request.model not in user.setting.openai_web.available_models or \
-            ask_request.source == ChatSourceTypes.openai_api and ask_request.model not in user.setting.openai_api.available_models:
+    if ask_request.model not in source_limits.available_models:
         raise WebsocketInvalidAskException("errors.userNotAllowToUseModel")
 
     # 模型是否全局启用
@@ -183,26 +178,10 @@ async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
             ask_request.source == ChatSourceTypes.openai_api and ask_request.model not in config.openai_api.enabled_models:
         raise WebsocketInvalidAskException("errors.modelNotEnabled")
 
-    # 对话次数判断
-    model_ask_count = source_setting.per_model_ask_count.__root__.get(ask_request.model, 0)
-    total_ask_count = source_setting.total_ask_count
-    if total_ask_count != -1 and total_ask_count <= 0:
-        # await websocket.close(1008, "errors.noAvailableTotalAskCount")
-        raise WebsocketInvalidAskException("errors.noAvailableTotalAskCount")
-    if model_ask_count != -1 and model_ask_count <= 0:
-        # await websocket.close(1008, "errors.noAvailableModelAskCount")
-        raise WebsocketInvalidAskException("errors.noAvailableModelAskCount")
-
-    # 判断是否能新建对话
-    async with get_async_session_context() as session:
-        conv_count = await session.execute(
-            select(func.count(BaseConversation.id)).filter(
-                and_(BaseConversation.user_id == user.id, BaseConversation.is_valid,
-                     BaseConversation.source == ask_request.source)))
-        conv_count = conv_count.scalar()
-
-    max_conv_count = source_setting.max_conv_count
-    if ask_request.new_conversation and max_conv_count != -1 and conv_count >= max_conv_count:
+    # 判断是否能新建对话；无限制时不需要查询对话数量
+    max_conv_count = source_limits.max_conv_count
+    if ask_request.new_conversation and max_conv_count != -1 and \
+            await user_limits_cache.get_conv_count(user.id, ask_request.source) >= max_conv_count:
         # await websocket.close(1008, "errors.maxConversationCountReached")
         raise WebsocketInvalidAskException("errors.maxConversationCountReached")
 
@@ -218,6 +197,25 @@ async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
                 config.openai_web.enable_uploading_multimodal_images is False:
             raise WebsocketInvalidAskException("errors.multimodalImagesNotAllowed")
 
+    # 对话次数判断，通过则预扣一次；放在最后，检查和预扣之间没有 await，并发提问不会超出次数
+    balance = quota_ledger.get_balance(user, ask_request.source)
+    model_ask_count = balance.models.get(ask_request.model, 0)
+    if balance.total != -1 and balance.total <= 0:
+        # await websocket.close(1008, "errors.noAvailableTotalAskCount")
+        raise WebsocketInvalidAskException("errors.noAvailableTotalAskCount")
+    if model_ask_count != -1 and model_ask_count <= 0:
+        # await websocket.close(1008, "errors.noAvailableModelAskCount")
+        raise WebsocketInvalidAskException("errors.noAvailableModelAskCount")
+    return quota_ledger.reserve(user, ask_request.source, ask_request.model)
+
+
+def get_ask_priority(user: UserReadAdmin, ask_request: AskRequest) -> int:
+    priority = user.setting.openai_web.ask_priority
+    if user.is_superuser:
+        priority += config.openai_web.ask_queue_superuser_priority
+    priority += config.openai_web.ask_queue_model_priorities.get(ask_request.model, 0)
+    return priority
+
 
 def check_message(msg: str):
     # 检查消息中的敏感信息
@@ -232,8 +230,19 @@ async def chat(websocket: WebSocket):
     利用 WebSocket 实时更新 ChatGPT 回复
     """
 
+    delta_encoder: AskResponseDeltaEncoder | None = None
+
+    async def send_response(response: AskResponse):
+        if delta_encoder is not None:
+            await websocket.send_json(delta_encoder.encode(response))
+        else:
+            await websocket.send_json(encode_ask_response(response))
+
+    # 合并短时间内的 message 帧，减少发送次数
+    coalescer = AskResponseCoalescer(send_response)
+
     async def reply(response: AskResponse):
-        await websocket.send_json(jsonable_encoder(response))
+        await coalescer.put(response)
 
     await websocket.accept()
     user_db = await websocket_auth(websocket)
@@ -246,7 +255,7 @@ async def chat(websocket: WebSocket):
 
     user = UserReadAdmin.from_orm(user_db)
 
-    if user.setting.openai_web_chat_status != OpenaiWebChatStatus.idling:
+    if chat_session_registry.get_status(user.id) != OpenaiWebChatStatus.idling:
         await websocket.close(1008, "errors.cannotConnectMoreThanOneClient")
         return
 
@@ -260,9 +269,12 @@ async def chat(websocket: WebSocket):
         await websocket.close(1007, "errors.invalidAskRequest")
         return
 
+    if ask_request.stream_mode == AskStreamMode.delta:
+        delta_encoder = AskResponseDeltaEncoder()
+
     # 检查限制
     try:
-        await check_limits(user, ask_request)
+        ask_count_reservation = await check_limits(user, ask_request)
     except WebsocketException as e:
         await reply(AskResponse(type=AskResponseType.error, tip=e.tip, error_detail=e.error_detail))
         await websocket.close(e.code, e.tip)
@@ -274,7 +286,11 @@ async def chat(websocket: WebSocket):
     if not ask_request.new_conversation:
         assert ask_request.conversation_id is not None
         conversation_id = ask_request.conversation_id
-        conversation = await _get_conversation_by_id(ask_request.conversation_id, user_db)
+        try:
+            conversation = await _get_conversation_by_id(ask_request.conversation_id, user_db)
+        except Exception:
+            quota_ledger.release(ask_count_reservation)
+            raise
 
     request_start_time = datetime.now()
 
@@ -287,32 +303,58 @@ async def chat(websocket: WebSocket):
     ask_start_time = None
     queueing_start_time = None
     queueing_end_time = None
+    ask_ticket = None
+    openai_web_account = None
 
     # 排队
     if ask_request.source == ChatSourceTypes.openai_web:
-        if openai_web_manager.is_busy():
-            await reply(AskResponse(
-                type=AskResponseType.queueing,
-                tip="tips.queueing"
-            ))
-        await change_user_chat_status(user.id, OpenaiWebChatStatus.queueing)
+        # 已有对话只能在其所属账号上继续；附件和图片通过 default 账号上传，因此也只能使用 default 账号
+        account_name = conversation.openai_web_account if conversation is not None else None
+        if account_name is None and (ask_request.openai_web_attachments or
+                                     ask_request.openai_web_multimodal_image_parts):
+            account_name = DEFAULT_ACCOUNT_NAME
+        chat_session_registry.set_status(user.id, OpenaiWebChatStatus.queueing)
         queueing_start_time = time.time()
-        await openai_web_manager.semaphore.acquire()
+        ask_ticket = openai_web_manager.enqueue_ask(user.id, account_name, user.setting.openai_web.queue_weight,
+                                                    get_ask_priority(user, ask_request))
+        try:
+            # 排队期间，排队位置变化时推送位置和预计等待时间
+            last_position = None
+            while ask_ticket.account is None:
+                position = openai_web_manager.get_queue_position(ask_ticket)
+                if position is not None and position != last_position:
+                    await reply(AskResponse(
+                        type=AskResponseType.queueing,
+                        tip="tips.queueing",
+                        queue_position=position,
+                        queue_estimated_wait=openai_web_manager.estimate_queue_wait(position)
+                    ))
+                    last_position = position
+                await ask_ticket.wait(config.openai_web.ask_queue_update_interval)
+        except Exception as e:
+            openai_web_manager.release_ask(ask_ticket)
+            chat_session_registry.set_status(user.id, OpenaiWebChatStatus.idling)
+            quota_ledger.release(ask_count_reservation)
+            logger.debug(f"{user.username} websocket disconnected while queueing: {e.__class__.__name__}")
+            return
         queueing_end_time = time.time()
+        openai_web_account = ask_ticket.account
         # 如果 websocket 关闭了，则直接退出
         if websocket.state == WebSocketState.DISCONNECTED:
-            await change_user_chat_status(user.id, OpenaiWebChatStatus.idling)
-            await openai_web_manager.semaphore.release()
+            chat_session_registry.set_status(user.id, OpenaiWebChatStatus.idling)
+            openai_web_manager.release_ask(ask_ticket)
+            quota_ledger.release(ask_count_reservation)
             logger.debug(f"{user.username} websocket disconnected while queueing")
             return
 
     # 在此之前应当没有任何副作用
     message = None
+    last_web_data = None
 
     try:
         # rev: 更改状态为 asking
         if ask_request.source == ChatSourceTypes.openai_web:
-            await change_user_chat_status(user.id, OpenaiWebChatStatus.asking)
+            chat_session_registry.set_status(user.id, OpenaiWebChatStatus.asking)
 
         await reply(AskResponse(
             type=AskResponseType.waiting,
@@ -337,12 +379,18 @@ async def chat(websocket: WebSocket):
                                       plugin_ids=ask_request.openai_web_plugin_ids,
                                       attachments=ask_request.openai_web_attachments,
                                       multimodal_image_parts=ask_request.openai_web_multimodal_image_parts,
+                                      account=openai_web_account,
                                       ):
             has_got_reply = True
 
             try:
                 if ask_request.source == ChatSourceTypes.openai_web:
-                    message = convert_revchatgpt_message(data)
+                    if config.ask_stream.raw_relay:
+                        # 只提取字段用于转发，完整的消息在结束后再构造
+                        last_web_data = data
+                        message_json = convert_revchatgpt_message_to_json(data)
+                    else:
+                        message = convert_revchatgpt_message(data)
                     if conversation_id is None:
                         conversation_id = data["conversation_id"]
                 else:
@@ -355,12 +403,21 @@ async def chat(websocket: WebSocket):
                 logger.warning(f"convert message error: {e}")
                 continue
 
-            await reply(AskResponse(
-                type=AskResponseType.message,
-                conversation_id=conversation_id,
-                message=message
-            ))
+            if config.ask_stream.raw_relay:
+                # 跳过 pydantic 校验
+                await reply(AskResponse.construct(
+                    type=AskResponseType.message,
+                    conversation_id=conversation_id,
+                    message=message_json if ask_request.source == ChatSourceTypes.openai_web else message
+                ))
+            else:
+                await reply(AskResponse(
+                    type=AskResponseType.message,
+                    conversation_id=conversation_id,
+                    message=message
+                ))
 
+        await coalescer.flush()
         is_completed = True
     except ConnectionClosed as e:
         websocket_code = e.code
@@ -417,8 +474,16 @@ async def chat(websocket: WebSocket):
 
     finally:
         if ask_request.source == ChatSourceTypes.openai_web:
-            openai_web_manager.semaphore.release()
-            await change_user_chat_status(user.id, OpenaiWebChatStatus.idling)
+            openai_web_manager.release_ask(ask_ticket)
+            chat_session_registry.set_status(user.id, OpenaiWebChatStatus.idling)
+        # 得到回复才扣除对话次数；放在 finally 中，以免发送错误信息时抛出的异常导致预扣的次数无法结算
+        if has_got_reply:
+            quota_ledger.commit(ask_count_reservation)
+        else:
+            quota_ledger.release(ask_count_reservation)
+
+    if last_web_data is not None:
+        message = convert_revchatgpt_message(last_web_data)
 
     ask_stop_time = time.time()
     queueing_time = 0
@@ -471,6 +536,10 @@ async def chat(websocket: WebSocket):
                 content=content
             )
 
+            # 保存消息的 token 数，之后组装上下文时不再计算
+            count_message_tokens(ask_message, OpenaiApiChatModels(ask_request.model))
+            count_message_tokens(message, OpenaiApiChatModels(ask_request.model))
+
             # 对于api新对话，添加历史记录到mongodb
             if ask_request.new_conversation:
                 new_conv_history = OpenaiApiConversationHistoryDocument(
@@ -487,25 +556,19 @@ async def chat(websocket: WebSocket):
                     current_model=message.model
                 )
 
-                await new_conv_history.save()
+                await conversation_history.create_conversation_history(new_conv_history)
+                conversation_history.ConversationThreadCache().put(
+                    conversation_id, [ask_message, message], MAX_CONTEXT_MESSAGE_COUNT + 1)
                 logger.debug(f"saved new api conversation history {conversation_id} to mongodb")
             else:
-                # 更新mongodb历史记录
-                conv_history = await OpenaiApiConversationHistoryDocument.get(conversation_id)
-                assert conv_history is not None, f"update api: conversation history {conversation_id} is None"
-                conv_history.update_time = datetime.now().astimezone(tz=timezone.utc)
-
-                conv_history.mapping[str(ask_message.id)] = ask_message
-                conv_history.mapping[str(message.id)] = message
-                conv_history.current_node = str(message.id)
-                conv_history.current_model = message.model
-
-                if ask_message.parent is not None:
-                    parent_message = conv_history.mapping.get(str(ask_message.parent))
-                    assert parent_message is not None, f"update api: parent message {ask_message.parent} is None"
-                    parent_message.children.append(message.id)
-                    conv_history.mapping[str(ask_message.parent)] = parent_message
-                await conv_history.save()
+                # 更新mongodb历史记录：只写入新增的两条消息和父消息的 children，不重写整个文档
+                is_updated = await conversation_history.add_messages(
+                    ChatSourceTypes.openai_api, conversation_id, [ask_message, message],
+                    current_model=message.model, update_time=datetime.now().astimezone(tz=timezone.utc))
+                assert is_updated, \
+                    f"update api: conversation history {conversation_id} or parent message {ask_message.parent} is None"
+                # 下一次提问可直接使用缓存的分支组装上下文，不需要再读取历史记录
+                conversation_history.ConversationThreadCache().append(conversation_id, [ask_message, message])
 
                 logger.debug(f"updated api conversation history {conversation_id} to mongodb")
 
@@ -520,7 +583,8 @@ async def chat(websocket: WebSocket):
                 if ask_request.source == ChatSourceTypes.openai_web and ask_request.new_title is not None and \
                         ask_request.new_title.strip() != "":
                     try:
-                        await openai_web_manager.set_conversation_title(str(conversation_id), ask_request.new_title)
+                        await openai_web_manager.set_conversation_title(str(conversation_id), ask_request.new_title,
+                                                                        account_name=openai_web_account.name)
                     except Exception as e:
                         logger.warning(f"set_conversation_title error {e.__class__.__name__}: {str(e)}")
 
@@ -536,7 +600,10 @@ async def chat(websocket: WebSocket):
                     update_time=current_time
                 )
                 conversation = BaseConversation(**new_conv.dict(exclude_unset=True))
+                if ask_request.source == ChatSourceTypes.openai_web:
+                    conversation.openai_web_account = openai_web_account.name
                 session.add(conversation)
+                user_limits_cache.on_conversation_created(user.id, ask_request.source)
 
             else:
                 conversation = await session.get(BaseConversation, conversation.id)
@@ -546,26 +613,6 @@ async def chat(websocket: WebSocket):
                     conversation.current_model = ask_request.model
                 session.add(conversation)
 
-            # 扣除对话次数
-            source_setting = user.setting.openai_web if ask_request.source == ChatSourceTypes.openai_web else user.setting.openai_api
-
-            total_ask_count = source_setting.total_ask_count
-            model_ask_count = source_setting.per_model_ask_count.__root__.get(ask_request.model, -1)
-            assert model_ask_count, "model_ask_count is None"
-            if total_ask_count != -1 or model_ask_count != -1:
-
-                if total_ask_count != -1:
-                    assert total_ask_count > 0
-                    source_setting.total_ask_count -= 1
-                if model_ask_count != -1:
-                    assert model_ask_count > 0
-                    source_setting.per_model_ask_count.__root__[ask_request.model] = model_ask_count - 1
-
-                user_db = await session.get(User, user.id)
-                setattr(user_db.setting, ask_request.source, source_setting)
-
-                session.add(user_db.setting)
-
             await session.commit()
 
             if ask_request.source == ChatSourceTypes.openai_web:
@@ -581,6 +628,11 @@ async def chat(websocket: WebSocket):
                 ask_time=ask_time,
             ).create()
 
+        # 对话次数已在 quota_ledger 中扣除，未设置定期写入时立即写入数据库
+        if config.common.ask_count_flush_interval <= 0:
+            await quota_ledger.flush()
+
+    coalescer.close()
     websocket.scope["ask_websocket_close_code"] = websocket_code
     websocket.scope["ask_websocket_close_reason"] = websocket_reason
     await websocket.close(websocket_code, websocket_reason)
@@ -2,10 +2,11 @@ import uuid
 from typing import List, Union
 
 import httpx
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy import select, and_, delete
 
+from api import conversation_history
 from api.database.sqlalchemy import get_async_session_context
 from api.enums import ChatSourceTypes
 from api.exceptions import InvalidParamsException, AuthorityDenyException, InternalException, OpenaiWebException
@@ -13,15 +14,18 @@ from api.models.db import User, OpenaiWebConversation, BaseConversation
 from api.models.doc import OpenaiApiConversationHistoryDocument, OpenaiWebConversationHistoryDocument, \
     BaseConversationHistory
 from api.response import response
-from api.schemas import OpenaiWebConversationSchema, BaseConversationSchema, OpenaiApiConversationSchema
+from api.schemas import OpenaiWebConversationSchema, BaseConversationSchema, OpenaiApiConversationSchema, \
+    ConversationThreadSchema
 from api.schemas.openai_schemas import OpenaiChatInterpreterInfo
 from api.sources import OpenaiWebChatManager
+from api.user_limits import UserLimitsCache
 from api.users import current_active_user, current_super_user
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 router = APIRouter()
 openai_web_manager = OpenaiWebChatManager()
+user_limits_cache = UserLimitsCache()
 
 
 async def _get_conversation_by_id(conversation_id: str | uuid.UUID, user: User = Depends(current_active_user)):
@@ -36,6 +40,13 @@ async def _get_conversation_by_id(conversation_id: str | uuid.UUID, user: User =
         return conversation
 
 
+async def _get_openai_web_account_name(conversation_id: str | uuid.UUID) -> str | None:
+    async with get_async_session_context() as session:
+        r = await session.execute(
+            select(BaseConversation.openai_web_account).where(BaseConversation.conversation_id == str(conversation_id)))
+        return r.scalars().first()
+
+
 @router.get("/conv", tags=["conversation"],
             response_model=List[
                 Union[BaseConversationSchema, OpenaiWebConversationSchema, OpenaiApiConversationSchema]])
@@ -65,50 +76,127 @@ async def get_all_conversations(_user: User = Depends(current_super_user), valid
         return results
 
 
+async def _get_openai_web_conversation_history(conversation: BaseConversation, with_mapping: bool = True):
+    try:
+        result = await openai_web_manager.get_cached_conversation_history(
+            conversation.conversation_id, account_name=conversation.openai_web_account,
+            updated_at=conversation.update_time, with_mapping=with_mapping)
+        if result.current_model != conversation.current_model or not conversation.is_valid:
+            async with get_async_session_context() as session:
+                conversation = await session.get(BaseConversation, conversation.id)
+                conversation.current_model = result.current_model
+                conversation.is_valid = True
+                await session.commit()
+            user_limits_cache.invalidate_conv_count(conversation.user_id)
+        return result
+    except httpx.TimeoutException as e:
+        logger.warning(
+            f"{conversation.conversation_id} get conversation history timeout: {e.__class__.__name__}")
+        raise InternalException("errors.timeout")
+    except OpenaiWebException as e:
+        if e.code == 404:
+            if conversation.is_valid:
+                async with get_async_session_context() as session:
+                    conversation = await session.get(BaseConversation, conversation.id)
+                    conversation.is_valid = False
+                    await session.commit()
+                user_limits_cache.invalidate_conv_count(conversation.user_id)
+        raise e
+    except Exception as e:
+        logger.warning(
+            f"{conversation.conversation_id} get conversation history failed: {e.__class__.__name__} {e}")
+        raise e
+
+
 @router.get("/conv/{conversation_id}", tags=["conversation"],
             response_model=OpenaiApiConversationHistoryDocument | OpenaiWebConversationHistoryDocument | BaseConversationHistory)
 async def get_conversation_history(conversation: BaseConversation = Depends(_get_conversation_by_id)):
     if conversation.source == ChatSourceTypes.openai_web:
-        try:
-            result = await openai_web_manager.get_conversation_history(conversation.conversation_id)
-            if result.current_model != conversation.current_model or not conversation.is_valid:
-                async with get_async_session_context() as session:
-                    conversation = await session.get(BaseConversation, conversation.id)
-                    conversation.current_model = result.current_model
-                    conversation.is_valid = True
-                    await session.commit()
-            return result
-        except httpx.TimeoutException as e:
-            logger.warning(
-                f"{conversation.conversation_id} get conversation history timeout: {e.__class__.__name__}")
-            raise InternalException("errors.timeout")
-        except OpenaiWebException as e:
-            if e.code == 404:
-                if conversation.is_valid:
-                    async with get_async_session_context() as session:
-                        conversation = await session.get(BaseConversation, conversation.id)
-                        conversation.is_valid = False
-                        await session.commit()
-            raise e
-        except Exception as e:
-            logger.warning(
-                f"{conversation.conversation_id} get conversation history failed: {e.__class__.__name__} {e}")
-            raise e
+        return await _get_openai_web_conversation_history(conversation)
     else:
-        doc = await OpenaiApiConversationHistoryDocument.get(conversation.conversation_id)
+        doc = await conversation_history.get_conversation_history(ChatSourceTypes.openai_api,
+                                                                  conversation.conversation_id)
         if doc is None:
             raise InvalidParamsException("errors.conversationNotFound")
         return doc
 
 
+@router.get("/conv/{conversation_id}/thread", tags=["conversation"], response_model=ConversationThreadSchema)
+async def get_conversation_thread(node_id: uuid.UUID = None, before: uuid.UUID = None,
+                                  limit: int = Query(50, ge=1, le=500),
+                                  conversation: BaseConversation = Depends(_get_conversation_by_id)):
+    """
+    返回一个分支（从根节点到 node_id，默认为 current_node）上最新的 limit 条消息
+    before 为上一页返回的 cursor，用于继续向前翻页
+    """
+    # 第一页检查 ChatGPT 对话的缓存是否过期，之后的页直接读取缓存
+    doc = None
+    if conversation.source == ChatSourceTypes.openai_web and before is None:
+        doc = await _get_openai_web_conversation_history(conversation, with_mapping=False)
+
+    # 多取一条用于判断是否还有更早的消息；翻页时多取的 before 本身会被去掉
+    end_node = before or node_id
+    count = limit + 1 + (1 if before else 0)
+    if doc is not None and doc.mapping:
+        messages = conversation_history.get_branch_from_mapping(doc.mapping, end_node or doc.current_node, count)
+    else:
+        doc, messages = await conversation_history.load_branch(conversation.source, conversation.conversation_id,
+                                                               node_id=end_node, limit=count)
+    if doc is None:
+        raise InvalidParamsException("errors.conversationNotFound")
+    if before is not None:
+        if not messages or messages[-1].id != before:
+            raise InvalidParamsException(f"Message {before} not found")
+        messages = messages[:-1]
+    has_more = len(messages) > limit
+    messages = messages[-limit:]
+    return ConversationThreadSchema(
+        conversation_id=conversation.conversation_id,
+        source=conversation.source,
+        title=doc.title,
+        current_node=doc.current_node,
+        current_model=doc.current_model,
+        messages=messages,
+        has_more=has_more,
+        cursor=messages[0].id if messages else None,
+    )
+
+
+@router.get("/conv/{conversation_id}/branch", tags=["conversation"], response_model=ConversationThreadSchema)
+async def get_conversation_branch(node_id: uuid.UUID, limit: int = Query(50, ge=1, le=500),
+                                  conversation: BaseConversation = Depends(_get_conversation_by_id)):
+    """
+    切换分支：返回从 node_id 开始，沿最新的子消息直到叶子节点的消息
+    客户端已有 node_id 之前的消息；更早的消息可用 cursor 通过 thread 接口获取
+    """
+    doc = await conversation_history.get_conversation_history(conversation.source, conversation.conversation_id,
+                                                              with_mapping=False)
+    if doc is None:
+        raise InvalidParamsException("errors.conversationNotFound")
+    messages = await conversation_history.load_descendants(conversation.source, conversation.conversation_id,
+                                                           node_id, limit + 1, doc=doc)
+    if not messages:
+        raise InvalidParamsException(f"Message {node_id} not found")
+    next_node = messages[limit].id if len(messages) > limit else None
+    messages = messages[:limit]
+    return ConversationThreadSchema(
+        conversation_id=conversation.conversation_id,
+        source=conversation.source,
+        title=doc.title,
+        current_node=doc.current_node,
+        current_model=doc.current_model,
+        messages=messages,
+        has_more=messages[0].parent is not None,
+        cursor=messages[0].id,
+        next_node=next_node,
+    )
+
+
 @router.get("/conv/{conversation_id}/cache", tags=["conversation"],
             response_model=OpenaiApiConversationHistoryDocument | OpenaiWebConversationHistoryDocument | BaseConversationHistory)
 async def get_conversation_history_from_cache(conversation_id, user: User = Depends(current_super_user)):
     conversation = await _get_conversation_by_id(conversation_id, user=user)
-    if conversation.source == ChatSourceTypes.openai_web:
-        doc = await OpenaiWebConversationHistoryDocument.get(conversation.conversation_id)
-    else:
-        doc = await OpenaiApiConversationHistoryDocument.get(conversation.conversation_id)
+    doc = await conversation_history.get_conversation_history(conversation.source, conversation.conversation_id)
     if doc is None:
         raise InvalidParamsException("errors.conversationNotFound")
     return doc
@@ -123,7 +211,8 @@ async def delete_conversation(conversation: BaseConversation = Depends(_get_conv
         raise InvalidParamsException("errors.conversationAlreadyDeleted")
     if conversation.source == ChatSourceTypes.openai_web:
         try:
-            await openai_web_manager.delete_conversation(conversation.conversation_id)
+            await openai_web_manager.delete_conversation(conversation.conversation_id,
+                                                         account_name=conversation.openai_web_account)
         except OpenaiWebException as e:
             logger.warning(f"delete conversation {conversation.conversation_id} failed: {e.code} {e.message}")
         except httpx.HTTPStatusError as e:
@@ -133,6 +222,7 @@ async def delete_conversation(conversation: BaseConversation = Depends(_get_conv
         conversation.is_valid = False
         session.add(conversation)
         await session.commit()
+    user_limits_cache.invalidate_conv_count(conversation.user_id)
     return response(200)
 
 
@@ -144,12 +234,7 @@ async def vanish_conversation(conversation: BaseConversation = Depends(_get_conv
     """
     if conversation.is_valid:
         await delete_conversation(conversation)
-    if conversation.source == ChatSourceTypes.openai_web:
-        doc = await OpenaiWebConversationHistoryDocument.get(conversation.conversation_id)
-    else:  # api
-        doc = await OpenaiApiConversationHistoryDocument.get(conversation.conversation_id)
-    if doc is not None:
-        await doc.delete()
+    await conversation_history.delete_conversation_history(conversation.source, conversation.conversation_id)
     async with get_async_session_context() as session:
         await session.execute(
             delete(BaseConversation).where(BaseConversation.conversation_id == conversation.conversation_id))
@@ -161,13 +246,13 @@ async def vanish_conversation(conversation: BaseConversation = Depends(_get_conv
 async def update_conversation_title(title: str, conversation: BaseConversation = Depends(_get_conversation_by_id)):
     if conversation.source == ChatSourceTypes.openai_web:
         await openai_web_manager.set_conversation_title(conversation.conversation_id,
-                                                        title)
+                                                        title, account_name=conversation.openai_web_account)
     else:  # api
-        doc = await OpenaiApiConversationHistoryDocument.get(conversation.conversation_id)
-        if doc is None:
+        result = await OpenaiApiConversationHistoryDocument.find_one(
+            OpenaiApiConversationHistoryDocument.id == conversation.conversation_id
+        ).update({"$set": {"title": title}})
+        if result.matched_count == 0:
             raise InvalidParamsException("errors.conversationNotFound")
-        doc.title = title
-        await doc.save()
     async with get_async_session_context() as session:
         conversation.title = title
         session.add(conversation)
@@ -185,9 +270,12 @@ async def assign_conversation(username: str, conversation: BaseConversation = De
         user = user.scalars().one_or_none()
         if user is None:
             raise InvalidParamsException("errors.userNotFound")
+        previous_user_id = conversation.user_id
         conversation.user_id = user.id
         session.add(conversation)
         await session.commit()
+    user_limits_cache.invalidate_conv_count(previous_user_id)
+    user_limits_cache.invalidate_conv_count(user.id)
     return response(200)
 
 
@@ -197,6 +285,7 @@ async def delete_all_conversation(_user: User = Depends(current_super_user)):
     async with get_async_session_context() as session:
         await session.execute(delete(OpenaiWebConversation))
         await session.commit()
+    user_limits_cache.invalidate_conv_count()
     return response(200)
 
 
@@ -204,7 +293,8 @@ async def delete_all_conversation(_user: User = Depends(current_super_user)):
 async def generate_conversation_title(message_id: str,
                                       conversation: OpenaiWebConversation = Depends(_get_conversation_by_id)):
     async with get_async_session_context() as session:
-        title = await openai_web_manager.generate_conversation_title(conversation.conversation_id, message_id)
+        title = await openai_web_manager.generate_conversation_title(conversation.conversation_id, message_id,
+                                                                     account_name=conversation.openai_web_account)
         if title:
             conversation.title = title
             session.add(conversation)
@@ -217,7 +307,8 @@ async def generate_conversation_title(message_id: str,
 
 @router.get("/conv/{conversation_id}/interpreter", tags=["conversation"], response_model=OpenaiChatInterpreterInfo)
 async def get_conversation_interpreter_info(conversation_id: str):
-    url = await openai_web_manager.get_interpreter_info(conversation_id)
+    account_name = await _get_openai_web_account_name(conversation_id)
+    url = await openai_web_manager.get_interpreter_info(conversation_id, account_name=account_name)
     return response(200, result=url)
 
 
@@ -225,5 +316,7 @@ async def get_conversation_interpreter_info(conversation_id: str):
 async def get_conversation_interpreter_download_url(conversation_id: str, message_id: str, sandbox_path: str):
     if message_id is None or sandbox_path is None:
         raise InvalidParamsException("message_id and sandbox_path are required")
-    url = await openai_web_manager.get_interpreter_file_download_url(conversation_id, message_id, sandbox_path)
+    account_name = await _get_openai_web_account_name(conversation_id)
+    url = await openai_web_manager.get_interpreter_file_download_url(conversation_id, message_id, sandbox_path,
+                                                                     account_name=account_name)
     return response(200, result=url)
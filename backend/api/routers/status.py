@@ -24,7 +24,7 @@ async def get_server_status(_user: User = Depends(current_active_user)):
         result = await count_active_users()
     else:
         result = await count_active_users_cached()
-    active_user_in_5m, active_user_in_1h, active_user_in_1d, queueing_count, _ = result
+    active_user_in_5m, active_user_in_1h, active_user_in_1d, _, _ = result
     pipeline = [
         {
             '$facet': {
@@ -60,12 +60,17 @@ async def get_server_status(_user: User = Depends(current_active_user)):
     aggregate_result = await AskLogDocument.aggregate(pipeline).to_list(length=1)
     gpt4_count_in_3_hours = aggregate_result[0].get('total')
 
+    queue_wait_p50, queue_wait_p90, queue_wait_p99 = openai_web_manager.get_queue_wait_percentiles()
+
     result = CommonStatusSchema(
         active_user_in_5m=active_user_in_5m,
         active_user_in_1h=active_user_in_1h,
         active_user_in_1d=active_user_in_1d,
         is_chatbot_busy=openai_web_manager.is_busy(),
-        chatbot_waiting_count=queueing_count,
+        chatbot_waiting_count=openai_web_manager.get_queue_length(),
+        queue_wait_p50=queue_wait_p50,
+        queue_wait_p90=queue_wait_p90,
+        queue_wait_p99=queue_wait_p99,
         gpt4_count_in_3_hours=gpt4_count_in_3_hours
     )
     return result
@@ -10,6 +10,7 @@ from sqlalchemy import select
 
 import api.enums
 import api.globals as g
+from api.chat_session import ChatSessionRegistry
 from api.conf import Config, Credentials
 from api.conf.config import ConfigModel
 from api.conf.credentials import CredentialsModel
@@ -19,8 +20,9 @@ from api.exceptions import InvalidParamsException, OpenaiWebException
 from api.models.db import User, OpenaiWebConversation
 from api.models.doc import RequestLogDocument, AskLogDocument
 from api.schemas import LogFilterOptions, SystemInfo, UserCreate, UserSettingSchema, OpenaiWebSourceSettingSchema, \
-    OpenaiApiSourceSettingSchema, RequestLogAggregation, AskLogAggregation
-from api.sources import OpenaiWebChatManager, OpenaiApiChatManager
+    OpenaiApiSourceSettingSchema, RequestLogAggregation, AskLogAggregation, OpenaiWebAccountInfo, \
+    OpenaiApiKeyInfo, OpenaiApiResponseCacheInfo
+from api.sources import OpenaiWebChatManager, OpenaiApiChatManager, OpenaiApiResponseCache
 from api.users import current_super_user, get_user_manager_context
 from utils.admin import sync_conversations
 from utils.logger import get_logger
@@ -36,7 +38,7 @@ async def count_active_users():
     async with get_async_session_context() as session:
         users = await session.execute(select(User))
         users = users.scalars().all()
-    queueing_count = 0
+    queueing_count = ChatSessionRegistry().count(OpenaiWebChatStatus.queueing)
     active_user_in_5m = 0
     active_user_in_1h = 0
     active_user_in_1d = 0
@@ -44,8 +46,6 @@ async def count_active_users():
     for user in users:
         if not user.last_active_time:
             continue
-        if user.setting.openai_web_chat_status == OpenaiWebChatStatus.queueing:
-            queueing_count += 1
         if user.is_superuser:  # 管理员不计入在线人数
             continue
         if user.last_active_time > current_time - timedelta(minutes=5):
@@ -78,6 +78,65 @@ async def get_system_info(_user: User = Depends(current_super_user)):
     return result
 
 
+@router.get("/system/openai-web-accounts", tags=["system"], response_model=list[OpenaiWebAccountInfo])
+async def get_openai_web_accounts(_user: User = Depends(current_super_user)):
+    openai_web_manager = OpenaiWebChatManager()
+    return [OpenaiWebAccountInfo(
+        name=account.name,
+        max_concurrency=account.max_concurrency,
+        active_count=account.active_count,
+        is_healthy=account.is_healthy(),
+        unhealthy_until=account.unhealthy_until,
+        last_error=account.last_error,
+        connection_pool=account.get_connection_pool_stats(),
+    ) for account in openai_web_manager.accounts.values()]
+
+
+@router.get("/system/openai-api-keys", tags=["system"], response_model=list[OpenaiApiKeyInfo])
+async def get_openai_api_keys(_user: User = Depends(current_super_user)):
+    openai_api_manager = OpenaiApiChatManager()
+    return [OpenaiApiKeyInfo(
+        name=key.name,
+        max_concurrency=key.max_concurrency,
+        active_count=key.active_count,
+        rpm=key.get_rpm(),
+        rpm_limit=key.rpm_limit,
+        tpm=key.get_tpm(),
+        tpm_limit=key.tpm_limit,
+        cooldown_until=key.cooldown_until if key.is_cooling_down() else None,
+        last_error=key.last_error,
+    ) for key in openai_api_manager.keys.values()]
+
+
+def _get_openai_api_response_cache_info() -> OpenaiApiResponseCacheInfo:
+    response_cache = OpenaiApiResponseCache()
+    return OpenaiApiResponseCacheInfo(
+        enabled=config.openai_api.response_cache,
+        size=response_cache.get_size(),
+        max_size=config.openai_api.response_cache_size,
+        ttl=config.openai_api.response_cache_ttl,
+        hits=response_cache.hits,
+        misses=response_cache.misses,
+        evictions=response_cache.evictions,
+        hit_rate=response_cache.get_hit_rate(),
+    )
+
+
+@router.get("/system/openai-api-response-cache", tags=["system"], response_model=OpenaiApiResponseCacheInfo)
+async def get_openai_api_response_cache(_user: User = Depends(current_super_user)):
+    return _get_openai_api_response_cache_info()
+
+
+@router.post("/system/action/clear-openai-api-response-cache", tags=["system"],
+             response_model=OpenaiApiResponseCacheInfo)
+async def clear_openai_api_response_cache(_user: User = Depends(current_super_user)):
+    """
+    清空缓存的回复并重置命中统计
+    """
+    OpenaiApiResponseCache().clear()
+    return _get_openai_api_response_cache_info()
+
+
 FAKE_REQ_START_TIMESTAMP = 1672502400  # 2023-01-01 00:00:00
 
 
@@ -268,8 +327,11 @@ async def update_credentials(credentials_model: CredentialsModel, _user: User =
 
 
 @router.post("/system/action/sync-openai-web-conv", tags=["system"])
-async def sync_openai_web_conversations(_user: User = Depends(current_super_user)):
-    exception = await sync_conversations()
+async def sync_openai_web_conversations(full: bool = False, _user: User = Depends(current_super_user)):
+    """
+    full 为 True 时进行全量同步，会将 ChatGPT 中已删除的对话标记为无效
+    """
+    exception = await sync_conversations(full=full)
     if exception:
         if isinstance(exception, httpx.ConnectError):
             raise OpenaiWebException("Failed to connect to ChatGPT server. Did you set the correct chatgpt_base_url?")
@@ -13,6 +13,8 @@ from api.exceptions import UserNotExistException, AuthenticationFailedException
 from api.models.db import User
 from api.response import response
 from api.schemas import UserRead, UserUpdate, UserCreate, UserUpdateAdmin, UserReadAdmin, UserSettingSchema
+from api.quota_ledger import QuotaLedger
+from api.user_limits import UserLimitsCache
 from api.users import auth_backend, fastapi_users, current_active_user, get_user_manager_context, current_super_user, \
     get_user_manager, UserManager
 
@@ -92,6 +94,7 @@ async def get_all_users(_user: User = Depends(current_super_user)):
 @router.get("/user/me", response_model=UserRead, tags=["user"])
 async def get_me(user: User = Depends(current_active_user)):
     user_read = UserRead.from_orm(user)
+    QuotaLedger().apply_to(user.id, user_read.setting)
     for source in ["openai_api", "openai_web"]:
         source_setting = getattr(user_read.setting, source)
         global_enabled_models = getattr(config, source).enabled_models
@@ -135,6 +138,7 @@ async def admin_get_user(user_id: int, _user: User = Depends(current_super_user)
         if user is None:
             raise UserNotExistException()
         result = UserRead.from_orm(user)
+        QuotaLedger().apply_to(user_id, result.setting)
         return result
 
 
@@ -153,17 +157,19 @@ async def admin_update_user(user_update_admin: UserUpdateAdmin, request: Request
 
 @router.delete("/user/{user_id}", tags=["user"])
 async def admin_delete_user(user_id: int, _user: User = Depends(current_super_user)):
-    async with get_async_session_context() as session:
+    async with QuotaLedger().resetting_user(user_id), get_async_session_context() as session:
         user = await session.get(User, user_id)
         await session.delete(user)
         await session.commit()
+        UserLimitsCache().invalidate_user(user_id)
         return None
 
 
 @router.patch("/user/{user_id}/setting", response_model=UserReadAdmin, tags=["user"])
 async def admin_update_user_setting(user_id: int, user_setting: UserSettingSchema,
                                     _user: User = Depends(current_super_user)):
-    async with get_async_session_context() as session:
+    # 先写入该用户未写入的扣除量，再以管理员的设置为准
+    async with QuotaLedger().resetting_user(user_id), get_async_session_context() as session:
         user = await session.get(User, user_id)
         if user is None:
             raise UserNotExistException()
@@ -171,4 +177,5 @@ async def admin_update_user_setting(user_id: int, user_setting: UserSettingSchem
             setattr(user.setting, key, value)
         await session.commit()
         await session.refresh(user)
+        UserLimitsCache().invalidate_user(user_id)
         return UserReadAdmin.from_orm(user)
@@ -1,3 +1,4 @@
 from .system_schemas import *
 from .user_schemas import *
 from .conversation_schemas import *
+from .batch_ask_schemas import *
@@ -0,0 +1,44 @@
+import datetime
+import uuid
+from typing import Optional, Any
+
+from pydantic import BaseModel, Field, validator
+
+from api.enums import OpenaiApiChatModels, BatchAskJobStatus
+
+
+class BatchAskJobCreate(BaseModel):
+    title: Optional[str]
+    model: OpenaiApiChatModels
+    prompts: list[str] = Field(..., min_items=1)
+    extra_args: Optional[dict[str, Any]]
+    concurrency: Optional[int] = Field(None, ge=1)  # 为空时使用 openai_api.batch_ask_max_concurrency
+    save_conversations: bool = False  # 是否将每个 prompt 及回复保存为一个对话
+
+    @validator("prompts")
+    def check_prompts(cls, v):
+        if any(not prompt.strip() for prompt in v):
+            raise ValueError("prompt should not be empty")
+        return v
+
+
+class BatchAskJobSchema(BaseModel):
+    """
+    不包含 items 的任务概况，用于列表和进度查询
+    """
+    id: uuid.UUID = Field(alias="_id")
+    user_id: int
+    title: Optional[str]
+    model: OpenaiApiChatModels
+    concurrency: int
+    save_conversations: bool
+    status: BatchAskJobStatus
+    total_count: int
+    succeeded_count: int
+    failed_count: int
+    create_time: datetime.datetime
+    update_time: datetime.datetime
+    finish_time: Optional[datetime.datetime]
+
+    class Config:
+        allow_population_by_field_name = True
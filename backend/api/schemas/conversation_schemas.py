@@ -1,7 +1,7 @@
 import datetime
 import uuid
 from enum import auto
-from typing import Literal, Optional, Annotated, Union
+from typing import Literal, Optional, Annotated, Union, Any
 
 from pydantic import BaseModel, root_validator, validator, Field
 from strenum import StrEnum
@@ -26,6 +26,11 @@ def _validate_model(_source: ChatSourceTypes, model: str | None):
         logger.warning(f"unknown model: {model} for type {_source}")
 
 
+class AskStreamMode(StrEnum):
+    full = auto()  # 每一帧都是完整消息
+    delta = auto()  # 只发送变化的部分，并定期发送完整消息
+
+
 class AskRequest(BaseModel):
     source: ChatSourceTypes
     model: str
@@ -38,6 +43,7 @@ class AskRequest(BaseModel):
     openai_web_plugin_ids: Optional[list[str]] = None
     openai_web_attachments: Optional[list[OpenaiWebAskAttachment]] = None
     openai_web_multimodal_image_parts: Optional[list[OpenaiWebChatMessageMultimodalTextContentImagePart]] = None
+    stream_mode: AskStreamMode = AskStreamMode.full
 
     @root_validator
     def check(cls, values):
@@ -55,16 +61,47 @@ class AskResponseType(StrEnum):
     waiting = auto()
     queueing = auto()
     message = auto()
+    message_delta = auto()
     error = auto()
 
 
+class AskResponseMessageDeltaOperation(BaseModel):
+    op: Literal['append', 'set', 'remove']  # append: 字符串追加，或在列表末尾追加元素
+    path: list[str | int]  # 相对于 message 的路径，例如 ["content", "parts", 0]
+    value: Optional[Any] = None
+
+
+class AskResponseMessageDelta(BaseModel):
+    message_id: uuid.UUID
+    ops: list[AskResponseMessageDeltaOperation]
+
+
 class AskResponse(BaseModel):
     type: AskResponseType
     tip: str = None
     conversation_id: uuid.UUID = None
     message: Optional[
         Annotated[Union[OpenaiWebChatMessage, OpenaiApiChatMessage], Field(discriminator='source')]] = None
+    message_delta: AskResponseMessageDelta = None  # 仅 message_delta 类型，应用于 seq - 1 帧的消息
+    seq: int = None  # 仅增量模式下的 message 和 message_delta 类型
     error_detail: str = None
+    queue_position: int = None  # 仅 queueing 类型
+    queue_estimated_wait: float = None  # 仅 queueing 类型，预计排队时间（秒）
+
+
+class ConversationThreadSchema(BaseModel):
+    """
+    当前分支上的一段消息，按从旧到新排列
+    """
+    conversation_id: uuid.UUID
+    source: ChatSourceTypes
+    title: Optional[str]
+    current_node: Optional[uuid.UUID]
+    current_model: Optional[str]
+    messages: list[Annotated[Union[OpenaiWebChatMessage, OpenaiApiChatMessage], Field(discriminator='source')]]
+    has_more: bool = False  # 是否还有更早的消息
+    cursor: Optional[uuid.UUID]  # 本页最早一条消息的 id，作为 before 参数获取上一页
+    next_node: Optional[uuid.UUID]  # 仅切换分支时：因 limit 未返回的下一条消息 id，以其为 node_id 继续获取
 
 
 class BaseConversationSchema(BaseModel):
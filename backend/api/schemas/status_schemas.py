@@ -7,4 +7,7 @@ class CommonStatusSchema(BaseModel):
     active_user_in_1d: int = None
     is_chatbot_busy: bool = None
     chatbot_waiting_count: int = None
+    queue_wait_p50: float = None
+    queue_wait_p90: float = None
+    queue_wait_p99: float = None
     gpt4_count_in_3_hours: int = None
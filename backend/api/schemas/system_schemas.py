@@ -13,6 +13,39 @@ class SystemInfo(BaseModel):
     valid_conversation_count: int
 
 
+class OpenaiWebAccountInfo(BaseModel):
+    name: str
+    max_concurrency: int
+    active_count: int
+    is_healthy: bool
+    unhealthy_until: Optional[float]
+    last_error: Optional[str]
+    connection_pool: dict[str, int]  # connections, idle_connections, http2_connections, request_count
+
+
+class OpenaiApiKeyInfo(BaseModel):
+    name: str
+    max_concurrency: int
+    active_count: int
+    rpm: int
+    rpm_limit: Optional[int]
+    tpm: int
+    tpm_limit: Optional[int]
+    cooldown_until: Optional[float]
+    last_error: Optional[str]
+
+
+class OpenaiApiResponseCacheInfo(BaseModel):
+    enabled: bool
+    size: int
+    max_size: int
+    ttl: int
+    hits: int
+    misses: int
+    evictions: int
+    hit_rate: Optional[float]
+
+
 class LogFilterOptions(BaseModel):
     max_lines: int = 100
     exclude_keywords: list[str] = None
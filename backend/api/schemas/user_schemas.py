@@ -2,7 +2,7 @@ import datetime
 from typing import Optional
 
 from fastapi_users import schemas
-from pydantic import BaseModel, EmailStr, validator, root_validator
+from pydantic import BaseModel, EmailStr, validator, root_validator, Field
 
 from api.conf import Config
 from api.enums import OpenaiWebChatStatus, OpenaiWebChatModels, OpenaiApiChatModels
@@ -50,6 +50,8 @@ class OpenaiWebSourceSettingSchema(BaseSourceSettingSchema):
     per_model_ask_count: OpenaiWebPerModelAskCount
     allow_uploading_attachments: bool
     allow_uploading_multimodal_images: bool
+    queue_weight: float = Field(1, gt=0)  # 仅在 ask_queue_policy 为 weighted 时生效，越大排队越靠前
+    ask_priority: int = 0  # 排队优先级，例如付费用户可以设置更高的优先级
 
     @staticmethod
     def default():
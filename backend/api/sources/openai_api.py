@@ -1,17 +1,26 @@
+import asyncio
+import hashlib
 import json
+import time
 import uuid
+from collections import deque, OrderedDict
 from datetime import datetime, timezone
 from typing import Optional
 
 import httpx
 from pydantic import ValidationError
 
+from api import conversation_history
+from api.conversation_history import ConversationThreadCache
+from api.ask_stream import TextChunkBuffer
 from api.conf import Config, Credentials
 from api.enums import OpenaiApiChatModels, ChatSourceTypes
 from api.exceptions import OpenaiApiException
-from api.models.doc import OpenaiApiChatMessage, OpenaiApiConversationHistoryDocument, OpenaiApiChatMessageMetadata, \
+from api.models.doc import OpenaiApiChatMessage, OpenaiApiChatMessageMetadata, \
     OpenaiApiChatMessageTextContent
-from api.schemas.openai_schemas import OpenaiChatResponse
+from api.schemas.openai_schemas import OpenaiChatResponseUsage
+from api.tokenizer import truncate_context, count_message_tokens, MESSAGE_OVERHEAD_TOKENS
+from api.upstream_record import make_upstream_transports
 from utils.common import singleton_with_lock
 from utils.logger import get_logger
 
@@ -37,17 +46,207 @@ async def _check_response(response: httpx.Response) -> None:
 
 
 def make_session() -> httpx.AsyncClient:
-    if config.openai_api.proxy is not None:
+    limits = httpx.Limits(max_connections=config.openai_api.max_connections)
+    # 记录或回放上游请求时，使用包装后的 transport
+    upstream_transports = make_upstream_transports(ChatSourceTypes.openai_api, config.openai_api.openai_base_url,
+                                                   limits, proxy=config.openai_api.proxy)
+    if upstream_transports:
+        session = httpx.AsyncClient(timeout=None, limits=limits, **upstream_transports)
+    elif config.openai_api.proxy is not None:
         proxies = {
             "http://": config.openai_api.proxy,
             "https://": config.openai_api.proxy,
         }
-        session = httpx.AsyncClient(proxies=proxies, timeout=None)
+        session = httpx.AsyncClient(proxies=proxies, timeout=None, limits=limits)
     else:
-        session = httpx.AsyncClient(timeout=None)
+        session = httpx.AsyncClient(timeout=None, limits=limits)
     return session
 
 
+def _get_retry_after(response: httpx.Response) -> float | None:
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+DEFAULT_API_KEY_NAME = "default"
+
+_RATE_WINDOW_SECONDS = 60
+
+# 命中回复缓存时，将回复分成多少帧模拟流式返回
+CACHED_REPLY_FRAME_COUNT = 20
+
+
+class OpenaiApiKey:
+    """
+    key 池中的一个 API key：拥有独立的并发限制、每分钟请求数 / token 数预算和限流冷却时间
+    """
+
+    def __init__(self, name: str, api_key: str | None, max_concurrency: int, rpm_limit: int | None,
+                 tpm_limit: int | None):
+        self.name = name
+        self.active_count = 0
+        self.cooldown_until: float | None = None
+        self.last_error: str | None = None
+        # 最近一分钟内的请求时间和 token 用量（[时间, token 数]，请求结束后按实际用量原地修正）
+        self._request_times: deque[float] = deque()
+        self._token_usage: deque[list] = deque()
+        self._token_usage_sum = 0
+        self.reset(api_key, max_concurrency, rpm_limit, tpm_limit)
+
+    def reset(self, api_key: str | None, max_concurrency: int, rpm_limit: int | None, tpm_limit: int | None):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.cooldown_until = None
+
+    def _prune(self, now: float):
+        while self._request_times and self._request_times[0] <= now - _RATE_WINDOW_SECONDS:
+            self._request_times.popleft()
+        while self._token_usage and self._token_usage[0][0] <= now - _RATE_WINDOW_SECONDS:
+            self._token_usage_sum -= self._token_usage.popleft()[1]
+
+    def get_rpm(self, now: float = None) -> int:
+        self._prune(now or time.time())
+        return len(self._request_times)
+
+    def get_tpm(self, now: float = None) -> int:
+        self._prune(now or time.time())
+        return self._token_usage_sum
+
+    def is_cooling_down(self, now: float = None) -> bool:
+        return self.cooldown_until is not None and (now or time.time()) < self.cooldown_until
+
+    def can_accept(self, tokens: int, now: float) -> bool:
+        if self.is_cooling_down(now) or self.active_count >= self.max_concurrency:
+            return False
+        if self.rpm_limit is not None and self.get_rpm(now) >= self.rpm_limit:
+            return False
+        # 单次请求超过 TPM 上限时，只要窗口内没有其它用量也允许，否则永远无法发送
+        if self.tpm_limit is not None and self.get_tpm(now) > 0 and self.get_tpm(now) + tokens > self.tpm_limit:
+            return False
+        return True
+
+    def get_load(self, now: float) -> float:
+        """
+        并发、RPM、TPM 中占用比例最高的一项
+        """
+        load = self.active_count / self.max_concurrency
+        if self.rpm_limit is not None:
+            load = max(load, self.get_rpm(now) / self.rpm_limit)
+        if self.tpm_limit is not None:
+            load = max(load, self.get_tpm(now) / self.tpm_limit)
+        return load
+
+    def record_tokens(self, tokens: int, now: float = None) -> list:
+        """
+        记录一次 token 用量，返回该记录，之后可用 correct_tokens 修正
+        """
+        usage = [now or time.time(), tokens]
+        self._token_usage.append(usage)
+        self._token_usage_sum += tokens
+        return usage
+
+    def correct_tokens(self, usage: list, tokens: int, now: float = None):
+        """
+        将 record_tokens 返回的记录修正为实际用量；记录已移出时间窗口时无需修正
+        """
+        now = now or time.time()
+        self._prune(now)
+        if usage[0] > now - _RATE_WINDOW_SECONDS:
+            self._token_usage_sum += tokens - usage[1]
+            usage[1] = tokens
+
+    def acquire(self, tokens: int, now: float) -> list:
+        """
+        占用一个并发并预计 token 用量，返回用量记录
+        """
+        self.active_count += 1
+        self._request_times.append(now)
+        return self.record_tokens(tokens, now)
+
+    def mark_rate_limited(self, retry_after: float | None, reason: str):
+        self.cooldown_until = time.time() + (retry_after if retry_after is not None
+                                             else config.openai_api.key_cooldown_seconds)
+        self.last_error = reason
+        logger.warning(f"OpenAI API key {self.name} is rate limited, cooldown until {self.cooldown_until}: {reason}")
+
+
+class CachedReply:
+    def __init__(self, text: str, finish_reason: str | None, usage: OpenaiChatResponseUsage | None,
+                 expire_at: float):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.expire_at = expire_at
+
+
+@singleton_with_lock
+class OpenaiApiResponseCache:
+    """
+    完全相同的请求（模型、消息、extra_args）直接使用缓存的回复，不再请求 OpenAI
+    - 需开启 openai_api.response_cache；只缓存正常结束（finish_reason 为 stop）的回复
+    - 超过 response_cache_ttl 秒过期，最多缓存 response_cache_size 条，LRU 淘汰
+    """
+
+    def __init__(self):
+        self._replies: OrderedDict[str, CachedReply] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(data: dict) -> str:
+        """
+        data 为 chat/completions 的请求体；消息内容去掉首尾空白并统一换行符，参数按键排序
+        """
+        normalized = {
+            **data,
+            "messages": [{"role": msg["role"], "content": msg["content"].replace("\r\n", "\n").strip()}
+                         for msg in data["messages"]],
+        }
+        normalized.pop("stream", None)
+        raw = json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> CachedReply | None:
+        reply = self._replies.get(key)
+        if reply is not None and reply.expire_at <= time.time():
+            del self._replies[key]
+            reply = None
+        if reply is None:
+            self.misses += 1
+            return None
+        self._replies.move_to_end(key)
+        self.hits += 1
+        return reply
+
+    def put(self, key: str, text: str, finish_reason: str | None, usage: OpenaiChatResponseUsage | None):
+        if config.openai_api.response_cache_size == 0:
+            return
+        self._replies[key] = CachedReply(text, finish_reason, usage, time.time() + config.openai_api.response_cache_ttl)
+        self._replies.move_to_end(key)
+        while len(self._replies) > config.openai_api.response_cache_size:
+            self._replies.popitem(last=False)
+            self.evictions += 1
+
+    def get_size(self) -> int:
+        now = time.time()
+        return sum(1 for reply in self._replies.values() if reply.expire_at > now)
+
+    def get_hit_rate(self) -> float | None:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def clear(self):
+        self._replies.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
 @singleton_with_lock
 class OpenaiApiChatManager:
     """
@@ -56,9 +255,65 @@ class OpenaiApiChatManager:
 
     def __init__(self):
         self.session = make_session()
+        self.keys: dict[str, OpenaiApiKey] = {}
+        self.load_keys()
+        self._key_released = asyncio.Event()
 
     def reset_session(self):
         self.session = make_session()
+        self.load_keys()
+
+    def load_keys(self):
+        """
+        根据 credentials 重建 key 池；同名 key 复用原对象，以保留正在进行的请求计数和用量
+        """
+        key_credentials = [(DEFAULT_API_KEY_NAME, credentials.openai_api_key, None, None, None)]
+        for key in credentials.openai_api_extra_keys:
+            if key.enabled:
+                key_credentials.append((key.name, key.api_key, key.max_concurrency, key.rpm_limit, key.tpm_limit))
+        keys = {}
+        for name, api_key, max_concurrency, rpm_limit, tpm_limit in key_credentials:
+            if name in keys:
+                logger.warning(f"Duplicated OpenAI API key name: {name}, ignored")
+                continue
+            if api_key is None and name == DEFAULT_API_KEY_NAME and len(key_credentials) > 1:
+                continue
+            args = (api_key, max_concurrency or config.openai_api.key_max_concurrency,
+                    rpm_limit or config.openai_api.key_rpm_limit, tpm_limit or config.openai_api.key_tpm_limit)
+            if name in self.keys:
+                self.keys[name].reset(*args)
+                keys[name] = self.keys[name]
+            else:
+                keys[name] = OpenaiApiKey(name, *args)
+        self.keys = keys
+
+    async def acquire_key(self, tokens: int) -> tuple[OpenaiApiKey, list]:
+        """
+        选择负载最低且在预算内的 key；都不可用时等待，超过 key_acquire_timeout 抛出 429
+        返回 key 和预计的 token 用量记录，结束时传给 release_key
+        """
+        deadline = time.time() + config.openai_api.key_acquire_timeout
+        while True:
+            now = time.time()
+            candidates = [key for key in self.keys.values() if key.can_accept(tokens, now)]
+            if candidates:
+                key = min(candidates, key=lambda k: k.get_load(now))
+                return key, key.acquire(tokens, now)
+            if now >= deadline:
+                raise OpenaiApiException("No available OpenAI API key, please try again later", code=429)
+            # 有 key 释放时立即重试；预算按时间窗口恢复，因此也定期重试
+            self._key_released.clear()
+            try:
+                await asyncio.wait_for(self._key_released.wait(), min(1.0, deadline - now))
+            except asyncio.TimeoutError:
+                pass
+
+    def release_key(self, key: OpenaiApiKey, token_usage: list, used_tokens: int | None = None):
+        key.active_count -= 1
+        if used_tokens is not None:
+            # 替换预计的用量，而不是追加差值：预计偏高时差值为负，会让窗口内的用量低于实际
+            key.correct_tokens(token_usage, used_tokens)
+        self._key_released.set()
 
     async def ask(self, text_content: str, conversation_id: uuid.UUID = None,
                   parent_id: uuid.UUID = None, model: OpenaiApiChatModels = None,
@@ -87,36 +342,28 @@ class OpenaiApiChatManager:
             assert parent_id is None, "parent_id must be None when conversation_id is None"
             messages = [new_message]
         else:
-            conv_history = await OpenaiApiConversationHistoryDocument.get(conversation_id)
-            if not conv_history:
-                raise ValueError("conversation_id not found")
-            if conv_history.source != ChatSourceTypes.openai_api:
-                raise ValueError(f"{conversation_id} is not api conversation")
-            if not conv_history.mapping.get(str(parent_id)):
-                raise ValueError(f"{parent_id} is not a valid parent of {conversation_id}")
-
-            # 从 current_node 开始往前找 context_message_count 个 message
-            if not conv_history.current_node:
-                raise ValueError(f"{conversation_id} current_node is None")
-
-            msg = conv_history.mapping.get(str(conv_history.current_node))
-            assert msg, f"{conv_history.id} current_node({conv_history.current_node}) not found in mapping"
-
-            count = 0
-            iter_count = 0
-
-            while msg:
-                count += 1
-                messages.append(msg)
-                if context_message_count != -1 and count >= context_message_count:
-                    break
-                iter_count += 1
-                if iter_count > MAX_CONTEXT_MESSAGE_COUNT:
-                    raise ValueError(f"too many messages to iterate, conversation_id={conversation_id}")
-                msg = conv_history.mapping.get(str(msg.parent))
-
-            messages.reverse()
-            messages.append(new_message)
+            # 从 parent_id 开始往前找 context_message_count 个 message
+            # 优先使用缓存的分支；未命中时读取整个分支（最多 MAX_CONTEXT_MESSAGE_COUNT + 1 条）并缓存
+            capacity = MAX_CONTEXT_MESSAGE_COUNT + 1
+            count = capacity if context_message_count == -1 else min(context_message_count, capacity)
+            thread_cache = ConversationThreadCache()
+            messages = thread_cache.get(conversation_id, parent_id, count)
+            if messages is None:
+                conv_history, messages = await conversation_history.load_branch(
+                    ChatSourceTypes.openai_api, conversation_id, node_id=parent_id, limit=capacity)
+                if not conv_history:
+                    raise ValueError("conversation_id not found")
+                if not messages or str(messages[-1].id) != str(parent_id):
+                    raise ValueError(f"{parent_id} is not a valid parent of {conversation_id}")
+                thread_cache.put(conversation_id, messages, capacity)
+                messages = messages[-count:]
+            if len(messages) > MAX_CONTEXT_MESSAGE_COUNT:
+                raise ValueError(f"too many messages to iterate, conversation_id={conversation_id}")
+
+            messages = messages + [new_message]
+
+        # 按模型的 token 预算截断上下文
+        messages = truncate_context(messages, model)
 
         # TODO: credits 判断
 
@@ -128,59 +375,139 @@ class OpenaiApiChatManager:
             **(extra_args or {})
         }
 
+        response_cache = OpenaiApiResponseCache()
+        cache_key = None
+        if config.openai_api.response_cache:
+            cache_key = response_cache.make_key(data)
+            cached_reply = response_cache.get(cache_key)
+            if cached_reply is not None:
+                async for reply_message in self._replay_cached_reply(cached_reply, model, message_id):
+                    yield reply_message
+                return
+
         reply_message = None
-        text_content = ""
+        text_buffer = TextChunkBuffer()
+        flush_interval = config.ask_stream.coalesce_interval_ms / 1000
+        last_yield_time = None
 
         timeout = httpx.Timeout(config.openai_api.read_timeout, connect=config.openai_api.connect_timeout)
 
-        async with self.session.stream(
-                method="POST",
-                url=f"{base_url}chat/completions",
-                json=data,
-                headers={"Authorization": f"Bearer {credentials.openai_api_key}"},
-                timeout=timeout
-        ) as response:
-            await _check_response(response)
-            async for line in response.aiter_lines():
-                if not line or line is None:
-                    continue
-                if "data: " in line:
-                    line = line[6:]
-                if "[DONE]" in line:
-                    break
-
-                try:
-                    line = json.loads(line)
-                    resp = OpenaiChatResponse(**line)
-
-                    if resp.choices[0].message is not None:
-                        text_content = resp.choices[0].message.get("content")
-                    if resp.choices[0].delta is not None:
-                        text_content += resp.choices[0].delta.get("content", "")
-                    if reply_message is None:
-                        reply_message = OpenaiApiChatMessage(
-                            source="openai_api",
-                            id=uuid.uuid4(),
-                            role="assistant",
-                            model=model,
-                            create_time=datetime.now().astimezone(tz=timezone.utc),
-                            parent=message_id,
-                            children=[],
-                            content=OpenaiApiChatMessageTextContent(content_type="text", text=text_content),
-                            metadata=OpenaiApiChatMessageMetadata(
-                                source="openai_api",
-                                finish_reason=resp.choices[0].finish_reason,
-                            )
-                        )
-                    else:
-                        reply_message.content = OpenaiApiChatMessageTextContent(content_type="text", text=text_content)
-
-                    if resp.usage:
-                        reply_message.metadata.usage = resp.usage
-
-                    yield reply_message
-
-                except json.decoder.JSONDecodeError:
-                    logger.warning(f"OpenAIChatResponse parse json error")
-                except ValidationError as e:
-                    logger.warning(f"OpenAIChatResponse validate error: {e}")
+        # 本次请求预计消耗的 token 数，用于 key 的 TPM 预算；结束后按实际用量修正
+        estimated_tokens = sum(count_message_tokens(msg, model) + MESSAGE_OVERHEAD_TOKENS for msg in messages) + \
+            config.openai_api.reserved_completion_tokens
+
+        # 被限流（429）且还没有收到回复时，换一个 key 重试
+        retry_count = 0
+        while True:
+            key, token_usage = await self.acquire_key(estimated_tokens)
+            try:
+                async with self.session.stream(
+                        method="POST",
+                        url=f"{base_url}chat/completions",
+                        json=data,
+                        headers={"Authorization": f"Bearer {key.api_key}"},
+                        timeout=timeout
+                ) as response:
+                    if response.status_code == 429:
+                        key.mark_rate_limited(_get_retry_after(response), f"429 {response.reason_phrase}")
+                        if retry_count < len(self.keys) - 1:
+                            retry_count += 1
+                            continue
+                    await _check_response(response)
+                    async for line in response.aiter_lines():
+                        if not line or line is None:
+                            continue
+                        if "data: " in line:
+                            line = line[6:]
+                        if "[DONE]" in line:
+                            break
+
+                        try:
+                            # 只提取需要的字段，不逐行构造 OpenaiChatResponse
+                            line = json.loads(line)
+                            choices = line.get("choices") or [{}]
+                            choice = choices[0]
+
+                            if choice.get("message") is not None:
+                                text_buffer.set(choice["message"].get("content") or "")
+                            if choice.get("delta") is not None:
+                                text_buffer.append(choice["delta"].get("content") or "")
+                            if reply_message is None:
+                                reply_message = OpenaiApiChatMessage(
+                                    source="openai_api",
+                                    id=uuid.uuid4(),
+                                    role="assistant",
+                                    model=model,
+                                    create_time=datetime.now().astimezone(tz=timezone.utc),
+                                    parent=message_id,
+                                    children=[],
+                                    content=OpenaiApiChatMessageTextContent(content_type="text", text=""),
+                                    metadata=OpenaiApiChatMessageMetadata(
+                                        source="openai_api",
+                                    )
+                                )
+                            if choice.get("finish_reason"):
+                                reply_message.metadata.finish_reason = choice["finish_reason"]
+                            if line.get("usage"):
+                                reply_message.metadata.usage = OpenaiChatResponseUsage.parse_obj(line["usage"])
+
+                            # 只在发送间隔到达（与 ask_stream.coalesce_interval_ms 一致）或有结束信息时拼接完整文本
+                            now = time.monotonic()
+                            if last_yield_time is None or now - last_yield_time >= flush_interval or \
+                                    choice.get("finish_reason") or line.get("usage"):
+                                reply_message.content = OpenaiApiChatMessageTextContent(
+                                    content_type="text", text=text_buffer.getvalue())
+                                last_yield_time = now
+                                yield reply_message
+
+                        except json.decoder.JSONDecodeError:
+                            logger.warning(f"OpenAIChatResponse parse json error")
+                        except ValidationError as e:
+                            logger.warning(f"OpenAIChatResponse validate error: {e}")
+                        except (KeyError, TypeError, AttributeError) as e:
+                            logger.warning(f"OpenAIChatResponse parse error: {e.__class__.__name__} {e}")
+                    if reply_message is not None and text_buffer.has_pending():
+                        reply_message.content = OpenaiApiChatMessageTextContent(
+                            content_type="text", text=text_buffer.getvalue())
+                        yield reply_message
+                    if cache_key is not None and reply_message is not None and \
+                            reply_message.metadata.finish_reason == "stop":
+                        response_cache.put(cache_key, text_buffer.getvalue(), reply_message.metadata.finish_reason,
+                                           reply_message.metadata.usage)
+                break
+            finally:
+                used_tokens = None
+                if reply_message is not None and reply_message.metadata.usage is not None:
+                    usage = reply_message.metadata.usage
+                    used_tokens = (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)
+                self.release_key(key, token_usage, used_tokens)
+
+    @staticmethod
+    async def _replay_cached_reply(cached_reply: CachedReply, model: OpenaiApiChatModels, message_id: uuid.UUID):
+        """
+        将缓存的回复分成若干帧返回，与正常的流式回复走相同的处理流程
+        """
+        reply_message = OpenaiApiChatMessage(
+            source="openai_api",
+            id=uuid.uuid4(),
+            role="assistant",
+            model=model,
+            create_time=datetime.now().astimezone(tz=timezone.utc),
+            parent=message_id,
+            children=[],
+            content=OpenaiApiChatMessageTextContent(content_type="text", text=""),
+            metadata=OpenaiApiChatMessageMetadata(
+                source="openai_api",
+                cached=True,
+            )
+        )
+        text = cached_reply.text
+        step = max(len(text) // CACHED_REPLY_FRAME_COUNT, 1)
+        for end in range(step, len(text), step):
+            reply_message.content = OpenaiApiChatMessageTextContent(content_type="text", text=text[:end])
+            yield reply_message
+            await asyncio.sleep(0)
+        reply_message.content = OpenaiApiChatMessageTextContent(content_type="text", text=text)
+        reply_message.metadata.finish_reason = cached_reply.finish_reason
+        reply_message.metadata.usage = cached_reply.usage
+        yield reply_message
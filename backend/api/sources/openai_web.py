@@ -1,15 +1,20 @@
 import asyncio
 import json
+import time
 import uuid
+from collections import deque
+from datetime import datetime, timezone
 from mimetypes import guess_type
 from typing import AsyncGenerator
 
 import aiofiles
+import dateutil.parser
 import httpx
 from fastapi.encoders import jsonable_encoder
 import aiohttp
 from pydantic import parse_obj_as, ValidationError
 
+from api import conversation_history
 from api.conf import Config, Credentials
 from api.enums import OpenaiWebChatModels, ChatSourceTypes
 from api.exceptions import InvalidParamsException, OpenaiWebException, ResourceNotFoundException
@@ -26,6 +31,7 @@ from api.models.json import UploadedFileOpenaiWebInfo
 from api.schemas.file_schemas import UploadedFileInfoSchema
 from api.schemas.openai_schemas import OpenaiChatPlugin, OpenaiChatPluginUserSettings, OpenaiChatFileUploadInfo, \
     OpenaiChatFileUploadUrlResponse, OpenaiWebAskAttachment
+from api.upstream_record import make_upstream_transports
 from utils.common import singleton_with_lock
 from utils.logger import get_logger
 
@@ -34,6 +40,21 @@ credentials = Credentials()
 logger = get_logger(__name__)
 
 
+_CONTENT_TYPE_MAP = {
+    "text": OpenaiWebChatMessageTextContent,
+    "multimodal_text": OpenaiWebChatMessageMultimodalTextContent,
+    "code": OpenaiWebChatMessageCodeContent,
+    "execution_output": OpenaiWebChatMessageExecutionOutputContent,
+    "stderr": OpenaiWebChatMessageStderrContent,
+    "tether_browsing_display": OpenaiWebChatMessageTetherBrowsingDisplayContent,
+    "tether_quote": OpenaiWebChatMessageTetherQuoteContent,
+    "system_error": OpenaiWebChatMessageSystemErrorContent
+}
+
+# OpenaiWebChatMessageMetadata 序列化后的字段名（使用别名，如 _cite_metadata）
+_METADATA_KEYS = tuple(field.alias for field in OpenaiWebChatMessageMetadata.__fields__.values())
+
+
 def convert_revchatgpt_message(item: dict, message_id: str = None) -> OpenaiWebChatMessage | None:
     if not item.get("message"):
         return None
@@ -44,21 +65,11 @@ def convert_revchatgpt_message(item: dict, message_id: str = None) -> OpenaiWebC
     fallback_content = None
     if item["message"].get("content"):
         content_type = item["message"]["content"].get("content_type")
-        content_map = {
-            "text": OpenaiWebChatMessageTextContent,
-            "multimodal_text": OpenaiWebChatMessageMultimodalTextContent,
-            "code": OpenaiWebChatMessageCodeContent,
-            "execution_output": OpenaiWebChatMessageExecutionOutputContent,
-            "stderr": OpenaiWebChatMessageStderrContent,
-            "tether_browsing_display": OpenaiWebChatMessageTetherBrowsingDisplayContent,
-            "tether_quote": OpenaiWebChatMessageTetherQuoteContent,
-            "system_error": OpenaiWebChatMessageSystemErrorContent
-        }
-        if content_type not in content_map:
+        if content_type not in _CONTENT_TYPE_MAP:
             logger.debug(f"Parse message: Unknown content type {content_type}")
             fallback_content = item["message"]["content"]
         else:
-            content = content_map[content_type](**item["message"]["content"])
+            content = _CONTENT_TYPE_MAP[content_type](**item["message"]["content"])
 
     message_id = message_id or item["message"]["id"]
     result = OpenaiWebChatMessage(
@@ -89,6 +100,58 @@ def convert_revchatgpt_message(item: dict, message_id: str = None) -> OpenaiWebC
     return result
 
 
+def convert_revchatgpt_message_to_json(item: dict, message_id: str = None) -> dict | None:
+    """
+    convert_revchatgpt_message 的轻量版本，用于流式转发：
+    不构造和校验 pydantic 模型，直接提取字段，得到与 jsonable_encoder(convert_revchatgpt_message(item)) 结构相同的 dict；
+    metadata 只包含 OpenaiWebChatMessageMetadata 中定义的字段，缺少的字段为 None，上游的其它字段被丢弃
+    """
+    message = item.get("message")
+    if not message:
+        return None
+    author = message.get("author") or {}
+    metadata = message.get("metadata") or {}
+
+    content = message.get("content") or None
+    fallback_content = None
+    if content is not None and content.get("content_type") not in _CONTENT_TYPE_MAP:
+        fallback_content = content
+        content = None
+
+    model = None
+    if metadata:
+        model_code = metadata.get("model_slug")
+        model = OpenaiWebChatModels.from_code(model_code) or model_code
+
+    metadata_json = dict.fromkeys(_METADATA_KEYS)
+    metadata_json.update({
+        "source": "openai_web",
+        "weight": message.get("weight"),
+        "end_turn": message.get("end_turn"),
+        "recipient": message.get("recipient"),
+        "message_status": message.get("status"),
+        "fallback_content": fallback_content,
+    })
+    metadata_json.update({key: metadata[key] for key in _METADATA_KEYS if key in metadata})
+
+    create_time = message.get("create_time")
+    if isinstance(create_time, (int, float)):
+        create_time = datetime.fromtimestamp(create_time, tz=timezone.utc).isoformat()
+
+    return {
+        "id": message_id or message["id"],
+        "source": "openai_web",
+        "role": author.get("role"),
+        "author_name": author.get("name"),
+        "model": model,
+        "create_time": create_time,
+        "parent": item.get("parent"),
+        "children": item.get("children", []),
+        "content": content,
+        "metadata": metadata_json
+    }
+
+
 def convert_mapping(mapping: dict[uuid.UUID, dict]) -> dict[str, OpenaiWebChatMessage]:
     result = {}
     if not mapping:
@@ -116,6 +179,17 @@ def get_latest_model_from_mapping(current_node_uuid: str | None,
         return model
 
 
+def parse_openai_web_time(value: str | float | None) -> datetime | None:
+    """
+    ChatGPT 返回的时间可能是 iso 格式字符串或时间戳
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    return dateutil.parser.isoparse(value).astimezone(timezone.utc)
+
+
 def _check_fields(data: dict) -> bool:
     try:
         data["message"]["content"]
@@ -137,23 +211,44 @@ async def _check_response(response: httpx.Response) -> None:
         raise error from ex
 
 
-def make_session() -> httpx.AsyncClient:
-    if config.openai_web.proxy is not None and config.openai_web.proxy != "":
+def _is_http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def make_session(access_token: str | None = None) -> httpx.AsyncClient:
+    http2 = config.openai_web.http2
+    if http2 and not _is_http2_available():
+        logger.warning("http2 is enabled but h2 is not installed, fallback to http/1.1")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=config.openai_web.max_connections,
+        max_keepalive_connections=config.openai_web.max_keepalive_connections,
+        keepalive_expiry=config.openai_web.keepalive_expiry,
+    )
+    # 记录或回放上游请求时，使用包装后的 transport
+    upstream_transports = make_upstream_transports(ChatSourceTypes.openai_web, config.openai_web.chatgpt_base_url or "",
+                                                   limits, http2=http2, proxy=config.openai_web.proxy or None)
+    if upstream_transports:
+        session = httpx.AsyncClient(http2=http2, limits=limits, **upstream_transports)
+    elif config.openai_web.proxy is not None and config.openai_web.proxy != "":
         proxies = {
             "http://": config.openai_web.proxy,
             "https://": config.openai_web.proxy,
         }
-        session = httpx.AsyncClient(proxies=proxies)
+        session = httpx.AsyncClient(proxies=proxies, http2=http2, limits=limits)
     else:
-        session = httpx.AsyncClient()
+        session = httpx.AsyncClient(http2=http2, limits=limits)
     session.headers.clear()
     session.headers.update(
         {
             "Accept": "text/event-stream",
-            "Authorization": f"Bearer {credentials.openai_web_access_token}",
+            "Authorization": f"Bearer {access_token or credentials.openai_web_access_token}",
             "Content-Type": "application/json",
             "X-Openai-Assistant-App-Id": "",
-            "Connection": "close",
             "Accept-Language": "en-US,en;q=0.9",
             "Referer": "https://chat.openai.com/chat",
         },
@@ -161,6 +256,151 @@ def make_session() -> httpx.AsyncClient:
     return session
 
 
+DEFAULT_ACCOUNT_NAME = "default"
+
+# 出现这些状态码时，认为账号暂时不可用（token 失效、被限流等）
+_UNHEALTHY_STATUS_CODES = (401, 403, 429)
+
+
+class OpenaiWebAccount:
+    """
+    账号池中的一个 ChatGPT 账号：拥有独立的凭据、session、并发限制和健康状态
+    """
+
+    def __init__(self, name: str, access_token: str | None, max_concurrency: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.session = make_session(access_token)
+        self.session.event_hooks["request"].append(self._count_request)
+        self.request_count = 0
+        self.active_count = 0
+        self.unhealthy_until: float | None = None
+        self.last_error: str | None = None
+        self._retired_sessions: dict[httpx.AsyncClient, int] = {}  # 已替换的 session -> 仍在使用它的提问数
+
+    def reset(self, access_token: str | None, max_concurrency: int):
+        old_session = self.session
+        self.session = make_session(access_token)
+        self.session.event_hooks["request"].append(self._count_request)
+        self.max_concurrency = max_concurrency
+        self.unhealthy_until = None
+        # 关闭旧 session 的连接；仍有提问在使用时，在最后一个提问结束后关闭
+        in_use_count = self.active_count - sum(self._retired_sessions.values())
+        if in_use_count > 0:
+            self._retired_sessions[old_session] = in_use_count
+        else:
+            self._close_session(old_session)
+
+    @staticmethod
+    def _close_session(session: httpx.AsyncClient):
+        try:
+            asyncio.get_running_loop().create_task(session.aclose())
+        except RuntimeError:
+            pass
+
+    def acquire(self) -> httpx.AsyncClient:
+        self.active_count += 1
+        return self.session
+
+    def release(self, session: httpx.AsyncClient):
+        self.active_count -= 1
+        if session in self._retired_sessions:
+            self._retired_sessions[session] -= 1
+            if self._retired_sessions[session] == 0:
+                del self._retired_sessions[session]
+                self._close_session(session)
+
+    async def _count_request(self, _request: httpx.Request):
+        self.request_count += 1
+
+    def get_connection_pool_stats(self) -> dict[str, int]:
+        """
+        连接池中到 chatgpt_base_url 的连接情况；依赖 httpx/httpcore 内部属性，获取失败时返回空
+        """
+        try:
+            transport = self.session._transport_for_url(httpx.URL(config.openai_web.chatgpt_base_url))
+            connections = list(transport._pool.connections)
+        except Exception as e:
+            logger.debug(f"Failed to get connection pool of account {self.name}: {e}")
+            return {}
+        return {
+            "connections": len(connections),
+            "idle_connections": sum(1 for conn in connections if conn.is_idle()),
+            "http2_connections": sum(1 for conn in connections if "HTTP/2" in conn.info()),
+            "request_count": self.request_count,
+        }
+
+    async def warm_up(self):
+        """
+        预先建立连接，使后续请求可以复用；返回的状态码无关紧要
+        """
+        try:
+            response = await self.session.head(config.openai_web.chatgpt_base_url,
+                                               timeout=config.openai_web.common_timeout)
+            logger.debug(f"Warmed up connection of account {self.name}: {response.status_code} "
+                         f"({response.http_version})")
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to warm up connection of account {self.name}: {e.__class__.__name__} {e}")
+
+    def is_healthy(self) -> bool:
+        return self.unhealthy_until is None or time.time() >= self.unhealthy_until
+
+    def free_slots(self) -> int:
+        return self.max_concurrency - self.active_count
+
+    def mark_unhealthy(self, reason: str):
+        self.unhealthy_until = time.time() + config.openai_web.account_unhealthy_cooldown_seconds
+        self.last_error = reason
+        logger.warning(f"OpenAI Web account {self.name} marked as unhealthy: {reason}")
+
+    def mark_healthy(self):
+        if self.unhealthy_until is not None:
+            logger.info(f"OpenAI Web account {self.name} recovered")
+        self.unhealthy_until = None
+
+
+class OpenaiWebAskTicket:
+    """
+    一次排队中的提问；被分配账号后 account 不为空
+    """
+
+    def __init__(self, user_id: int, account_name: str | None, priority: int, seq: int, tag: float):
+        self.user_id = user_id
+        self.account_name = account_name
+        self.priority = priority
+        self.seq = seq
+        self.tag = tag  # weighted 策略下的虚拟完成时间，fifo 策略下恒为 0
+        self.enqueue_time = time.time()
+        self.dispatch_time: float | None = None
+        self.account: OpenaiWebAccount | None = None
+        self.session: httpx.AsyncClient | None = None  # 分配账号时该账号的 session
+        self.is_released = False
+        self._future = asyncio.get_running_loop().create_future()
+
+    def effective_priority(self, now: float) -> float:
+        # aging: 排队越久优先级越高
+        return self.priority + (now - self.enqueue_time) / config.openai_web.ask_queue_aging_seconds
+
+    def sort_key(self, now: float):
+        return -self.effective_priority(now), self.tag, self.seq
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        """
+        等待分配账号，超时返回 False
+        """
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def _percentile(sorted_values: list[float], q: float) -> float | None:
+    if not sorted_values:
+        return None
+    return round(sorted_values[round(q * (len(sorted_values) - 1))], 3)
+
+
 @singleton_with_lock
 class OpenaiWebChatManager:
     """
@@ -168,37 +408,186 @@ class OpenaiWebChatManager:
     """
 
     def __init__(self):
-        self.session = make_session()
-        self.semaphore = asyncio.Semaphore(1)
+        self.accounts: dict[str, OpenaiWebAccount] = {}
+        self.load_accounts()
+        self._revalidating_conversations: dict[str, asyncio.Task] = {}
+        # 排队相关；所有操作都在事件循环中同步完成，不需要加锁
+        self._queue: list[OpenaiWebAskTicket] = []
+        self._ticket_seq = 0
+        self._virtual_time = 0.0
+        self._user_virtual_tags: dict[int, float] = {}
+        self._recent_wait_times: deque[float] = deque(maxlen=1000)
+        self._avg_ask_time: float | None = None
+
+    def load_accounts(self):
+        """
+        根据 credentials 重建账号池；同名账号复用原对象，以保留正在进行的提问计数和健康状态
+        """
+        account_credentials = [(DEFAULT_ACCOUNT_NAME, credentials.openai_web_access_token, None)]
+        for account in credentials.openai_web_extra_accounts:
+            if account.enabled:
+                account_credentials.append((account.name, account.access_token, account.max_concurrency))
+        accounts = {}
+        for name, access_token, max_concurrency in account_credentials:
+            if name in accounts:
+                logger.warning(f"Duplicated OpenAI Web account name: {name}, ignored")
+                continue
+            max_concurrency = max_concurrency or config.openai_web.account_max_concurrency
+            if name in self.accounts:
+                account = self.accounts[name]
+                account.reset(access_token, max_concurrency)
+            else:
+                account = OpenaiWebAccount(name, access_token, max_concurrency)
+            accounts[name] = account
+        self.accounts = accounts
+
+    async def warm_up(self):
+        await asyncio.gather(*[account.warm_up() for account in self.accounts.values()])
+
+    def get_account(self, account_name: str | None = None) -> OpenaiWebAccount:
+        """
+        未指定账号或账号已不存在时，使用 default 账号（旧版本中的对话都属于 default 账号）
+        """
+        if account_name and account_name in self.accounts:
+            return self.accounts[account_name]
+        return self.accounts[DEFAULT_ACCOUNT_NAME]
 
     def is_busy(self):
-        return self.semaphore.locked()
+        return all(account.free_slots() <= 0 for account in self.accounts.values())
 
     def reset_session(self):
-        self.session = make_session()
+        self.load_accounts()
+        self._dispatch()
+
+    def _pick_free_account(self, account_name: str | None = None) -> OpenaiWebAccount | None:
+        # 已有对话只能使用其所属账号
+        if account_name is not None:
+            account = self.get_account(account_name)
+            return account if account.free_slots() > 0 else None
+        candidates = [account for account in self.accounts.values() if account.free_slots() > 0]
+        healthy_candidates = [account for account in candidates if account.is_healthy()]
+        candidates = healthy_candidates or candidates
+        if not candidates:
+            return None
+        return max(candidates, key=lambda account: account.free_slots())
+
+    def enqueue_ask(self, user_id: int, account_name: str | None = None, weight: float = 1.0,
+                    priority: int = 0) -> OpenaiWebAskTicket:
+        """
+        提问进入队列；account_name 不为空时只能分配该账号
+        先按优先级（含 aging）分配，同优先级时：
+        fifo: 按进入队列的顺序分配
+        weighted: 按用户权重进行加权公平排队，刚提问过的用户会排在其它用户之后
+        """
+        self._ticket_seq += 1
+        tag = 0.0
+        if config.openai_web.ask_queue_policy == "weighted":
+            tag = max(self._virtual_time, self._user_virtual_tags.get(user_id, 0.0)) + 1 / max(weight, 0.01)
+            self._user_virtual_tags[user_id] = tag
+        ticket = OpenaiWebAskTicket(user_id, account_name, priority, self._ticket_seq, tag)
+        self._queue.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def release_ask(self, ticket: OpenaiWebAskTicket):
+        """
+        提问结束或放弃排队时调用，可重复调用
+        """
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+        elif ticket.account is not None and not ticket.is_released:
+            ticket.is_released = True
+            ticket.account.release(ticket.session)
+            ask_time = time.time() - ticket.dispatch_time
+            self._avg_ask_time = ask_time if self._avg_ask_time is None else \
+                0.8 * self._avg_ask_time + 0.2 * ask_time
+            self._dispatch()
+
+    def _dispatch(self):
+        now = time.time()
+        for ticket in sorted(self._queue, key=lambda t: t.sort_key(now)):
+            account = self._pick_free_account(ticket.account_name)
+            if account is None:
+                continue
+            ticket.session = account.acquire()
+            ticket.account = account
+            ticket.dispatch_time = time.time()
+            self._queue.remove(ticket)
+            self._virtual_time = max(self._virtual_time, ticket.tag)
+            self._recent_wait_times.append(ticket.dispatch_time - ticket.enqueue_time)
+            ticket._future.set_result(account)
+
+    def get_queue_length(self) -> int:
+        return len(self._queue)
+
+    def get_queue_position(self, ticket: OpenaiWebAskTicket) -> int | None:
+        """
+        从 1 开始的排队位置，已分配账号时返回 None
+        """
+        if ticket not in self._queue:
+            return None
+        now = time.time()
+        ticket_key = ticket.sort_key(now)
+        return sum(1 for t in self._queue if t.sort_key(now) < ticket_key) + 1
 
-    async def get_conversations(self, timeout=None):
-        all_conversations = []
-        offset = 0
+    def estimate_queue_wait(self, position: int | None) -> float | None:
+        """
+        根据最近的平均提问耗时估计等待时间（秒）
+        """
+        if position is None or self._avg_ask_time is None:
+            return None
+        capacity = sum(account.max_concurrency for account in self.accounts.values())
+        return round(position * self._avg_ask_time / max(capacity, 1), 1)
+
+    def get_queue_wait_percentiles(self) -> tuple[float | None, float | None, float | None]:
+        """
+        最近 1000 次提问排队时间的 p50, p90, p99（秒）
+        """
+        wait_times = sorted(self._recent_wait_times)
+        return _percentile(wait_times, 0.5), _percentile(wait_times, 0.9), _percentile(wait_times, 0.99)
+
+    async def get_conversations(self, timeout=None, account_name: str | None = None,
+                                updated_after: datetime | None = None):
+        """
+        分页获取账号中的对话，第一页之后每批并发获取 sync_conversations_concurrency 页
+        updated_after 不为空时为增量获取：对话按 update_time 倒序返回，遇到不晚于该时间的对话即停止翻页
+        """
+        session = self.get_account(account_name).session
         limit = 80
-        while True:
-            url = f"{config.openai_web.chatgpt_base_url}conversations?offset={offset}&limit={limit}"
-            if timeout is None:
-                timeout = httpx.Timeout(config.openai_web.common_timeout)
-            response = await self.session.get(url, timeout=timeout)
+        if timeout is None:
+            timeout = httpx.Timeout(config.openai_web.common_timeout)
+
+        async def fetch_page(page_offset: int) -> list[dict]:
+            url = f"{config.openai_web.chatgpt_base_url}conversations?offset={page_offset}&limit={limit}"
+            response = await session.get(url, timeout=timeout)
             await _check_response(response)
-            data = json.loads(response.text)
-            conversations = data["items"]
-            if len(conversations):
-                all_conversations.extend(conversations)
-            else:
-                break
-            offset += 80
-        return all_conversations
+            return json.loads(response.text)["items"]
 
-    async def get_conversation_history(self, conversation_id: uuid.UUID | str) -> OpenaiWebConversationHistoryDocument:
+        all_conversations = []
+        offset = 0
+        batch_size = 1
+        while True:
+            pages = await asyncio.gather(*[fetch_page(offset + i * limit) for i in range(batch_size)])
+            offset += batch_size * limit
+            batch_size = config.openai_web.sync_conversations_concurrency
+            for conversations in pages:
+                if not conversations:
+                    return all_conversations
+                for conv in conversations:
+                    if updated_after is not None:
+                        update_time = parse_openai_web_time(conv.get("update_time"))
+                        if update_time is not None and update_time <= updated_after:
+                            return all_conversations
+                    all_conversations.append(conv)
+
+    async def get_conversation_history(self, conversation_id: uuid.UUID | str, account_name: str | None = None,
+                                       cached_doc: OpenaiWebConversationHistoryDocument | None = None
+                                       ) -> OpenaiWebConversationHistoryDocument:
+        """
+        从 ChatGPT 获取对话历史并写入 mongodb；传入 cached_doc 时只写入变化的部分
+        """
         url = f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}"
-        response = await self.session.get(url, timeout=None)
+        response = await self.get_account(account_name).session.get(url, timeout=None)
         response.encoding = 'utf-8'
         await _check_response(response)
         result = json.loads(response.text)
@@ -223,24 +612,78 @@ class OpenaiWebChatManager:
                 source="openai_web",
                 plugin_ids=result.get("plugin_ids"),
                 moderation_results=result.get("moderation_results"),
-            )
+            ),
+            fetch_time=datetime.now(tz=timezone.utc)
         )
-        await doc.save()
+        await conversation_history.save_conversation_history(doc, cached_doc)
+        return doc
+
+    async def get_cached_conversation_history(self, conversation_id: uuid.UUID | str,
+                                              account_name: str | None = None,
+                                              updated_at: datetime | None = None,
+                                              with_mapping: bool = True) -> OpenaiWebConversationHistoryDocument:
+        """
+        优先返回 mongodb 中缓存的对话历史：
+        - 没有缓存，或缓存早于 updated_at（数据库中对话的 update_time，经本站提问或同步后会更新）时，从 ChatGPT 获取
+        - 缓存超过 history_cache_revalidate_seconds 时，直接返回缓存，同时在后台重新获取
+        with_mapping 为 False 时，返回的缓存可能不包含消息（按消息存储时），从 ChatGPT 获取的总是完整的
+        """
+        doc = None
+        if config.openai_web.history_cache:
+            doc = await conversation_history.get_conversation_history(ChatSourceTypes.openai_web, conversation_id,
+                                                                      with_mapping=with_mapping)
+        fetch_time = doc.fetch_time if doc is not None else None
+        if fetch_time is not None and fetch_time.tzinfo is None:  # mongodb 中读出的时间不带时区
+            fetch_time = fetch_time.replace(tzinfo=timezone.utc)
+        if fetch_time is None or (updated_at is not None and fetch_time < updated_at):
+            return await self.get_conversation_history(conversation_id, account_name=account_name, cached_doc=doc)
+        if (datetime.now(tz=timezone.utc) - fetch_time).total_seconds() > \
+                config.openai_web.history_cache_revalidate_seconds:
+            self._revalidate_conversation_history(conversation_id, account_name, doc)
         return doc
 
+    def _revalidate_conversation_history(self, conversation_id: uuid.UUID | str, account_name: str | None,
+                                         cached_doc: OpenaiWebConversationHistoryDocument):
+        key = str(conversation_id)
+        if key in self._revalidating_conversations:
+            return
+
+        async def revalidate():
+            try:
+                await self.get_conversation_history(conversation_id, account_name=account_name,
+                                                    cached_doc=cached_doc)
+                logger.debug(f"Revalidated conversation history {conversation_id}")
+            except Exception as e:
+                logger.warning(f"Failed to revalidate conversation history {conversation_id}: "
+                               f"{e.__class__.__name__} {e}")
+            finally:
+                self._revalidating_conversations.pop(key, None)
+
+        self._revalidating_conversations[key] = asyncio.create_task(revalidate())
+
+    @staticmethod
+    async def _update_cached_conversation_title(conversation_id: uuid.UUID | str, title: str):
+        await OpenaiWebConversationHistoryDocument.find_one(
+            OpenaiWebConversationHistoryDocument.id == uuid.UUID(str(conversation_id))
+        ).update({"$set": {"title": title}})
+
     async def clear_conversations(self):
         # await self.chatbot.clear_conversations()
         url = f"{config.openai_web.chatgpt_base_url}conversations"
-        response = await self.session.patch(url, json={"is_visible": False})
-        await _check_response(response)
+        for account in self.accounts.values():
+            response = await account.session.patch(url, json={"is_visible": False})
+            await _check_response(response)
 
     async def ask(self, text_content: str, conversation_id: uuid.UUID = None, parent_id: uuid.UUID = None,
                   model: OpenaiWebChatModels = None, plugin_ids: list[str] = None,
                   attachments: list[OpenaiWebAskAttachment] = None,
-                  multimodal_image_parts: list[OpenaiWebChatMessageMultimodalTextContentImagePart] = None, **_kwargs):
+                  multimodal_image_parts: list[OpenaiWebChatMessageMultimodalTextContentImagePart] = None,
+                  account: OpenaiWebAccount = None, **_kwargs):
 
         assert config.openai_web.enabled, "OpenAI Web is not enabled"
 
+        account = account or self.get_account()
+
         model = model or OpenaiWebChatModels.gpt_3_5
 
         if conversation_id or parent_id:
@@ -296,13 +739,19 @@ class OpenaiWebChatManager:
 
         timeout = httpx.Timeout(Config().openai_web.common_timeout, read=Config().openai_web.ask_timeout)
 
-        async with self.session.stream(
+        async with account.session.stream(
                 method="POST",
                 url=f"{config.openai_web.chatgpt_base_url}conversation",
                 data=json.dumps(data),
                 timeout=timeout,
         ) as response:
-            await _check_response(response)
+            try:
+                await _check_response(response)
+            except OpenaiWebException as e:
+                if e.code in _UNHEALTHY_STATUS_CODES:
+                    account.mark_unhealthy(f"{e.code} {e.message[:200]}")
+                raise e
+            account.mark_healthy()
             async for line in response.aiter_lines():
                 if not line or line is None:
                     continue
@@ -324,30 +773,35 @@ class OpenaiWebChatManager:
 
                 yield line
 
-    async def delete_conversation(self, conversation_id: str):
+    async def delete_conversation(self, conversation_id: str, account_name: str | None = None):
         # await self.chatbot.delete_conversation(conversation_id)
         url = f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}"
-        response = await self.session.patch(url, json={"is_visible": False})
+        response = await self.get_account(account_name).session.patch(url, json={"is_visible": False})
         await _check_response(response)
 
-    async def set_conversation_title(self, conversation_id: str, title: str):
+    async def set_conversation_title(self, conversation_id: str, title: str, account_name: str | None = None):
         url = f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}"
-        response = await self.session.patch(url, json={"title": title})
+        response = await self.get_account(account_name).session.patch(url, json={"title": title})
         await _check_response(response)
+        await self._update_cached_conversation_title(conversation_id, title)
 
-    async def generate_conversation_title(self, conversation_id: str, message_id: str):
+    async def generate_conversation_title(self, conversation_id: str, message_id: str,
+                                          account_name: str | None = None):
         url = f"{config.openai_web.chatgpt_base_url}conversation/gen_title/{conversation_id}"
-        response = await self.session.post(
+        response = await self.get_account(account_name).session.post(
             url,
             json={"message_id": message_id},
         )
         await _check_response(response)
         result = response.json()
         if result.get("title"):
+            await self._update_cached_conversation_title(conversation_id, result["title"])
             return result.get("title")
         else:
             raise OpenaiWebException(f"Failed to generate title: {result.get('message')}")
 
+    # 以下插件和文件相关的接口均使用 default 账号
+
     async def get_plugin_manifests(self, statuses="approved", is_installed=None, offset=0, limit=250):
         if not config.openai_web.is_plus_account:
             raise InvalidParamsException("errors.notPlusChatgptAccount")
@@ -358,7 +812,7 @@ class OpenaiWebChatManager:
         }
         if is_installed is not None:
             params["is_installed"] = is_installed
-        response = await self.session.get(
+        response = await self.get_account().session.get(
             url=f"{config.openai_web.chatgpt_base_url}aip/p",
             params=params,
             timeout=config.openai_web.ask_timeout
@@ -369,7 +823,7 @@ class OpenaiWebChatManager:
     async def change_plugin_user_settings(self, plugin_id: str, setting: OpenaiChatPluginUserSettings):
         if not config.openai_web.is_plus_account:
             raise InvalidParamsException("errors.notPlusChatgptAccount")
-        response = await self.session.patch(
+        response = await self.get_account().session.patch(
             url=f"{config.openai_web.chatgpt_base_url}aip/p/{plugin_id}/user-settings",
             json=setting.dict(exclude_unset=True, exclude_none=True),
         )
@@ -381,15 +835,15 @@ class OpenaiWebChatManager:
             logger.warning(f"Failed to parse plugin: {e}")
             raise e
 
-    async def get_interpreter_info(self, conversation_id: str):
-        response = await self.session.get(
+    async def get_interpreter_info(self, conversation_id: str, account_name: str | None = None):
+        response = await self.get_account(account_name).session.get(
             url=f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}/interpreter",
         )
         await _check_response(response)
         return response.json()
 
     async def get_file_download_url(self, file_id: str):
-        response = await self.session.get(
+        response = await self.get_account().session.get(
             url=f"{config.openai_web.chatgpt_base_url}files/{file_id}/download",
         )
         await _check_response(response)
@@ -400,8 +854,9 @@ class OpenaiWebChatManager:
             raise ResourceNotFoundException(
                 f"{file_id} Failed to get download url: {result.get('error_code')}({result.get('error_message')})")
 
-    async def get_interpreter_file_download_url(self, conversation_id: str, message_id: str, sandbox_path: str):
-        response = await self.session.get(
+    async def get_interpreter_file_download_url(self, conversation_id: str, message_id: str, sandbox_path: str,
+                                                account_name: str | None = None):
+        response = await self.get_account(account_name).session.get(
             url=f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}/interpreter/download",
             params={"message_id": message_id, "sandbox_path": sandbox_path}
         )
@@ -417,7 +872,7 @@ class OpenaiWebChatManager:
         """
         获取文件在 azure blob 的上传地址
         """
-        response = await self.session.post(
+        response = await self.get_account().session.post(
             url=f"{config.openai_web.chatgpt_base_url}files",
             json=upload_info.dict()
         )
@@ -437,7 +892,7 @@ class OpenaiWebChatManager:
         if file_id is None:
             raise InvalidParamsException()
 
-        response = await self.session.post(
+        response = await self.get_account().session.post(
             url=f"{config.openai_web.chatgpt_base_url}files/{file_id}/uploaded",
             json={}
         )
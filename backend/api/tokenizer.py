@@ -0,0 +1,134 @@
+import math
+from abc import ABC, abstractmethod
+from typing import Callable
+
+from api.conf import Config
+from api.enums import OpenaiApiChatModels
+from api.models.doc import OpenaiApiChatMessage, OpenaiApiChatMessageMetadata
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+# 每条消息在 chat/completions 中除内容外额外占用的 token 数（role 及分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 回复前的固定开销
+REPLY_PRIMING_TOKENS = 3
+
+
+class BaseTokenizer(ABC):
+    name: str
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        pass
+
+
+class EstimateTokenizer(BaseTokenizer):
+    """
+    不依赖任何词表的估算：ASCII 字符约 4 个一个 token，其余字符（如中文）每个约一个 token
+    """
+    name = "estimate"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        ascii_count = sum(1 for char in text if ord(char) < 128)
+        return math.ceil(ascii_count / 4) + (len(text) - ascii_count)
+
+
+class TiktokenTokenizer(BaseTokenizer):
+    """
+    需要安装 tiktoken，且词表已缓存到本地（TIKTOKEN_CACHE_DIR）或可以联网下载
+    """
+
+    def __init__(self, model_code: str):
+        import tiktoken
+        try:
+            self._encoding = tiktoken.encoding_for_model(model_code)
+        except KeyError:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        self.name = f"tiktoken:{self._encoding.name}"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+def _auto_tokenizer(model_code: str) -> BaseTokenizer:
+    try:
+        return TiktokenTokenizer(model_code)
+    except Exception as e:
+        logger.info(f"tiktoken is not available ({e.__class__.__name__}), fallback to estimate tokenizer")
+        return EstimateTokenizer()
+
+
+# 可通过 register_tokenizer 增加其它实现，在 openai_api.tokenizer 中按名称选择
+_TOKENIZER_FACTORIES: dict[str, Callable[[str], BaseTokenizer]] = {
+    "auto": _auto_tokenizer,
+    "tiktoken": TiktokenTokenizer,
+    "estimate": lambda _model_code: EstimateTokenizer(),
+}
+
+_tokenizers: dict[tuple[str, str], BaseTokenizer] = {}
+
+
+def register_tokenizer(name: str, factory: Callable[[str], BaseTokenizer]):
+    _TOKENIZER_FACTORIES[name] = factory
+    _tokenizers.clear()
+
+
+def get_tokenizer(model: OpenaiApiChatModels) -> BaseTokenizer:
+    key = (config.openai_api.tokenizer, model.code())
+    if key not in _tokenizers:
+        factory = _TOKENIZER_FACTORIES.get(config.openai_api.tokenizer)
+        if factory is None:
+            logger.warning(f"Unknown tokenizer {config.openai_api.tokenizer}, fallback to estimate tokenizer")
+            factory = _TOKENIZER_FACTORIES["estimate"]
+        _tokenizers[key] = factory(model.code())
+    return _tokenizers[key]
+
+
+def count_message_tokens(message: OpenaiApiChatMessage, model: OpenaiApiChatModels) -> int:
+    """
+    返回消息内容的 token 数（不含 MESSAGE_OVERHEAD_TOKENS），结果缓存在 message.metadata 中，随消息一起保存
+    缓存的 tokenizer 与当前不同时重新计算
+    """
+    tokenizer = get_tokenizer(model)
+    metadata = message.metadata
+    if metadata is not None and metadata.token_count is not None and metadata.tokenizer == tokenizer.name:
+        return metadata.token_count
+    token_count = tokenizer.count(message.content.text if message.content else "")
+    if metadata is None:
+        message.metadata = metadata = OpenaiApiChatMessageMetadata(source="openai_api")
+    metadata.token_count = token_count
+    metadata.tokenizer = tokenizer.name
+    return token_count
+
+
+def get_context_token_budget(model: OpenaiApiChatModels) -> int | None:
+    """
+    上下文（包括新消息）可用的 token 数；模型没有设置上下文长度时返回 None，表示不限制
+    """
+    context_length = config.openai_api.model_context_length.get(model)
+    if context_length is None:
+        return None
+    return max(context_length - config.openai_api.reserved_completion_tokens - REPLY_PRIMING_TOKENS, 0)
+
+
+def truncate_context(messages: list[OpenaiApiChatMessage], model: OpenaiApiChatModels) -> list[OpenaiApiChatMessage]:
+    """
+    从最新的消息开始保留，直到超出模型的 token 预算；最后一条（新提问的）消息总是保留
+    """
+    budget = get_context_token_budget(model)
+    if budget is None or not messages:
+        return messages
+    used = count_message_tokens(messages[-1], model) + MESSAGE_OVERHEAD_TOKENS
+    start = len(messages) - 1
+    while start > 0:
+        used += count_message_tokens(messages[start - 1], model) + MESSAGE_OVERHEAD_TOKENS
+        if used > budget:
+            break
+        start -= 1
+    return messages[start:]
@@ -0,0 +1,348 @@
+"""
+记录和回放与上游（ChatGPT Web / OpenAI API）之间的请求和回复，用于可重复的性能回归测试：
+
+- common.upstream_record_dir 不为空时，每个请求及其回复（包括 SSE 的每一段及其到达时间）去除密钥后写入该目录
+- common.upstream_replay_dir 不为空时，不再请求上游，而是按 common.upstream_replay_speed 倍速回放记录的回复
+
+回放时 chat() 的完整流程不变；记录中的 uuid（对话和消息 id）在每个新对话中替换为新的 uuid，同一段记录可以反复回放
+"""
+import asyncio
+import itertools
+import json
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable
+
+import aiofiles
+import httpx
+
+from api.conf import Config
+from api.enums import ChatSourceTypes
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+RECORD_VERSION = 1
+
+_SECRET_KEYS = {"authorization", "access_token", "accesstoken", "api_key", "apikey", "arkose_token", "password",
+                "session_token", "refresh_token"}
+_SECRET_PATTERNS = [
+    (re.compile(r"sk-[A-Za-z0-9_\-]{16,}"), "sk-REDACTED"),
+    (re.compile(r"eyJ[A-Za-z0-9_\-]+\.[A-Za-z0-9_\-]+\.[A-Za-z0-9_\-]+"), "REDACTED_JWT"),
+    (re.compile(r"Bearer\s+[^\s\"']+"), "Bearer REDACTED"),
+    (re.compile(r"([?&](?:sig|se|skoid|sktid|signature|X-Amz-Signature|X-Amz-Credential)=)[^&\"'\s]+"),
+     r"\1REDACTED"),
+    (re.compile(r"[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}"), "user@example.com"),
+]
+_UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+_CONVERSATION_ID_PATTERN = re.compile(r"\"conversation_id\":\s*\"([0-9a-f\-]{36})\"")
+
+# 回放时最多保留多少个对话的 uuid 映射，超过时丢弃最久未使用的对话
+MAX_REPLAY_CONVERSATIONS = 1000
+
+
+def scrub_text(text: str) -> str:
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def scrub_json(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: "REDACTED" if key.lower() in _SECRET_KEYS and value[key] else scrub_json(value[key])
+                for key in value}
+    if isinstance(value, list):
+        return [scrub_json(item) for item in value]
+    if isinstance(value, str):
+        return scrub_text(value)
+    return value
+
+
+def _relative_path(url: httpx.URL, base_url: str) -> str:
+    base_path = httpx.URL(base_url).path
+    path = url.path
+    return path[len(base_path):] if path.startswith(base_path) else path.lstrip("/")
+
+
+def _request_body(request: httpx.Request) -> Any:
+    try:
+        content = request.content
+    except httpx.RequestNotRead:
+        return None
+    if not content:
+        return None
+    try:
+        return json.loads(content)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """
+    转发回复内容的同时按行对齐记录每一段及其到达时间（毫秒，相对于收到回复头），关闭时回调 on_close
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[list[list]], Any]):
+        self._stream = stream
+        self._on_close = on_close
+        self._start = time.monotonic()
+        self._chunks: list[list] = []
+        self._pending = b""
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            # 只记录到最后一个换行符为止，保证 uuid 等不会被拆到两段中
+            self._pending += chunk
+            end = self._pending.rfind(b"\n") + 1
+            if end:
+                self._record(self._pending[:end])
+                self._pending = self._pending[end:]
+            yield chunk
+
+    def _record(self, data: bytes):
+        elapsed_ms = round((time.monotonic() - self._start) * 1000, 1)
+        self._chunks.append([elapsed_ms, scrub_text(data.decode("utf-8", errors="replace"))])
+
+    async def aclose(self):
+        if self._pending:
+            self._record(self._pending)
+            self._pending = b""
+        try:
+            await self._stream.aclose()
+        finally:
+            await self._on_close(self._chunks)
+
+
+class UpstreamRecordingTransport(httpx.AsyncBaseTransport):
+    """
+    包装实际的 transport，把每次请求和回复写入 record_dir；其它属性（如连接池）仍然来自被包装的 transport
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, source: ChatSourceTypes, base_url: str,
+                 record_dir: str):
+        self._transport = transport
+        self._source = source
+        self._base_url = base_url
+        self._record_dir = record_dir
+        os.makedirs(record_dir, exist_ok=True)
+
+    def __getattr__(self, name: str):
+        return getattr(self._transport, name)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.monotonic()
+        response = await self._transport.handle_async_request(request)
+        latency_ms = round((time.monotonic() - start) * 1000, 1)
+        record = {
+            "version": RECORD_VERSION,
+            "source": self._source,
+            "recorded_at": datetime.now(tz=timezone.utc).isoformat(),
+            "request": {
+                "method": request.method,
+                "path": _relative_path(request.url, self._base_url),
+                "query": scrub_text(request.url.query.decode()),
+                "body": scrub_json(_request_body(request)),
+            },
+            "response": {
+                "status_code": response.status_code,
+                "content_type": response.headers.get("content-type"),
+                "latency_ms": latency_ms,
+            },
+        }
+
+        async def save(chunks: list[list]):
+            record["response"]["chunks"] = chunks
+            file_name = f"{self._source}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.json"
+            try:
+                async with aiofiles.open(os.path.join(self._record_dir, file_name), "w") as f:
+                    await f.write(json.dumps(record, ensure_ascii=False))
+            except Exception as e:
+                logger.warning(f"Failed to save upstream record {file_name}: {e}")
+
+        response.stream = _RecordingStream(response.stream, save)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: list[list], speed: float, translate: Callable[[str], str]):
+        self._chunks = chunks
+        self._speed = speed
+        self._translate = translate
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        start = time.monotonic()
+        for elapsed_ms, text in self._chunks:
+            if self._speed:
+                delay = elapsed_ms / 1000 / self._speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield self._translate(text).encode()
+
+    async def aclose(self):
+        pass
+
+
+def load_records(replay_dir: str, source: ChatSourceTypes) -> list[dict]:
+    records = []
+    for file_name in sorted(os.listdir(replay_dir)):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(replay_dir, file_name)) as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Failed to load upstream record {file_name}: {e}")
+            continue
+        if record.get("version") == RECORD_VERSION and record.get("source") == source:
+            records.append(record)
+    return records
+
+
+class _ReplayConversation:
+    """
+    回放中的一个新对话：新 id 与记录中的 id（对话和消息 id）的双向映射
+    """
+
+    def __init__(self):
+        self.to_new: dict[str, str] = {}  # 记录中的 id -> 新 id
+        self.to_recorded: dict[str, str] = {}  # 新 id -> 记录中的 id
+
+    def add(self, recorded_id: str, new_id: str):
+        self.to_new[recorded_id] = new_id
+        self.to_recorded[new_id] = recorded_id
+
+    def to_recorded_text(self, text: str) -> str:
+        return _UUID_PATTERN.sub(lambda match: self.to_recorded.get(match.group(0), match.group(0)), text)
+
+    def to_new_text(self, text: str) -> str:
+        def replace(match: re.Match) -> str:
+            recorded_id = match.group(0)
+            if recorded_id not in self.to_new:
+                self.add(recorded_id, str(uuid.uuid4()))
+            return self.to_new[recorded_id]
+
+        return _UUID_PATTERN.sub(replace, text)
+
+
+class UpstreamReplayTransport(httpx.AsyncBaseTransport):
+    """
+    按 (method, path) 匹配记录的回复并回放，同一请求有多条记录时轮流使用；没有记录时返回 404
+    每个新对话对应一组 uuid 映射：记录中的对话和消息 id 在回放给 chat() 时替换为新的 id，请求中的新 id 则映射回记录中的 id
+    对话被删除（隐藏）时丢弃其映射，最多保留 MAX_REPLAY_CONVERSATIONS 个对话
+    """
+
+    def __init__(self, source: ChatSourceTypes, base_url: str, replay_dir: str, speed: float):
+        self._base_url = base_url
+        self._speed = speed
+        self._records: dict[tuple[str, str], list[dict]] = {}
+        for record in load_records(replay_dir, source):
+            key = (record["request"]["method"], record["request"]["path"])
+            self._records.setdefault(key, []).append(record)
+        self._cycles = {key: itertools.cycle(records) for key, records in self._records.items()}
+        self._conversations: OrderedDict[str, _ReplayConversation] = OrderedDict()  # 新对话 id -> uuid 映射
+        logger.info(f"Loaded {sum(len(records) for records in self._records.values())} {source} upstream records "
+                    f"from {replay_dir}")
+
+    def _select_record(self, method: str, path: str, body: Any) -> dict | None:
+        records = self._records.get((method, path))
+        if not records:
+            return None
+        if isinstance(body, dict) and body.get("conversation_id"):
+            # 优先使用同一对话中、回复同一条消息的记录
+            for keys in (("conversation_id", "parent_message_id"), ("conversation_id",)):
+                for record in records:
+                    recorded_body = record["request"]["body"]
+                    if isinstance(recorded_body, dict) and all(recorded_body.get(key) == body.get(key)
+                                                               for key in keys):
+                        return record
+        return next(self._cycles[(method, path)])
+
+    def _add_conversation(self, conversation_id: str) -> _ReplayConversation:
+        conversation = _ReplayConversation()
+        self._conversations[conversation_id] = conversation
+        while len(self._conversations) > MAX_REPLAY_CONVERSATIONS:
+            self._conversations.popitem(last=False)
+        return conversation
+
+    def _get_conversation(self, request_path: str, request_body: Any) -> tuple[str | None, _ReplayConversation]:
+        """
+        找到请求所属的新对话及其 uuid 映射；请求中没有对话 id 时返回 (None, 空映射)
+        """
+        conversation_id = None
+        match = _UUID_PATTERN.search(request_path)
+        if match:
+            conversation_id = match.group(0)
+        elif isinstance(request_body, dict) and request_body.get("conversation_id"):
+            conversation_id = request_body["conversation_id"]
+        if conversation_id is None:
+            return None, _ReplayConversation()
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            conversation = self._add_conversation(conversation_id)
+        else:
+            self._conversations.move_to_end(conversation_id)
+        return conversation_id, conversation
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request_path = _relative_path(request.url, self._base_url)
+        body = _request_body(request)
+        conversation_id, conversation = self._get_conversation(request_path, body)
+        recorded_path = conversation.to_recorded_text(request_path)
+        recorded_body = json.loads(conversation.to_recorded_text(json.dumps(body))) if body is not None else None
+        record = self._select_record(request.method, recorded_path, recorded_body)
+        if record is None:
+            return httpx.Response(404, json={"detail": f"No recorded response for {request.method} {request_path}"},
+                                  request=request)
+        if conversation_id is None:
+            # 新建对话：记录中的对话 id 映射为新的对话 id
+            chunks_text = "".join(text for _, text in record["response"].get("chunks", []))
+            recorded_match = _CONVERSATION_ID_PATTERN.search(chunks_text)
+            if recorded_match is not None:
+                conversation_id = str(uuid.uuid4())
+                conversation = self._add_conversation(conversation_id)
+                conversation.add(recorded_match.group(1), conversation_id)
+        elif request.method == "DELETE" or (isinstance(body, dict) and body.get("is_visible") is False):
+            self._conversations.pop(conversation_id, None)
+        if self._speed:
+            await asyncio.sleep(record["response"].get("latency_ms", 0) / 1000 / self._speed)
+        headers = {}
+        if record["response"].get("content_type"):
+            headers["content-type"] = record["response"]["content_type"]
+        return httpx.Response(
+            record["response"]["status_code"],
+            headers=headers,
+            stream=_ReplayStream(record["response"].get("chunks", []), self._speed, conversation.to_new_text),
+            request=request,
+        )
+
+
+def make_upstream_transports(source: ChatSourceTypes, base_url: str, limits: httpx.Limits, http2: bool = False,
+                             proxy: str | None = None) -> dict[str, Any]:
+    """
+    根据 common.upstream_replay_dir / upstream_record_dir 返回传给 httpx.AsyncClient 的 transport 和 mounts 参数
+    （代替 proxies）；
+    不记录也不回放时返回空 dict
+    """
+    if config.common.upstream_replay_dir:
+        return {"transport": UpstreamReplayTransport(source, base_url, config.common.upstream_replay_dir,
+                                                     config.common.upstream_replay_speed)}
+    if not config.common.upstream_record_dir:
+        return {}
+
+    def make_transport(proxy_url: str | None = None) -> UpstreamRecordingTransport:
+        transport = httpx.AsyncHTTPTransport(http2=http2, limits=limits,
+                                             proxy=httpx.Proxy(proxy_url) if proxy_url else None)
+        return UpstreamRecordingTransport(transport, source, base_url, config.common.upstream_record_dir)
+
+    transports: dict[str, Any] = {"transport": make_transport()}
+    if proxy:
+        transports["mounts"] = {"http://": make_transport(proxy), "https://": make_transport(proxy)}
+    return transports
@@ -0,0 +1,82 @@
+import datetime
+
+from sqlalchemy import select, func, and_
+
+from api.database.sqlalchemy import get_async_session_context
+from api.enums import ChatSourceTypes
+from api.models.db import BaseConversation
+from api.schemas import UserReadAdmin
+from utils.common import singleton_with_lock
+
+
+class SourceLimits:
+    """
+    用户某一对话类型的权限快照，只包含管理员修改设置时才会变化的部分；剩余提问次数每次提问都会变化，不在其中
+    """
+
+    def __init__(self, source_setting):
+        self.allow_to_use: bool = source_setting.allow_to_use
+        self.valid_until: datetime.datetime | None = source_setting.valid_until
+        self.time_slots: tuple[tuple[datetime.time, datetime.time], ...] = tuple(
+            (time_slot.start_time, time_slot.end_time) for time_slot in source_setting.daily_available_time_slots or [])
+        self.available_models: frozenset[str] = frozenset(str(model) for model in source_setting.available_models)
+        self.max_conv_count: int = source_setting.max_conv_count
+
+    def is_available_at(self, now_time: datetime.time) -> bool:
+        return not self.time_slots or any(start <= now_time <= end for start, end in self.time_slots)
+
+
+@singleton_with_lock
+class UserLimitsCache:
+    """
+    提问前的限制检查所需数据的缓存：
+    - 每个用户各对话类型的权限快照，管理员修改用户设置时失效
+    - 每个用户各对话类型的有效对话数量，新建对话时加一，删除 / 失效 / 转移对话时失效，之后重新查询
+    """
+
+    def __init__(self):
+        self._snapshots: dict[int, dict[ChatSourceTypes, SourceLimits]] = {}
+        self._conv_counts: dict[tuple[int, ChatSourceTypes], int] = {}
+
+    def get_source_limits(self, user: UserReadAdmin, source: ChatSourceTypes) -> SourceLimits:
+        snapshot = self._snapshots.get(user.id)
+        if snapshot is None:
+            snapshot = {
+                ChatSourceTypes.openai_web: SourceLimits(user.setting.openai_web),
+                ChatSourceTypes.openai_api: SourceLimits(user.setting.openai_api),
+            }
+            self._snapshots[user.id] = snapshot
+        return snapshot[source]
+
+    def invalidate_user(self, user_id: int):
+        self._snapshots.pop(user_id, None)
+        self.invalidate_conv_count(user_id)
+
+    async def get_conv_count(self, user_id: int, source: ChatSourceTypes) -> int:
+        key = (user_id, source)
+        count = self._conv_counts.get(key)
+        if count is None:
+            # 使用 (user_id, source, is_valid) 索引
+            async with get_async_session_context() as session:
+                result = await session.execute(
+                    select(func.count(BaseConversation.id)).filter(
+                        and_(BaseConversation.user_id == user_id, BaseConversation.source == source,
+                             BaseConversation.is_valid)))
+                count = result.scalar()
+            self._conv_counts[key] = count
+        return count
+
+    def on_conversation_created(self, user_id: int, source: ChatSourceTypes):
+        key = (user_id, source)
+        if key in self._conv_counts:
+            self._conv_counts[key] += 1
+
+    def invalidate_conv_count(self, user_id: int | None = None):
+        """
+        user_id 为空时清空所有用户的对话数量
+        """
+        if user_id is None:
+            self._conv_counts.clear()
+            return
+        for source in ChatSourceTypes:
+            self._conv_counts.pop((user_id, source), None)
@@ -0,0 +1,46 @@
+"""
+离线基准测试，不需要 MongoDB 和网络（SQLite 数据库位于临时目录）；在 backend 目录下运行，例如：
+
+    python -m benchmarks.stream_text
+
+未设置 CWS_CONFIG_DIR 时，使用临时目录中的默认配置，进程退出时删除该目录
+"""
+import atexit
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable
+
+
+def setup_offline_config():
+    if os.environ.get("CWS_CONFIG_DIR"):
+        return
+    config_dir = tempfile.mkdtemp(prefix="cws-bench-")
+    atexit.register(shutil.rmtree, config_dir, ignore_errors=True)
+    with open(os.path.join(config_dir, "config.yaml"), "w") as f:
+        f.write(f"data:\n  data_dir: {config_dir}\n  database_url: sqlite+aiosqlite:///{config_dir}/database.db\n"
+                f"log:\n  console_log_level: WARNING\n")
+    with open(os.path.join(config_dir, "credentials.yaml"), "w") as f:
+        f.write("openai_api_key: sk-bench\n")
+    os.environ["CWS_CONFIG_DIR"] = config_dir
+
+
+def timeit(func: Callable, repeat: int = 5) -> float:
+    """
+    返回 repeat 次中最快一次的耗时（秒）
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def print_results(title: str, rows: list[tuple[str, float]]):
+    print(f"\n{title}")
+    width = max(len(name) for name, _ in rows)
+    for name, seconds in rows:
+        print(f"  {name.ljust(width)}  {seconds * 1000:10.2f} ms")
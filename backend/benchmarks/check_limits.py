@@ -0,0 +1,103 @@
+"""
+提问前限制检查（check_limits）的基准：SQLite 中有 USER_COUNT 个用户、每人 CONVERSATIONS_PER_USER 个对话
+- 有效对话数量查询在不使用 / 使用 (user_id, source, is_valid) 索引时的耗时
+- check_limits 在缓存失效（每次都查询数量、重建权限快照）和命中缓存时的耗时
+"""
+from benchmarks import setup_offline_config
+
+setup_offline_config()
+
+import asyncio
+import datetime
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from sqlalchemy import insert, text
+
+from api.database.sqlalchemy import initialize_db, get_async_session_context
+from api.enums import ChatSourceTypes, OpenaiApiChatModels
+from api.models.db import BaseConversation
+from api.routers.chat import check_limits
+from api.schemas import AskRequest, UserReadAdmin, UserSettingSchema
+from api.user_limits import UserLimitsCache
+
+USER_COUNT = 200
+CONVERSATIONS_PER_USER = 50
+ITERATIONS = 2000
+
+
+async def prepare_database():
+    await initialize_db()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    rows = [{
+        "source": ChatSourceTypes.openai_api if index % 2 else ChatSourceTypes.openai_web,
+        "conversation_id": uuid.uuid4(),
+        "title": "bench",
+        "user_id": user_id,
+        "is_valid": index % 5 != 0,
+        "create_time": now,
+        "update_time": now,
+    } for user_id in range(1, USER_COUNT + 1) for index in range(CONVERSATIONS_PER_USER)]
+    async with get_async_session_context() as session:
+        await session.execute(insert(BaseConversation), rows)
+        await session.commit()
+
+
+def make_user() -> UserReadAdmin:
+    setting = UserSettingSchema.unlimited()
+    setting.openai_api.max_conv_count = CONVERSATIONS_PER_USER * 2
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return UserReadAdmin(id=USER_COUNT // 2, username="bench", nickname="bench", email="bench@example.com",
+                         last_active_time=now, create_time=now, avatar=None, remark=None, is_superuser=False,
+                         is_active=True, is_verified=True, setting=setting)
+
+
+async def measure(func: Callable[[], Awaitable], iterations: int = ITERATIONS) -> float:
+    """
+    返回平均每次调用的耗时（秒）
+    """
+    await func()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await func()
+    return (time.perf_counter() - start) / iterations
+
+
+async def main():
+    await prepare_database()
+    user = make_user()
+    ask_request = AskRequest(source=ChatSourceTypes.openai_api, model=OpenaiApiChatModels.gpt_3_5,
+                             new_conversation=True, text_content="hello")
+    user_limits_cache = UserLimitsCache()
+
+    def count_query(hint: str):
+        async def run():
+            async with get_async_session_context() as session:
+                await session.execute(
+                    text(f"SELECT count(id) FROM conversation {hint} "
+                         "WHERE user_id = :user_id AND source = :source AND is_valid"),
+                    {"user_id": user.id, "source": ChatSourceTypes.openai_api.name})
+        return run
+
+    async def check_limits_uncached():
+        user_limits_cache.invalidate_user(user.id)
+        await check_limits(user, ask_request)
+
+    async def check_limits_cached():
+        await check_limits(user, ask_request)
+
+    rows = [
+        ("count query, NOT INDEXED", await measure(count_query("NOT INDEXED"), ITERATIONS // 10)),
+        ("count query, (user_id, source, is_valid) index", await measure(count_query(""))),
+        ("check_limits, cache invalidated every call", await measure(check_limits_uncached)),
+        ("check_limits, cached", await measure(check_limits_cached)),
+    ]
+    print(f"\ncheck_limits ({USER_COUNT} users x {CONVERSATIONS_PER_USER} conversations)")
+    width = max(len(name) for name, _ in rows)
+    for name, seconds in rows:
+        print(f"  {name.ljust(width)}  {seconds * 1e6:10.1f} us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
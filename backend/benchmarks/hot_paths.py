@@ -0,0 +1,198 @@
+"""
+消息转换和流式转发热点路径的微基准，使用与 ChatGPT / OpenAI 返回结构相同的合成数据：
+
+    python -m benchmarks.hot_paths --output hot_paths.json --baseline last_hot_paths.json
+
+每项报告 ops/sec（多轮中最快的一轮）和单次调用的内存分配峰值（tracemalloc），结果可写入 JSON，与之前的报告对比
+"""
+from benchmarks import setup_offline_config
+
+setup_offline_config()
+
+import argparse
+import json
+import subprocess
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+from typing import Callable
+
+from fastapi.encoders import jsonable_encoder
+
+from api.ask_stream import AskResponseDeltaEncoder
+from api.schemas import AskResponse, AskResponseType
+from api.schemas.openai_schemas import OpenaiChatResponse
+from api.sources import convert_revchatgpt_message, convert_revchatgpt_message_to_json, convert_mapping, \
+    get_latest_model_from_mapping
+
+REPLY_TEXT = "The quick brown fox jumps over the lazy dog. " * 40  # 约 1800 字符
+MAPPING_SIZES = (50, 500, 5000)
+
+
+def make_web_item(message_id: str, role: str, text: str, parent: str | None, model_slug: str | None = None) -> dict:
+    """
+    与 ChatGPT conversation 接口的 SSE 帧 / conversation/{id} 的 mapping 节点结构相同
+    """
+    metadata = {"message_type": "next", "parent_id": parent, "timestamp_": "absolute"}
+    if model_slug:
+        metadata.update({"model_slug": model_slug, "finish_details": {"type": "stop", "stop_tokens": [100260]}})
+    return {
+        "id": message_id,
+        "message": {
+            "id": message_id,
+            "author": {"role": role, "name": None, "metadata": {}},
+            "create_time": 1700000000.123,
+            "update_time": None,
+            "content": {"content_type": "text", "parts": [text]},
+            "status": "finished_successfully",
+            "end_turn": True if role == "assistant" else None,
+            "weight": 1.0,
+            "metadata": metadata,
+            "recipient": "all",
+        },
+        "parent": parent,
+        "children": [],
+        "conversation_id": "4f1b5d6e-0c6a-4d0e-9a55-3c1f0e9f7a11",
+        "error": None,
+    }
+
+
+def make_mapping(size: int) -> tuple[dict[str, dict], str]:
+    """
+    一条从根节点开始、用户和助手交替的分支，返回 (mapping, current_node)
+    """
+    mapping = {}
+    parent = None
+    for index in range(size):
+        node_id = str(uuid.UUID(int=index + 1))
+        role = "user" if index % 2 == 0 else "assistant"
+        text = REPLY_TEXT if role == "assistant" else "Please explain this in detail."
+        node = make_web_item(node_id, role, text, parent, "text-davinci-002-render-sha" if role == "assistant" else None)
+        node.pop("conversation_id")
+        node.pop("error")
+        mapping[node_id] = node
+        if parent is not None:
+            mapping[parent]["children"].append(node_id)
+        parent = node_id
+    return mapping, parent
+
+
+def make_api_line() -> str:
+    return json.dumps({"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000,
+                       "model": "gpt-3.5-turbo",
+                       "choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": None}]})
+
+
+def measure(func: Callable, min_time: float = 0.2, rounds: int = 5) -> dict:
+    """
+    先估计一轮需要的调用次数（至少 min_time 秒），取 rounds 轮中最快的一轮计算 ops/sec；
+    再用 tracemalloc 单独测量一次调用的内存分配峰值
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+    best = elapsed
+    for _ in range(rounds - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"ops_per_sec": number / best, "peak_kib": peak / 1024}
+
+
+def build_cases() -> dict[str, Callable]:
+    web_item = make_web_item(str(uuid.uuid4()), "assistant", REPLY_TEXT, str(uuid.uuid4()),
+                             "text-davinci-002-render-sha")
+    cases = {
+        "convert_revchatgpt_message": lambda: convert_revchatgpt_message(web_item),
+        "convert_revchatgpt_message_to_json": lambda: convert_revchatgpt_message_to_json(web_item),
+    }
+    for size in MAPPING_SIZES:
+        mapping, current_node = make_mapping(size)
+        converted = convert_mapping(mapping)
+        cases[f"convert_mapping[{size}]"] = lambda mapping=mapping: convert_mapping(mapping)
+        cases[f"get_latest_model_from_mapping[{size}]"] = \
+            lambda current_node=current_node, converted=converted: get_latest_model_from_mapping(current_node,
+                                                                                                  converted)
+
+    api_line = make_api_line()
+
+    def parse_with_dict():
+        line = json.loads(api_line)
+        choice = (line.get("choices") or [{}])[0]
+        return (choice.get("delta") or {}).get("content"), choice.get("finish_reason"), line.get("usage")
+
+    cases["OpenaiChatResponse.parse_raw(line)"] = lambda: OpenaiChatResponse.parse_raw(api_line)
+    cases["json.loads(line) field extraction"] = parse_with_dict
+
+    message = convert_revchatgpt_message(web_item)
+    message_json = convert_revchatgpt_message_to_json(web_item)
+    response = AskResponse(type=AskResponseType.message, conversation_id=uuid.uuid4(), message=message)
+    raw_response = AskResponse.construct(type=AskResponseType.message, conversation_id=response.conversation_id,
+                                         message=message_json)
+    cases["jsonable_encoder(AskResponse)"] = lambda: jsonable_encoder(response)
+    cases["jsonable_encoder(AskResponse.construct raw)"] = lambda: jsonable_encoder(raw_response)
+
+    delta_encoder = AskResponseDeltaEncoder(snapshot_interval=1000000)
+    delta_encoder.encode(response)
+    cases["AskResponseDeltaEncoder.encode"] = lambda: delta_encoder.encode(response)
+    return cases
+
+
+def compare_reports(baseline: dict, report: dict):
+    print(f"\ncompared with baseline {baseline['meta'].get('revision')} ({baseline['meta'].get('time')})")
+    for name, result in report["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        ops_change = (result["ops_per_sec"] - old["ops_per_sec"]) / old["ops_per_sec"] * 100
+        print(f"  {name}: {old['ops_per_sec']:.0f} -> {result['ops_per_sec']:.0f} ops/s ({ops_change:+.1f}%), "
+              f"peak {old['peak_kib']:.1f} -> {result['peak_kib']:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for message conversion and streaming hot paths")
+    parser.add_argument("--filter", help="only run cases whose name contains this string")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per round")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="previous JSON results to compare with")
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in build_cases().items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(func, min_time=args.min_time)
+        print(f"  {name.ljust(48)} {results[name]['ops_per_sec']:14,.0f} ops/s  "
+              f"{results[name]['peak_kib']:10.1f} KiB peak")
+
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  timeout=5).stdout.strip() or None
+    except Exception:
+        revision = None
+    report = {"meta": {"time": datetime.now(tz=timezone.utc).isoformat(), "revision": revision},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+/chat websocket 的端到端压测：登录 N 个用户，每个用户依次提问（新对话或继续之前的对话），统计
+首 token 时间、每秒帧数、排队时间、端到端耗时的分位数，以及服务端进程的 CPU / 内存占用，结果写入 JSON 报告
+
+上游可使用 benchmarks.mock_upstream，例如：
+
+    python -m benchmarks.mock_upstream --port 8900
+    python main.py  # chatgpt_base_url / openai_base_url 指向 mock_upstream
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --admin-username admin --admin-password password \\
+        --users 20 --asks-per-user 5 --source openai_api --model gpt_3_5 --server-pid <pid> \\
+        --output report.json --baseline last_report.json
+
+压测用户（默认 loadtest_0 ~ loadtest_{N-1}）不存在时由管理员创建，并设置为不限制提问次数
+"""
+from benchmarks import setup_offline_config
+
+setup_offline_config()
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+import websockets
+from fastapi.encoders import jsonable_encoder
+
+from api.schemas import UserSettingSchema
+
+COOKIE_NAME = "cws_user_auth"
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+
+class AskResult:
+    def __init__(self, user: str, is_new: bool):
+        self.user = user
+        self.is_new = is_new
+        self.ok = False
+        self.error: Optional[str] = None
+        self.queue_wait: Optional[float] = None  # 发出提问到收到 waiting（离开排队）的时间
+        self.ttft: Optional[float] = None  # 发出提问到收到第一个 message 帧的时间
+        self.e2e: Optional[float] = None  # 发出提问到连接关闭的时间
+        self.message_frames = 0
+        self.fps: Optional[float] = None
+
+
+class ProcessSampler:
+    """
+    每秒采样一次服务端进程的 CPU 占用和常驻内存；优先使用 psutil，否则读取 /proc（仅 Linux）
+    """
+
+    def __init__(self, pid: int, interval: float = 1.0):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_percent: list[float] = []
+        self.rss_mb: list[float] = []
+        try:
+            import psutil
+            self._process = psutil.Process(pid)
+        except ImportError:
+            self._process = None
+
+    def _read_proc(self) -> tuple[float, float]:
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{self.pid}/status") as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        return cpu_seconds, rss_kb / 1024
+
+    async def run(self):
+        if self._process is not None:
+            self._process.cpu_percent()
+        else:
+            last_cpu, _ = self._read_proc()
+            last_time = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._process is not None:
+                self.cpu_percent.append(self._process.cpu_percent())
+                self.rss_mb.append(self._process.memory_info().rss / 1024 / 1024)
+            else:
+                cpu, rss = self._read_proc()
+                now = time.monotonic()
+                self.cpu_percent.append((cpu - last_cpu) / (now - last_time) * 100)
+                self.rss_mb.append(rss)
+                last_cpu, last_time = cpu, now
+
+    def report(self) -> dict:
+        return {"pid": self.pid, "cpu_percent": summarize(self.cpu_percent), "rss_mb": summarize(self.rss_mb)}
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.base_url = args.url.rstrip("/") + "/"
+        self.ws_url = self.base_url.replace("http", "ws", 1) + "chat"
+        self.results: list[AskResult] = []
+
+    async def _api(self, client: httpx.AsyncClient, method: str, path: str, **kwargs):
+        response = await client.request(method, self.base_url + path, **kwargs)
+        body = response.json()
+        if response.status_code != 200 or body.get("code") != 200:
+            raise RuntimeError(f"{method} {path} failed: {response.status_code} {body}")
+        return body.get("result")
+
+    async def login(self, username: str, password: str) -> httpx.AsyncClient:
+        client = httpx.AsyncClient(timeout=30)
+        await self._api(client, "POST", "auth/login", data={"username": username, "password": password})
+        return client
+
+    async def prepare_users(self) -> list[tuple[str, str]]:
+        """
+        创建不存在的压测用户，并设置为不限制提问次数
+        """
+        users = [(f"{self.args.user_prefix}{i}", self.args.user_password) for i in range(self.args.users)]
+        admin = await self.login(self.args.admin_username, self.args.admin_password)
+        try:
+            existing = {user["username"]: user["id"] for user in await self._api(admin, "GET", "user")}
+            setting = jsonable_encoder(UserSettingSchema.unlimited())
+            for username, password in users:
+                user_id = existing.get(username)
+                if user_id is None:
+                    user = await self._api(admin, "POST", "auth/register", json={
+                        "username": username, "nickname": username, "email": f"{username}@example.com",
+                        "password": password})
+                    user_id = user["id"]
+                await self._api(admin, "PATCH", f"user/{user_id}/setting", json=setting)
+        finally:
+            await admin.aclose()
+        return users
+
+    async def ask(self, cookie: str, request: dict, result: AskResult) -> tuple[Optional[str], Optional[str]]:
+        """
+        完成一次提问，返回 (conversation_id, 最后一条消息的 id)，用于继续对话
+        """
+        conversation_id, message_id = None, None
+        first_frame_time, last_frame_time = None, None
+        start = time.monotonic()
+        try:
+            async with websockets.connect(self.ws_url, extra_headers={"Cookie": f"{COOKIE_NAME}={cookie}"},
+                                          max_size=None) as ws:
+                await ws.send(json.dumps(request))
+                async for raw in ws:
+                    now = time.monotonic()
+                    frame = json.loads(raw)
+                    if frame["type"] == "waiting":
+                        result.queue_wait = now - start
+                    elif frame["type"] in ("message", "message_delta"):
+                        if first_frame_time is None:
+                            first_frame_time = now
+                            result.ttft = now - start
+                        last_frame_time = now
+                        result.message_frames += 1
+                        conversation_id = frame.get("conversation_id") or conversation_id
+                        if frame.get("message"):
+                            message_id = frame["message"]["id"]
+                    elif frame["type"] == "error":
+                        result.error = frame.get("tip") or frame.get("error_detail") or "error"
+            if ws.close_code != 1000 and result.error is None:
+                result.error = f"closed {ws.close_code} {ws.close_reason}"
+        except Exception as e:
+            result.error = f"{e.__class__.__name__}: {e}"
+        result.e2e = time.monotonic() - start
+        result.ok = result.error is None and first_frame_time is not None
+        if first_frame_time is not None and last_frame_time > first_frame_time:
+            result.fps = (result.message_frames - 1) / (last_frame_time - first_frame_time)
+        return conversation_id, message_id
+
+    async def run_user(self, username: str, password: str):
+        client = await self.login(username, password)
+        cookie = client.cookies.get(COOKIE_NAME)
+        await client.aclose()
+        conversations: list[tuple[str, str]] = []
+        for index in range(self.args.asks_per_user):
+            is_new = not conversations or random.random() >= self.args.continue_ratio
+            request = {
+                "source": self.args.source,
+                "model": self.args.model,
+                "new_conversation": is_new,
+                "text_content": f"load test {username} #{index}: {self.args.prompt}",
+            }
+            if is_new:
+                request["new_title"] = f"load test {username} #{index}"
+                slot = None
+            else:
+                slot = random.randrange(len(conversations))
+                request["conversation_id"], request["parent"] = conversations[slot]
+            result = AskResult(username, is_new)
+            self.results.append(result)
+            conversation_id, message_id = await self.ask(cookie, request, result)
+            if result.ok and conversation_id and message_id:
+                if slot is None:
+                    conversations.append((conversation_id, message_id))
+                else:
+                    conversations[slot] = (conversation_id, message_id)
+            if self.args.think_time:
+                await asyncio.sleep(random.uniform(0, 2 * self.args.think_time))
+
+    async def run(self) -> dict:
+        users = await self.prepare_users()
+        sampler = ProcessSampler(self.args.server_pid) if self.args.server_pid else None
+        sampler_task = asyncio.create_task(sampler.run()) if sampler else None
+        start = time.monotonic()
+        try:
+            await asyncio.gather(*(self.run_user(username, password) for username, password in users))
+        finally:
+            if sampler_task:
+                sampler_task.cancel()
+        duration = time.monotonic() - start
+        return self.make_report(duration, sampler)
+
+    def make_report(self, duration: float, sampler: Optional[ProcessSampler]) -> dict:
+        succeeded = [result for result in self.results if result.ok]
+        errors: dict[str, int] = {}
+        for result in self.results:
+            if not result.ok:
+                errors[result.error or "no reply"] = errors.get(result.error or "no reply", 0) + 1
+        try:
+            revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                      timeout=5).stdout.strip() or None
+        except Exception:
+            revision = None
+        return {
+            "meta": {
+                "time": datetime.now(tz=timezone.utc).isoformat(),
+                "revision": revision,
+                "url": self.args.url,
+                "source": self.args.source,
+                "model": self.args.model,
+                "users": self.args.users,
+                "asks_per_user": self.args.asks_per_user,
+                "continue_ratio": self.args.continue_ratio,
+            },
+            "summary": {
+                "duration": duration,
+                "asks": len(self.results),
+                "succeeded": len(succeeded),
+                "failed": len(self.results) - len(succeeded),
+                "new_conversation_asks": sum(1 for result in self.results if result.is_new),
+                "asks_per_second": len(succeeded) / duration if duration else None,
+                "errors": errors,
+            },
+            "ttft": summarize([result.ttft for result in succeeded]),
+            "queue_wait": summarize([result.queue_wait for result in succeeded if result.queue_wait is not None]),
+            "e2e": summarize([result.e2e for result in succeeded]),
+            "fps": summarize([result.fps for result in succeeded if result.fps is not None]),
+            "server": sampler.report() if sampler else None,
+        }
+
+
+def compare_reports(baseline: dict, report: dict):
+    """
+    打印与 baseline 报告相比的变化
+    """
+    print(f"\ncompared with baseline {baseline['meta'].get('revision')} ({baseline['meta'].get('time')})")
+    for section in ("ttft", "queue_wait", "e2e", "fps"):
+        for key in ("p50", "p90", "p99"):
+            old, new = (baseline.get(section) or {}).get(key), (report.get(section) or {}).get(key)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0
+            print(f"  {section}.{key}: {old:.3f} -> {new:.3f} ({change:+.1f}%)")
+    old, new = baseline["summary"].get("asks_per_second"), report["summary"].get("asks_per_second")
+    if old and new:
+        print(f"  asks_per_second: {old:.2f} -> {new:.2f} ({(new - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the /chat websocket")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="backend base url")
+    parser.add_argument("--admin-username", required=True)
+    parser.add_argument("--admin-password", required=True)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--user-prefix", default="loadtest_")
+    parser.add_argument("--user-password", default="loadtest-password")
+    parser.add_argument("--asks-per-user", type=int, default=5)
+    parser.add_argument("--continue-ratio", type=float, default=0.5, help="probability of continuing a conversation")
+    parser.add_argument("--think-time", type=float, default=0, help="mean seconds between asks of a user")
+    parser.add_argument("--source", choices=["openai_web", "openai_api"], default="openai_api")
+    parser.add_argument("--model", default="gpt_3_5")
+    parser.add_argument("--prompt", default="Please write a short paragraph about load testing.")
+    parser.add_argument("--server-pid", type=int, help="pid of the backend process to sample CPU / memory")
+    parser.add_argument("--output", default="load_test_report.json")
+    parser.add_argument("--baseline", help="previous report to compare with")
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadTest(args).run())
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["summary"], indent=2))
+    for section in ("ttft", "queue_wait", "e2e", "fps"):
+        stats = report[section]
+        if stats["count"]:
+            print(f"{section}: p50={stats['p50']:.3f} p90={stats['p90']:.3f} p99={stats['p99']:.3f}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_reports(json.load(f), report)
+    print(f"\nreport written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
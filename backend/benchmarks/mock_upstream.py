@@ -0,0 +1,380 @@
+"""
+模拟 ChatGPT Web 和 OpenAI API 的上游服务器，用于离线压测和性能回归，不需要真实账号：
+
+    python -m benchmarks.mock_upstream --port 8900 --tokens-per-second 50 --first-token-latency-ms 300 \\
+        --error-rate 0.01 --rate-limit-rate 0.05
+
+然后在 config.yaml 中设置：
+
+    openai_web:
+      chatgpt_base_url: http://127.0.0.1:8900/backend-api/
+    openai_api:
+      openai_base_url: http://127.0.0.1:8900/v1/
+
+实现了 OpenaiWebChatManager 和 OpenaiApiChatManager 调用的接口：conversation（SSE）、conversations、
+conversation/{id}、gen_title、aip/p、files 以及 chat/completions；对话保存在内存中，重启后清空
+GET /mock/stats 返回请求计数，POST /mock/options 可在运行时修改参数
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request, APIRouter
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from pydantic import BaseModel, Field
+
+FILLER_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do",
+                "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore", "magna", "aliqua"]
+
+
+class MockUpstreamOptions(BaseModel):
+    tokens_per_second: float = Field(50, ge=0)  # 每个回复的生成速度，0 表示不等待
+    first_token_latency_ms: int = Field(300, ge=0)  # 收到请求到返回第一个 token 的延迟
+    reply_tokens: int = Field(200, ge=1)  # 每个回复的 token 数
+    error_rate: float = Field(0, ge=0, le=1)  # 返回 500 的概率
+    rate_limit_rate: float = Field(0, ge=0, le=1)  # 返回 429 的概率
+    retry_after: Optional[int] = Field(None, ge=0)  # 429 时返回的 Retry-After 头
+    model_slug: str = "text-davinci-002-render-sha"  # ChatGPT Web 回复中的 model_slug
+
+
+class MockStats(BaseModel):
+    requests: int = 0
+    active_streams: int = 0
+    completed_streams: int = 0
+    rate_limited: int = 0
+    errors: int = 0
+    tokens: int = 0
+
+
+def _reply_tokens(prompt: str, count: int) -> list[str]:
+    tokens = [f"echo: {prompt[:40]}"] + [FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(count - 1)]
+    return [token + " " for token in tokens]
+
+
+def _now() -> float:
+    return time.time()
+
+
+def _iso_time(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + f".{int(timestamp % 1 * 1e6):06d}+00:00"
+
+
+class MockChatGPTState:
+    """
+    内存中的 ChatGPT Web 对话，mapping 的结构与 ChatGPT 的 conversation/{id} 接口相同
+    """
+
+    def __init__(self):
+        self.conversations: dict[str, dict] = {}
+        self.files: dict[str, dict] = {}
+
+    def create_conversation(self, title: str = "New chat") -> dict:
+        conversation_id = str(uuid.uuid4())
+        root_id = str(uuid.uuid4())
+        conversation = {
+            "id": conversation_id,
+            "title": title,
+            "create_time": _now(),
+            "update_time": _now(),
+            "mapping": {root_id: {"id": root_id, "message": None, "parent": None, "children": []}},
+            "current_node": root_id,
+            "moderation_results": [],
+            "is_visible": True,
+        }
+        self.conversations[conversation_id] = conversation
+        return conversation
+
+    def add_node(self, conversation: dict, message: dict, parent: str):
+        mapping = conversation["mapping"]
+        mapping[message["id"]] = {"id": message["id"], "message": message, "parent": parent, "children": []}
+        mapping[parent]["children"].append(message["id"])
+        conversation["current_node"] = message["id"]
+        conversation["update_time"] = _now()
+
+    def visible_conversations(self) -> list[dict]:
+        conversations = [conv for conv in self.conversations.values() if conv["is_visible"]]
+        return sorted(conversations, key=lambda conv: conv["update_time"], reverse=True)
+
+
+def create_app(options: MockUpstreamOptions = None) -> FastAPI:
+    app = FastAPI()
+    app.state.options = options or MockUpstreamOptions()
+    app.state.stats = MockStats()
+    state = MockChatGPTState()
+    web = APIRouter(prefix="/backend-api")
+    api = APIRouter(prefix="/v1")
+
+    def get_options() -> MockUpstreamOptions:
+        return app.state.options
+
+    def inject_fault() -> Response | None:
+        stats: MockStats = app.state.stats
+        opts = get_options()
+        stats.requests += 1
+        if opts.rate_limit_rate and random.random() < opts.rate_limit_rate:
+            stats.rate_limited += 1
+            headers = {"Retry-After": str(opts.retry_after)} if opts.retry_after is not None else None
+            return JSONResponse({"detail": "Too many requests (mock)"}, status_code=429, headers=headers)
+        if opts.error_rate and random.random() < opts.error_rate:
+            stats.errors += 1
+            return JSONResponse({"detail": "Internal server error (mock)"}, status_code=500)
+        return None
+
+    async def generate_tokens(prompt: str):
+        """
+        按 first_token_latency_ms 和 tokens_per_second 产生回复的 token
+        """
+        opts = get_options()
+        stats: MockStats = app.state.stats
+        await asyncio.sleep(opts.first_token_latency_ms / 1000)
+        interval = 1 / opts.tokens_per_second if opts.tokens_per_second else 0
+        stats.active_streams += 1
+        try:
+            for index, token in enumerate(_reply_tokens(prompt, opts.reply_tokens)):
+                if index and interval:
+                    await asyncio.sleep(interval)
+                stats.tokens += 1
+                yield token
+            stats.completed_streams += 1
+        finally:
+            stats.active_streams -= 1
+
+    @app.get("/mock/stats", response_model=MockStats)
+    async def get_stats():
+        return app.state.stats
+
+    @app.get("/mock/options", response_model=MockUpstreamOptions)
+    async def get_mock_options():
+        return get_options()
+
+    @app.post("/mock/options", response_model=MockUpstreamOptions)
+    async def update_mock_options(update: dict):
+        app.state.options = MockUpstreamOptions(**{**get_options().dict(), **update})
+        return app.state.options
+
+    # ChatGPT Web
+
+    @web.post("/conversation")
+    async def ask_conversation(request: Request):
+        data = json.loads(await request.body())
+        if fault := inject_fault():
+            return fault
+        if data.get("conversation_id"):
+            conversation = state.conversations.get(data["conversation_id"])
+            if conversation is None:
+                return JSONResponse({"detail": "Conversation not found"}, status_code=404)
+        else:
+            conversation = state.create_conversation()
+        parent = data.get("parent_message_id") or conversation["current_node"]
+        if parent not in conversation["mapping"]:
+            parent = conversation["current_node"]
+
+        prompt = ""
+        if data.get("action") != "continue":
+            user_message = data["messages"][0]
+            parts = user_message["content"].get("parts") or [""]
+            prompt = parts[-1] if isinstance(parts[-1], str) else ""
+            state.add_node(conversation, {
+                "id": user_message["id"],
+                "author": {"role": "user", "name": None, "metadata": {}},
+                "create_time": _now(),
+                "content": user_message["content"],
+                "status": "finished_successfully",
+                "end_turn": None,
+                "weight": 1.0,
+                "metadata": user_message.get("metadata") or {},
+                "recipient": "all",
+            }, parent)
+            parent = user_message["id"]
+
+        reply_message = {
+            "id": str(uuid.uuid4()),
+            "author": {"role": "assistant", "name": None, "metadata": {}},
+            "create_time": _now(),
+            "update_time": None,
+            "content": {"content_type": "text", "parts": [""]},
+            "status": "in_progress",
+            "end_turn": None,
+            "weight": 1.0,
+            "metadata": {"message_type": "next", "model_slug": get_options().model_slug, "parent_id": parent},
+            "recipient": "all",
+        }
+
+        async def event_stream():
+            text = ""
+            async for token in generate_tokens(prompt):
+                text += token
+                reply_message["content"] = {"content_type": "text", "parts": [text]}
+                yield f"data: {json.dumps({'message': reply_message, 'conversation_id': conversation['id'], 'error': None})}\n\n"
+            reply_message["status"] = "finished_successfully"
+            reply_message["end_turn"] = True
+            reply_message["metadata"]["finish_details"] = {"type": "stop", "stop_tokens": [100260]}
+            state.add_node(conversation, reply_message, parent)
+            yield f"data: {json.dumps({'message': reply_message, 'conversation_id': conversation['id'], 'error': None})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    @web.get("/conversations")
+    async def get_conversations(offset: int = 0, limit: int = 20):
+        if fault := inject_fault():
+            return fault
+        conversations = state.visible_conversations()
+        items = [{
+            "id": conv["id"],
+            "title": conv["title"],
+            "create_time": _iso_time(conv["create_time"]),
+            "update_time": _iso_time(conv["update_time"]),
+        } for conv in conversations[offset:offset + limit]]
+        return {"items": items, "total": len(conversations), "limit": limit, "offset": offset}
+
+    @web.patch("/conversations")
+    async def hide_all_conversations(data: dict):
+        for conv in state.conversations.values():
+            conv["is_visible"] = data.get("is_visible", conv["is_visible"])
+        return {"success": True}
+
+    @web.get("/conversation/{conversation_id}")
+    async def get_conversation(conversation_id: str):
+        if fault := inject_fault():
+            return fault
+        conversation = state.conversations.get(conversation_id)
+        if conversation is None or not conversation["is_visible"]:
+            return JSONResponse({"detail": "Can't load conversation"}, status_code=404)
+        return {key: value for key, value in conversation.items() if key not in ("id", "is_visible")}
+
+    @web.patch("/conversation/{conversation_id}")
+    async def update_conversation(conversation_id: str, data: dict):
+        conversation = state.conversations.get(conversation_id)
+        if conversation is None:
+            return JSONResponse({"detail": "Conversation not found"}, status_code=404)
+        for key in ("title", "is_visible"):
+            if key in data:
+                conversation[key] = data[key]
+        return {"success": True}
+
+    @web.post("/conversation/gen_title/{conversation_id}")
+    async def generate_title(conversation_id: str, data: dict):
+        conversation = state.conversations.get(conversation_id)
+        if conversation is None:
+            return JSONResponse({"detail": "Conversation not found"}, status_code=404)
+        conversation["title"] = f"Mock chat {conversation_id[:8]}"
+        return {"title": conversation["title"]}
+
+    @web.get("/conversation/{conversation_id}/interpreter")
+    async def get_interpreter_info(conversation_id: str):
+        return {"kernel_started": False, "time_remaining_ms": 0}
+
+    @web.get("/aip/p")
+    async def get_plugins(offset: int = 0, limit: int = 250):
+        return {"items": [], "count": 0}
+
+    @web.patch("/aip/p/{plugin_id}/user-settings")
+    async def update_plugin_settings(plugin_id: str):
+        return JSONResponse({"detail": f"Plugin {plugin_id} not found"}, status_code=404)
+
+    @web.post("/files")
+    async def create_file_upload(request: Request, data: dict):
+        file_id = f"file-{uuid.uuid4().hex}"
+        state.files[file_id] = {"name": data.get("file_name"), "uploaded": False}
+        return {"status": "success", "upload_url": str(request.url_for("upload_file", file_id=file_id)),
+                "file_id": file_id}
+
+    @web.post("/files/{file_id}/uploaded")
+    async def check_file_uploaded(request: Request, file_id: str):
+        if not state.files.get(file_id, {}).get("uploaded"):
+            return {"status": "error", "error_code": "file_not_uploaded", "error_message": "File not uploaded"}
+        return {"status": "success", "download_url": str(request.url_for("download_file", file_id=file_id))}
+
+    @web.get("/files/{file_id}/download")
+    async def get_file_download_url(request: Request, file_id: str):
+        if file_id not in state.files:
+            return {"status": "error", "error_code": "file_not_found", "error_message": "File not found"}
+        return {"status": "success", "download_url": str(request.url_for("download_file", file_id=file_id))}
+
+    @app.put("/mock-blob/{file_id}", name="upload_file")
+    async def upload_file(file_id: str, request: Request):
+        if file_id not in state.files:
+            return Response(status_code=404)
+        state.files[file_id]["content"] = await request.body()
+        state.files[file_id]["uploaded"] = True
+        return Response(status_code=201)
+
+    @app.get("/mock-blob/{file_id}", name="download_file")
+    async def download_file(file_id: str):
+        if not state.files.get(file_id, {}).get("uploaded"):
+            return Response(status_code=404)
+        return Response(content=state.files[file_id]["content"], media_type="application/octet-stream")
+
+    # OpenAI API
+
+    @api.post("/chat/completions")
+    async def chat_completions(data: dict):
+        if fault := inject_fault():
+            return fault
+        messages = data.get("messages") or [{}]
+        prompt = messages[-1].get("content") or ""
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(_now())
+        prompt_tokens = sum(len(str(msg.get("content") or "").split()) for msg in messages)
+
+        def make_chunk(delta: dict, finish_reason: str | None) -> str:
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                     "model": data.get("model"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        if not data.get("stream"):
+            text = "".join([token async for token in generate_tokens(prompt)])
+            return {"id": completion_id, "object": "chat.completion", "created": created, "model": data.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": get_options().reply_tokens,
+                              "total_tokens": prompt_tokens + get_options().reply_tokens}}
+
+        async def event_stream():
+            yield make_chunk({"role": "assistant", "content": ""}, None)
+            async for token in generate_tokens(prompt):
+                yield make_chunk({"content": token}, None)
+            yield make_chunk({}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    app.include_router(web)
+    app.include_router(api)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock ChatGPT Web / OpenAI API upstream server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    defaults = MockUpstreamOptions()
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--first-token-latency-ms", type=int, default=defaults.first_token_latency_ms)
+    parser.add_argument("--reply-tokens", type=int, default=defaults.reply_tokens)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate)
+    parser.add_argument("--retry-after", type=int, default=defaults.retry_after)
+    parser.add_argument("--model-slug", default=defaults.model_slug)
+    args = parser.parse_args()
+    options = MockUpstreamOptions(
+        tokens_per_second=args.tokens_per_second,
+        first_token_latency_ms=args.first_token_latency_ms,
+        reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        model_slug=args.model_slug,
+    )
+    uvicorn.run(create_app(options), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
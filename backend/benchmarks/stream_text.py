@@ -0,0 +1,83 @@
+"""
+流式回复文本累积的基准：模拟 8k token 的回复
+- 逐块拼接并构造消息内容（旧实现）与 TextChunkBuffer 按发送间隔拼接的对比
+- 通过 httpx.MockTransport 完整运行 OpenaiApiChatManager.ask，对比每块都拼接（coalesce_interval_ms=0）和默认间隔
+"""
+from benchmarks import setup_offline_config, timeit, print_results
+
+setup_offline_config()
+
+import asyncio
+import json
+
+import httpx
+
+from api.ask_stream import TextChunkBuffer
+from api.conf import Config
+from api.enums import OpenaiApiChatModels
+from api.models.doc import OpenaiApiChatMessageTextContent
+from api.sources import OpenaiApiChatManager
+
+config = Config()
+
+TOKEN_COUNT = 8192
+CHUNKS = [f"tok{i % 97} " for i in range(TOKEN_COUNT)]
+
+
+def naive_accumulate():
+    text = ""
+    for chunk in CHUNKS:
+        text += chunk
+        OpenaiApiChatMessageTextContent(content_type="text", text=text)
+
+
+def buffered_accumulate(flush_every: int):
+    buffer = TextChunkBuffer()
+    for index, chunk in enumerate(CHUNKS):
+        buffer.append(chunk)
+        if index % flush_every == 0:
+            OpenaiApiChatMessageTextContent(content_type="text", text=buffer.getvalue())
+    OpenaiApiChatMessageTextContent(content_type="text", text=buffer.getvalue())
+
+
+def make_sse_body() -> bytes:
+    lines = []
+    for index, chunk in enumerate(CHUNKS):
+        choice = {"index": 0, "delta": {"content": chunk}, "finish_reason": None}
+        if index == len(CHUNKS) - 1:
+            choice["finish_reason"] = "stop"
+        lines.append(f"data: {json.dumps({'choices': [choice]})}\n\n")
+    lines.append("data: [DONE]\n\n")
+    return "".join(lines).encode()
+
+
+def run_ask(coalesce_interval_ms: int, body: bytes):
+    config.ask_stream.coalesce_interval_ms = coalesce_interval_ms
+    manager = OpenaiApiChatManager()
+    manager.session = httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, content=body, headers={"content-type": "text/event-stream"})))
+
+    async def consume():
+        message = None
+        async for message in manager.ask("hello", model=OpenaiApiChatModels.gpt_3_5):
+            pass
+        assert message.content.text == "".join(CHUNKS)
+
+    asyncio.run(consume())
+
+
+def main():
+    print_results(f"accumulate {TOKEN_COUNT} chunks", [
+        ("naive (+= and new content per chunk)", timeit(naive_accumulate)),
+        ("TextChunkBuffer, flush every 20 chunks", timeit(lambda: buffered_accumulate(20))),
+        ("TextChunkBuffer, flush every chunk", timeit(lambda: buffered_accumulate(1))),
+    ])
+    body = make_sse_body()
+    print_results(f"OpenaiApiChatManager.ask over MockTransport, {TOKEN_COUNT} chunks", [
+        ("coalesce_interval_ms=0 (materialize every chunk)", timeit(lambda: run_ask(0, body), repeat=3)),
+        ("coalesce_interval_ms=50", timeit(lambda: run_ask(50, body), repeat=3)),
+    ])
+
+
+if __name__ == "__main__":
+    main()
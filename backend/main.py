@@ -11,18 +11,18 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.inmemory import InMemoryBackend
 from pydantic import EmailStr
-from sqlalchemy import select
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 import api.globals as g
 from api.database.sqlalchemy import initialize_db, get_async_session_context, get_user_db_context
+from api.batch_ask import BatchAskJobRunner
+from api.chat_session import ChatSessionRegistry
+from api.quota_ledger import QuotaLedger
 from api.database.mongodb import init_mongodb
-from api.enums import OpenaiWebChatStatus
 from api.exceptions import SelfDefinedException, UserAlreadyExists
 from api.middlewares import AccessLoggerMiddleware, StatisticsMiddleware
-from api.models.db import User
 from api.response import CustomJSONResponse, handle_exception_response
-from api.routers import users, conv, chat, system, status, files
+from api.routers import users, conv, chat, system, status, files, batch_ask
 from api.schemas import UserCreate, UserSettingSchema
 from api.sources import OpenaiWebChatManager
 from api.users import get_user_manager_context
@@ -50,6 +50,7 @@ app.include_router(chat.router)
 app.include_router(system.router)
 app.include_router(status.router)
 app.include_router(files.router)
+app.include_router(batch_ask.router)
 
 # 解决跨站问题
 app.add_middleware(
@@ -87,6 +88,12 @@ async def on_startup():
 
     # 初始化 chatgpt_manager
     g.chatgpt_manager = OpenaiWebChatManager()
+    if config.openai_web.enabled and config.openai_web.warm_up_on_startup and config.openai_web.chatgpt_base_url:
+        asyncio.create_task(g.chatgpt_manager.warm_up())
+
+    # 继续执行上次未完成的批量提问任务
+    if config.openai_api.enabled:
+        await BatchAskJobRunner().resume_unfinished_jobs()
 
     if config.common.create_initial_admin_user:
         try:
@@ -108,14 +115,10 @@ async def on_startup():
         except Exception as e:
             raise e
 
-    # 重置所有用户 chat_status
-    async with get_async_session_context() as session:
-        r = await session.execute(select(User))
-        results = r.scalars().all()
-        for user in results:
-            user.setting.openai_web_chat_status = OpenaiWebChatStatus.idling
-            session.add(user.setting)
-        await session.commit()
+    # 重置所有用户 chat_status；之后的状态只记录在内存中
+    await ChatSessionRegistry().reset_snapshot()
+    ChatSessionRegistry().start_snapshot()
+    QuotaLedger().start_flush()
 
     if config.openai_web.chatgpt_base_url is None:
         logger.error("chatgpt_base_url is not set in config!")
@@ -145,6 +148,8 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     logger.info("On shutdown...")
+    # 写入尚未写入数据库的提问次数扣除
+    await QuotaLedger().flush()
 
 
 # @api.get("/routes")
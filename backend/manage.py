@@ -36,11 +36,28 @@ def get_model_definitions(args):
     print(json.dumps(result))
 
 
+def migrate_history_layout(args):
+    if len(args) < 1 or args[0] not in ("embedded", "split"):
+        print("Usage: python manage.py migrate_history_layout [embedded|split]")
+        sys.exit(1)
+    import asyncio
+    from api.database.mongodb import init_mongodb
+    from api.conversation_history import migrate_conversation_history
+
+    async def migrate():
+        await init_mongodb()
+        count = await migrate_conversation_history(args[0])
+        print(f"Migrated {count} conversation histories to {args[0]} layout")
+
+    asyncio.run(migrate())
+
+
 commands = {
     "create_config": create_config,
     "get_config_schema": get_config_schema,
     "get_credentials_schema": get_credentials_schema,
-    "get_model_definitions": get_model_definitions
+    "get_model_definitions": get_model_definitions,
+    "migrate_history_layout": migrate_history_layout
 }
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+"""
+对话同步（utils/admin/sync_conv.py）的测试，使用临时目录中的 SQLite 数据库，不请求上游；在 backend 目录下运行：
+
+    python -m unittest tests.test_sync_conv
+"""
+from benchmarks import setup_offline_config
+
+setup_offline_config()
+
+import unittest
+import uuid
+from unittest import mock
+
+from sqlalchemy import select
+
+from api.database.sqlalchemy import initialize_db, get_async_session_context
+from api.models.db import BaseConversation
+from utils.admin import sync_conv
+
+CONVERSATION_ID = str(uuid.uuid4())
+
+
+class SyncConversationsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        await initialize_db()
+        self.calls: list[tuple[str, object]] = []
+
+        async def get_conversations(account_name: str | None = None, updated_after=None, **_):
+            self.calls.append((account_name, updated_after))
+            if account_name == "empty":
+                return []
+            return [{"id": CONVERSATION_ID, "title": "hello", "create_time": "2023-10-01T00:00:00+00:00",
+                     "update_time": "2023-10-02T00:00:00+00:00"}]
+
+        for patcher in (mock.patch.object(sync_conv.manager, "accounts", {"default": None, "empty": None}),
+                        mock.patch.object(sync_conv.manager, "get_conversations", get_conversations),
+                        mock.patch.object(sync_conv.config.openai_web, "sync_conversations_incremental", True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_account_without_conversations_does_not_force_full_sync(self):
+        self.assertIsNone(await sync_conv.sync_conversations(full=True))
+        self.assertEqual({name: updated_after for name, updated_after in self.calls},
+                         {"default": None, "empty": None})
+
+        self.calls.clear()
+        self.assertIsNone(await sync_conv.sync_conversations())
+        # 两个账号都有同步记录，第二次为增量同步
+        self.assertEqual(len(self.calls), 2)
+        for name, updated_after in self.calls:
+            self.assertIsNotNone(updated_after, name)
+
+        async with get_async_session_context() as session:
+            r = await session.execute(select(BaseConversation.is_valid, BaseConversation.openai_web_account))
+            self.assertEqual(r.all(), [(True, "default")])
+
+
+if __name__ == "__main__":
+    unittest.main()
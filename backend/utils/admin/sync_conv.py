@@ -1,64 +1,131 @@
-import dateutil.parser
-from dateutil.tz import tzutc
-from httpx import HTTPError
-from sqlalchemy import select
+import json
+import os
+from datetime import datetime, timezone
 
+from sqlalchemy import select, update, case
+from sqlalchemy.dialects.sqlite import insert
+
+from api.conf import Config
 from api.database.sqlalchemy import get_async_session_context
+from api.enums import ChatSourceTypes
 from api.exceptions import OpenaiWebException
-from api.models.db import OpenaiWebConversation
-from api.sources import OpenaiWebChatManager
+from api.models.db import BaseConversation
+from api.sources import OpenaiWebChatManager, DEFAULT_ACCOUNT_NAME, parse_openai_web_time
+from api.user_limits import UserLimitsCache
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+config = Config()
 manager = OpenaiWebChatManager()
 
+SYNC_WATERMARK_FILE_PATH = os.path.join(config.data.data_dir, "sync_conv_watermark.json")
+_UPSERT_BATCH_SIZE = 500
+# 较旧的 SQLite 限制每条语句最多 999 个参数（SQLITE_MAX_VARIABLE_NUMBER）
+_SQLITE_MAX_VARIABLES = 999
+
 
-async def sync_conversations() -> Exception | None:
+def _load_watermarks() -> dict[str, datetime]:
+    """
+    每个账号上次同步时见到的最大 update_time
+    """
+    if not os.path.exists(SYNC_WATERMARK_FILE_PATH):
+        return {}
     try:
-        logger.info("Start syncing conversations...")
-        result = await manager.get_conversations()
-        logger.info(f"Fetched {len(result)} conversations from ChatGPT account.")
-        openai_conversations_map = {conv['id']: conv for conv in result}
+        with open(SYNC_WATERMARK_FILE_PATH, "r") as f:
+            return {name: parse_openai_web_time(value) for name, value in json.load(f).items()}
+    except Exception as e:
+        logger.warning(f"Failed to load sync watermark: {e}")
+        return {}
+
+
+def _save_watermarks(watermarks: dict[str, datetime]):
+    with open(SYNC_WATERMARK_FILE_PATH, "w") as f:
+        json.dump({name: value.isoformat() for name, value in watermarks.items()}, f)
+
+
+async def sync_conversations(full: bool = False) -> Exception | None:
+    """
+    同步 ChatGPT 账号中的对话到数据库
+    - 增量同步：只获取上次同步后更新过的对话，新增或更新数据库记录
+    - 全量同步：获取全部对话，并将账号中已不存在的对话标记为无效
+    full 为 False 时，若关闭了增量同步或有账号没有同步记录，仍会进行全量同步
+    """
+    try:
+        sync_start_time = datetime.now(tz=timezone.utc)
+        watermarks = {} if full else _load_watermarks()
+        is_full_sync = full or not config.openai_web.sync_conversations_incremental or \
+            any(name not in watermarks for name in manager.accounts)
+        logger.info(f"Start syncing conversations ({'full' if is_full_sync else 'incremental'})...")
+
+        openai_conversations_map = {}
+        conversation_account_map = {}
+        new_watermarks = dict(watermarks)
+        for account_name in manager.accounts:
+            result = await manager.get_conversations(
+                account_name=account_name, updated_after=None if is_full_sync else watermarks[account_name])
+            logger.info(f"Fetched {len(result)} conversations from ChatGPT account {account_name}.")
+            for conv in result:
+                openai_conversations_map[conv["id"]] = conv
+                conversation_account_map[conv["id"]] = account_name
+                update_time = parse_openai_web_time(conv.get("update_time"))
+                if update_time and (account_name not in new_watermarks or update_time > new_watermarks[account_name]):
+                    new_watermarks[account_name] = update_time
+            if is_full_sync:
+                # 没有对话的账号也要记录，否则之后每次都会进行全量同步
+                new_watermarks.setdefault(account_name, sync_start_time)
+
+        rows = [
+            dict(
+                conversation_id=conv_id,
+                source=ChatSourceTypes.openai_web,
+                title=conv["title"],
+                is_valid=True,
+                create_time=parse_openai_web_time(conv["create_time"]),
+                update_time=parse_openai_web_time(conv.get("update_time")),
+                openai_web_account=conversation_account_map[conv_id] or DEFAULT_ACCOUNT_NAME,
+            ) for conv_id, conv in openai_conversations_map.items()
+        ]
+
         async with get_async_session_context() as session:
-            r = await session.execute(select(OpenaiWebConversation))
-            results = r.scalars().all()
-
-            for conv_db in results:
-                openai_conv = openai_conversations_map.get(str(conv_db.conversation_id), None)
-                if openai_conv:
-                    # 同步标题
-                    if openai_conv["title"] != conv_db.title:
-                        conv_db.title = openai_conv["title"]
-                        logger.info(f"Conversation {conv_db.conversation_id} title changed: {conv_db.title}")
-                    # 同步时间
-                    create_time = dateutil.parser.isoparse(openai_conv["create_time"]).astimezone(tzutc())
-                    if create_time != conv_db.create_time:
-                        conv_db.create_time = create_time
-                        logger.info(
-                            f"Conversation {conv_db.conversation_id} create time changed：{conv_db.create_time}")
-                    session.add(conv_db)
-                    openai_conversations_map.pop(str(conv_db.conversation_id))
-                else:
-                    if conv_db.is_valid:  # 数据库中存在，但 ChatGPT 中（可能）不存在
-                        conv_db.is_valid = False
-                        logger.info(
-                            f"Conversation [{conv_db.title}]({conv_db.conversation_id}) may be deleted, marked as invalid.")
-                        session.add(conv_db)
-
-            # 新增对话
-            for openai_conv in openai_conversations_map.values():
-                new_conv = OpenaiWebConversation(
-                    conversation_id=openai_conv["id"],
-                    title=openai_conv["title"],
-                    is_valid=True,
-                    create_time=dateutil.parser.isoparse(openai_conv["create_time"])
-                )
-                session.add(new_conv)
-                logger.info(
-                    f"Found new conversation [{new_conv.title}]({new_conv.conversation_id})")
+            # 批量 upsert：已存在的对话同步标题、创建时间和所属账号，update_time 取较新值，不改变 is_valid
+            batch_size = _SQLITE_MAX_VARIABLES // len(rows[0]) if rows else 1
+            for i in range(0, len(rows), batch_size):
+                stmt = insert(BaseConversation).values(rows[i:i + batch_size])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[BaseConversation.conversation_id],
+                    set_={
+                        "title": stmt.excluded.title,
+                        "create_time": stmt.excluded.create_time,
+                        "openai_web_account": stmt.excluded.openai_web_account,
+                        "update_time": case(
+                            (BaseConversation.update_time.is_(None) |
+                             (stmt.excluded.update_time > BaseConversation.update_time), stmt.excluded.update_time),
+                            else_=BaseConversation.update_time),
+                    })
+                await session.execute(stmt)
+            logger.info(f"Upserted {len(rows)} conversations.")
+
+            # 只有全量同步才能确定哪些对话已被删除
+            if is_full_sync:
+                r = await session.execute(
+                    select(BaseConversation.id, BaseConversation.conversation_id, BaseConversation.title).where(
+                        BaseConversation.source == ChatSourceTypes.openai_web, BaseConversation.is_valid))
+                invalid_ids = []
+                for id_, conversation_id, title in r.all():
+                    if str(conversation_id) not in openai_conversations_map:
+                        invalid_ids.append(id_)
+                        logger.info(f"Conversation [{title}]({conversation_id}) may be deleted, marked as invalid.")
+                for i in range(0, len(invalid_ids), _UPSERT_BATCH_SIZE):
+                    await session.execute(
+                        update(BaseConversation).where(
+                            BaseConversation.id.in_(invalid_ids[i:i + _UPSERT_BATCH_SIZE])).values(is_valid=False))
 
             await session.commit()
+        # 同步可能新增对话或将对话标记为无效
+        UserLimitsCache().invalidate_conv_count()
+
+        _save_watermarks(new_watermarks)
         logger.info("Sync conversations finished.")
         return None
     except OpenaiWebException as e: